@@ -0,0 +1,179 @@
+"""実際のレスポンスを記録し、ネットワークなしで再生してotogeの解析時間を測ります。
+
+    python -m benchmarks.cassette record --user-id <DiscordのユーザーID>
+    python -m benchmarks.cassette replay --iterations 50
+
+記録先はbenchmarks.loadと同じ benchmarks/pages で、代わりのサーバーでもそのまま使えます。
+記録したページには個人情報やCookieが含まれるので、公開しないでください。
+"""
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import httpx
+import orjson
+
+from benchmarks.fakeUpstream import pagePath, useTransport
+
+
+def requestPagePath(directory: Path, request: httpx.Request) -> Path:
+    url = request.url
+    return pagePath(directory, url.host, url.path, url.query.decode())
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """通常どおり通信し、受け取ったレスポンスをページとして保存します。"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.transport = httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        response = await self.transport.handle_async_request(request)
+        content = await response.aread()
+        file = requestPagePath(self.directory, request)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        file.write_bytes(content)
+        headers = {
+            key: value
+            for key, value in response.headers.items()
+            if key not in ("content-encoding", "content-length", "transfer-encoding")
+        }
+        file.with_name(f"{file.name}.meta.json").write_bytes(
+            orjson.dumps({"status": response.status_code, "headers": headers})
+        )
+        return httpx.Response(
+            response.status_code, headers=headers, content=content, request=request
+        )
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """保存したページをメモリから返します。通信は一切しません。"""
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.pages: dict[Path, tuple[int, dict[str, str], bytes]] = {}
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        file = requestPagePath(self.directory, request)
+        page = self.pages.get(file)
+        if page is None:
+            if not file.is_file():
+                return httpx.Response(404, request=request)
+            meta = file.with_name(f"{file.name}.meta.json")
+            status, headers = 200, {}
+            if meta.is_file():
+                data = orjson.loads(meta.read_bytes())
+                status, headers = data["status"], data["headers"]
+            page = (status, headers, file.read_bytes())
+            self.pages[file] = page
+        status, headers, content = page
+        return httpx.Response(status, headers=headers, content=content, request=request)
+
+
+Scenarios = dict[str, Callable[[], Awaitable[Any]]]
+
+
+async def maimaiScenarios(row: dict[str, Any]) -> Scenarios:
+    from otoge import MaiMaiClient
+
+    from services.segaSession import cipherSuite
+
+    segaId = cipherSuite.decrypt(row["segaid"].encode()).decode()
+    password = cipherSuite.decrypt(row["password"].encode()).decode()
+    client = MaiMaiClient()
+    aime = (await client.login(segaId, password))[row["aime"]]
+    await aime.select()
+
+    async def login():
+        await MaiMaiClient().login(segaId, password)
+
+    return {"maimai login": login, "maimai aime.record": aime.record}
+
+
+async def konamiScenarios(row: dict[str, Any]) -> Scenarios:
+    from services import konami
+    from services.recordSync import konamiGames
+
+    scenarios = {}
+    for game, clientClass in konamiGames.items():
+        client = konami.createClient(clientClass, row)
+        scenarios[f"{game} fetchProfile"] = client.fetchProfile
+        # pop'n musicの履歴はプロフィールに含まれている
+        if game != "popn":
+            scenarios[f"{game} fetchPlayRecords"] = client.fetchPlayRecords
+    return scenarios
+
+
+async def run(call: Callable[[], Awaitable[Any]], iterations: int) -> tuple[float, int]:
+    """1回あたりの平均時間 (ミリ秒) と、確保したメモリの最大量 (バイト) を返します。
+    tracemallocは処理を遅くするので、時間とメモリは別々に測ります。
+    """
+    await call()
+    startedAt = time.perf_counter()
+    for _ in range(iterations):
+        await call()
+    elapsed = time.perf_counter() - startedAt
+
+    tracemalloc.start()
+    await call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed / iterations * 1000, peak
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("--pages", default="benchmarks/pages")
+    parser.add_argument("--user-id", type=int)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+    directory = Path(args.pages)
+
+    if args.mode == "record":
+        from services.database import Database
+
+        useTransport(lambda: RecordingTransport(directory))
+        await Database.connect()
+        aimeRow = dict(await Database.fetchrow("aimeAccount", args.user_id))
+        konamiRow = dict(await Database.fetchrow("konamiAccount", args.user_id))
+        await Database.pool.close()
+        for scenarios in (
+            await maimaiScenarios(aimeRow),
+            await konamiScenarios(konamiRow),
+        ):
+            for name, call in scenarios.items():
+                await call()
+                print(f"recorded {name}")
+        return
+
+    # 読み込んだページを使い回せるように、全クライアントで一つのtransportを共有する
+    replay = ReplayTransport(directory)
+    useTransport(lambda: replay)
+    # 再生時は認証情報を使わないので、データベースの行の代わりに仮の値を使う
+    from services import konami, segaSession
+
+    dummy = segaSession.cipherSuite.encrypt(b"benchmark").decode()
+    aimeRow = {"id": 0, "segaid": dummy, "password": dummy, "aime": 0}
+    konamiRow = {
+        "id": 0,
+        "cookies": konami.cipherSuite.encrypt(orjson.dumps([])).decode(),
+    }
+
+    print(f"{'scenario':<28} {'ms/call':>9} {'peak KiB':>9}")
+    for scenarios in (
+        await maimaiScenarios(aimeRow),
+        await konamiScenarios(konamiRow),
+    ):
+        for name, call in scenarios.items():
+            milliseconds, peak = await run(call, args.iterations)
+            print(f"{name:<28} {milliseconds:>9.2f} {peak / 1024:>9.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+from typing import Any
+
+
+class FakeResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def defer(self, **kwargs: Any):
+        self.interaction.deferred = True
+
+    async def send_message(self, **kwargs: Any):
+        self.interaction.sent.append(kwargs)
+
+    async def send_modal(self, modal: Any):
+        self.interaction.sent.append({"modal": modal})
+
+
+class FakeFollowup:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def send(self, **kwargs: Any):
+        self.interaction.sent.append(kwargs)
+
+
+class FakeInteraction:
+    """コマンドの処理に必要な部分だけを持つ、discord.Interactionの代わりです。"""
+
+    def __init__(self, userId: int):
+        self.user = SimpleNamespace(id=userId, display_name=f"user{userId}")
+        self.guild_id = None
+        self.extras: dict[str, Any] = {}
+        self.data: dict[str, Any] = {}
+        self.deferred = False
+        self.sent: list[dict[str, Any]] = []
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+    async def edit_original_response(self, **kwargs: Any):
+        self.sent.append(kwargs)
@@ -0,0 +1,97 @@
+import asyncio
+import socket
+from pathlib import Path
+from typing import Callable
+from urllib.parse import quote
+
+import httpx
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+
+
+def pagePath(directory: Path, host: str, path: str, query: str) -> Path:
+    """記録したページの保存先です。pages/<ホスト>/<パスとクエリ> に置きます。"""
+    name = quote(path.strip("/") + (f"?{query}" if query else ""), safe="/") or "index"
+    return directory / host / name
+
+
+def createApp(directory: Path, latency: float = 0.0) -> FastAPI:
+    """記録したページを返す、SEGA・eagateの代わりのサーバーを作ります。
+    ページと同じ場所にある <ページ>.meta.json があれば、ステータスとヘッダーに使います。
+    """
+    app = FastAPI()
+
+    @app.api_route("/{host}/{path:path}", methods=["GET", "POST"])
+    async def page(host: str, path: str, request: Request):
+        if latency:
+            await asyncio.sleep(latency)
+        file = pagePath(directory, host, path, request.url.query)
+        if not file.is_file():
+            return Response(status_code=404)
+        meta = file.with_name(f"{file.name}.meta.json")
+        status, headers = 200, {}
+        if meta.is_file():
+            data = orjson.loads(meta.read_bytes())
+            status, headers = data["status"], data["headers"]
+        return Response(file.read_bytes(), status_code=status, headers=headers)
+
+    return app
+
+
+class RedirectTransport(httpx.AsyncBaseTransport):
+    """すべてのリクエストを、ホスト名をパスに含めて代わりのサーバーへ送ります。"""
+
+    def __init__(self, baseUrl: str):
+        self.baseUrl = httpx.URL(baseUrl)
+        self.transport = httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = self.baseUrl.copy_with(
+            path=f"/{request.url.host}{request.url.path}", query=request.url.query
+        )
+        redirected = httpx.Request(
+            request.method,
+            url,
+            headers=[(k, v) for k, v in request.headers.raw if k.lower() != b"host"],
+            stream=request.stream,
+        )
+        return await self.transport.handle_async_request(redirected)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def useTransport(factory: Callable[[], httpx.AsyncBaseTransport]):
+    """以降に作られるhttpxのクライアント (otogeのものを含む) のtransportを差し替えます。
+    transportを明示したクライアント (ASGITransportなど) はそのままにします。
+    """
+    original = httpx.AsyncClient.__init__
+
+    def init(self, *args, **kwargs):
+        kwargs.setdefault("transport", factory())
+        original(self, *args, **kwargs)
+
+    httpx.AsyncClient.__init__ = init
+
+
+def redirectUpstreams(baseUrl: str):
+    useTransport(lambda: RedirectTransport(baseUrl))
+
+
+def freePort() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def serve(app: FastAPI) -> tuple[uvicorn.Server, str]:
+    port = freePort()
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, f"http://127.0.0.1:{port}"
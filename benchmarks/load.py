@@ -0,0 +1,161 @@
+"""記録したページを返す代わりのサーバーを立て、コマンドとAPIの負荷試験をします。
+
+    python -m benchmarks.load --pages benchmarks/pages --concurrency 16 --requests 200
+
+dsnには使い捨てのデータベースを指定してください。ベンチマーク用のユーザーが登録されます。
+上流のレート制限 (sega_rate など) も測定に影響するので、必要に応じて緩めてください。
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+
+import httpx
+import orjson
+
+from benchmarks.fakeDiscord import FakeInteraction
+from benchmarks.fakeUpstream import createApp, redirectUpstreams, serve
+
+# 実在のユーザーと重ならないID
+benchmarkUserId = 9_000_000_000_000_000_000
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def measure(
+    name: str,
+    concurrency: int,
+    count: int,
+    call: Callable[[int], Awaitable[None]],
+) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    errors = 0
+
+    async def one(index: int):
+        nonlocal errors
+        async with semaphore:
+            startedAt = time.perf_counter()
+            try:
+                await call(index)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - startedAt)
+
+    startedAt = time.perf_counter()
+    await asyncio.gather(*[one(index) for index in range(count)])
+    elapsed = time.perf_counter() - startedAt
+    return {
+        "name": name,
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "throughput": count / elapsed,
+        "errors": errors,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", default="benchmarks/pages")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--image-url", default="https://maimaidx.jp/maimai-mobile/img/")
+    parser.add_argument("--only", nargs="*")
+    args = parser.parse_args()
+
+    server, baseUrl = await serve(createApp(Path(args.pages), args.latency))
+    redirectUpstreams(baseUrl)
+    os.environ["image_cache_dir"] = tempfile.mkdtemp(prefix="otogebot-bench-")
+
+    # httpxを差し替えてから読み込む
+    from cogs.maimai import MaimaiCog
+    from cogs.nostalgia import NostalgiaCog
+    from cogs.polaris import PolarisChordCog
+    from cogs.popn import POPNMusicCog
+    from main import app
+    from services import konami, segaSession
+    from services.database import Database
+    from services.http import HTTPClientPool
+    from services.imageCache import ImageCache
+    from services.records import PlayRecords
+
+    await Database.connect()
+    await PlayRecords.createTables()
+    HTTPClientPool.open()
+    ImageCache.open()
+
+    userIds = [benchmarkUserId + index for index in range(args.users)]
+    for userId in userIds:
+        dummy = segaSession.cipherSuite.encrypt(b"benchmark").decode()
+        await Database.execute("saveAimeAccount", userId, dummy, dummy, 0)
+        cookies = konami.cipherSuite.encrypt(orjson.dumps([])).decode()
+        await Database.execute("saveKonamiAccount", userId, cookies)
+
+    cogs = {
+        "maimai": MaimaiCog(None),
+        "popn": POPNMusicCog(None),
+        "polaris": PolarisChordCog(None),
+        "nos": NostalgiaCog(None),
+    }
+
+    def command(cog, name: str):
+        async def call(index: int):
+            await getattr(cog, name).callback(
+                cog, FakeInteraction(userIds[index % len(userIds)])
+            )
+
+        return call
+
+    api = httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://api"
+    )
+
+    def route(path: Callable[[int], str]):
+        async def call(index: int):
+            response = await api.get(path(userIds[index % len(userIds)]))
+            response.raise_for_status()
+
+        return call
+
+    scenarios = {
+        f"{game} {name}": command(cog, f"{name}Command")
+        for game, cog in cogs.items()
+        for name in ("profile", "record")
+    }
+    scenarios["GET /icon/maimai"] = route(lambda userId: f"/icon/{userId}/maimai")
+    scenarios["GET /icon/popn"] = route(lambda userId: f"/icon/{userId}/popn")
+    scenarios["GET /imageProxy"] = route(
+        lambda userId: f"/imageProxy?url={args.image_url}"
+    )
+
+    print(
+        f"{'scenario':<20} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+        f" {'req/s':>9} errors"
+    )
+    for name, call in scenarios.items():
+        if args.only and name not in args.only:
+            continue
+        result = await measure(name, args.concurrency, args.requests, call)
+        print(
+            f"{result['name']:<20} {result['p50']:>9.1f} {result['p95']:>9.1f}"
+            f" {result['p99']:>9.1f} {result['throughput']:>9.1f} {result['errors']}"
+        )
+
+    await api.aclose()
+    await HTTPClientPool.close()
+    await Database.pool.close()
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import os
+import time
+
+import discord
+import dotenv
+import orjson
+from discord import app_commands
+from discord.ext import commands, tasks
+from prometheus_client import start_http_server
+
+from services import metrics, tracing
+from services.database import Database
+from services.guilds import GuildMembers
+from services.http import HTTPClientPool
+from services.imageCache import ImageCache
+from services.invalidation import Invalidation
+from services.records import PlayRecords
+from services.renderer import Renderer
+from views.recordPaginator import RecordPageButton
+
+dotenv.load_dotenv()
+
+discord.utils.setup_logging()
+
+
+def parseShardIds(value: str | None) -> list[int] | None:
+    """"0,1,2" や "0-3" の形式のシャードIDを読み取ります。"""
+    if not value:
+        return None
+    shardIds = []
+    for part in value.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            shardIds.extend(range(int(start), int(end) + 1))
+        else:
+            shardIds.append(int(part))
+    return shardIds
+
+
+# 複数のプロセスでシャードを分担する場合は、launcher.pyがこれらを設定する
+clusterId = int(os.getenv("cluster_id", "0"))
+shardCount = int(os.getenv("shard_count")) if os.getenv("shard_count") else None
+shardIds = parseShardIds(os.getenv("shard_ids"))
+
+
+class CommandTree(app_commands.CommandTree):
+    """コマンドごとのメトリクスとトレースを記録します。"""
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        # オートコンプリートは完了の通知が来ないので、スパンを始めると閉じられない
+        if interaction.type is discord.InteractionType.autocomplete:
+            return True
+        name = interaction.command.qualified_name if interaction.command else "unknown"
+        interaction.extras["span"] = tracing.startSpan(
+            f"command {name}", user=interaction.user.id
+        )
+        if interaction.guild_id is not None:
+            await GuildMembers.remember(interaction.guild_id, interaction.user.id)
+        return True
+
+    async def on_error(
+        self, interaction: discord.Interaction, error: app_commands.AppCommandError
+    ):
+        name = interaction.command.qualified_name if interaction.command else "unknown"
+        metrics.commandErrors.labels(name).inc()
+        metrics.commandLatency.labels(name).observe(
+            (discord.utils.utcnow() - interaction.created_at).total_seconds()
+        )
+        if "span" in interaction.extras:
+            tracing.endSpan(interaction.extras.pop("span"), error)
+        await super().on_error(interaction, error)
+
+
+bot = commands.AutoShardedBot(
+    "otogebot#",
+    intents=discord.Intents.default(),
+    shard_count=shardCount,
+    shard_ids=shardIds,
+    tree_cls=CommandTree,
+)
+
+
+class Presence:
+    """ステータスに表示する値をキャッシュします。"""
+
+    # application_infoはREST呼び出しなので、ステータスの更新より長い間隔で取得する
+    refreshSeconds: float = float(os.getenv("app_info_refresh_seconds", "900"))
+    installCount: int = 0
+    fetchedAt: float = float("-inf")
+    current: str | None = None
+
+
+@tasks.loop(seconds=20)
+async def precenseLoop():
+    if time.monotonic() - Presence.fetchedAt >= Presence.refreshSeconds:
+        appInfo = await bot.application_info()
+        Presence.installCount = appInfo.approximate_user_install_count
+        Presence.fetchedAt = time.monotonic()
+    # 他のクラスターのサーバー数と合算する
+    await Database.execute("saveClusterStats", clusterId, len(bot.guilds))
+    guildCount = await Database.fetchval("totalGuildCount")
+    text = f"/help | {guildCount} servers | {Presence.installCount} users"
+    if text == Presence.current:
+        return
+    await bot.change_presence(status=discord.Status.online, activity=discord.Game(text))
+    Presence.current = text
+
+
+@bot.event
+async def on_ready():
+    # 再接続するとステータスは消えるので、次のループで必ず送り直す
+    Presence.current = None
+    if not precenseLoop.is_running():
+        precenseLoop.start()
+
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    await GuildMembers.forget(guild.id)
+
+
+@bot.event
+async def on_app_command_completion(
+    interaction: discord.Interaction, command: app_commands.Command
+):
+    metrics.commandLatency.labels(command.qualified_name).observe(
+        (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    )
+    if "span" in interaction.extras:
+        tracing.endSpan(interaction.extras.pop("span"))
+
+
+async def syncCommandTree():
+    """コマンドツリーが前回の同期から変わっている場合のみ同期します。
+    force_command_syncを1にすると、変わっていなくても同期します。
+    """
+    payload = orjson.dumps(
+        [command.to_dict(bot.tree) for command in bot.tree.get_commands()],
+        option=orjson.OPT_SORT_KEYS,
+        default=str,
+    )
+    digest = hashlib.sha256(payload).hexdigest()
+    key = f"commandTreeHash:{bot.application_id}"
+
+    await Database.execute("createBotState")
+    if (
+        os.getenv("force_command_sync") != "1"
+        and await Database.fetchval("botState", key) == digest
+    ):
+        return
+    await bot.tree.sync()
+    await Database.execute("saveBotState", key, digest)
+
+
+@bot.event
+async def setup_hook():
+    await bot.load_extension("cogs.maimai")
+    await bot.load_extension("cogs.popn")
+    await bot.load_extension("cogs.polaris")
+    await bot.load_extension("cogs.nostalgia")
+    await bot.load_extension("cogs.otoge")
+    bot.add_dynamic_items(RecordPageButton)
+    async with Database.lock("schema"):
+        await Database.execute("createClusterStats")
+    # 全クラスターで一度だけ行えばよい処理
+    if clusterId == 0:
+        await bot.load_extension("cogs.sync")
+        await syncCommandTree()
+
+
+async def main():
+    """ボットだけを起動します。APIはmain.pyをrole=apiで起動してください。"""
+    await Database.connect()
+    await PlayRecords.createTables()
+    await Invalidation.listen()
+    HTTPClientPool.open()
+    ImageCache.open()
+    Renderer.open()
+    if os.getenv("metrics_port"):
+        # ボットだけのプロセスでは、別のポートで/metricsを公開する
+        start_http_server(int(os.getenv("metrics_port")))
+    asyncio.create_task(metrics.monitorEventLoopLag())
+    asyncio.create_task(metrics.monitorPool(Database.pool))
+    try:
+        async with bot:
+            await bot.start(os.getenv("discord"))
+    finally:
+        await Invalidation.close()
+        await Database.pool.close()
+        await HTTPClientPool.close()
+        Renderer.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
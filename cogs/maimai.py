@@ -1,5 +1,6 @@
 import os
 
+import asyncpg
 import discord
 import dotenv
 from cryptography.fernet import Fernet
@@ -8,7 +9,18 @@ from discord.ext import commands
 from otoge import MaiMaiClient
 from otoge.maimai import MaiMaiAime, MaiMaiPlayRecord
 
+from services import recordSync, tracing
 from services.database import Database
+from services.http import countResponses
+from services.invalidation import Invalidation
+from services.rating import MaimaiRating, RatingEntry
+from services.segaSession import SegaSessions
+from services.renderer import Card
+from views.leaderboard import Leaderboards
+from views.recordCard import RecordCards
+from views.recordExport import RecordExports
+from views.recordPaginator import RecordPaginator
+from views.songLookup import SongLookup
 
 dotenv.load_dotenv()
 
@@ -16,6 +28,9 @@ dotenv.load_dotenv()
 class MaimaiCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        RecordPaginator.renderers["maimai"] = self.recordEmbeds
+        RecordCards.builders["maimai"] = self.recordCard
+        MaimaiRating.open()
         self.cipherSuite = Fernet(os.getenv("fernet_key").encode())
 
     group = app_commands.Group(name="maimai", description="maimai関連のコマンド。")
@@ -30,7 +45,7 @@ class MaimaiCog(commands.Cog):
         self, interaction: discord.Interaction, segaid: str, password: str
     ):
         await interaction.response.defer(ephemeral=True)
-        client = MaiMaiClient()
+        client = countResponses(MaiMaiClient())
         try:
             aimeList = await client.login(segaid, password)
         except Exception as e:
@@ -56,21 +71,14 @@ class MaimaiCog(commands.Cog):
 
         async def selectCallback(interaction: discord.Interaction):
             await interaction.response.defer(ephemeral=True)
-            await Database.pool.execute(
-                """
-                    INSERT INTO aime (id, segaid, password, aime)
-                    VALUES ($1, $2, $3, $4)
-                    ON CONFLICT (id)
-                    DO UPDATE SET
-                        segaid = EXCLUDED.segaid,
-                        password = EXCLUDED.password,
-                        aime = excluded.aime
-                """,
+            await Database.execute(
+                "saveAimeAccount",
                 interaction.user.id,
                 self.cipherSuite.encrypt(segaid.encode()).decode(),
                 self.cipherSuite.encrypt(password.encode()).decode(),
                 int(interaction.data["values"][0]),
             )
+            await Invalidation.publish(interaction.user.id, "maimai")
             embed = discord.Embed(
                 title="ログインしました。",
                 colour=discord.Colour.green(),
@@ -87,12 +95,28 @@ class MaimaiCog(commands.Cog):
         )
         await interaction.followup.send(embed=embed, view=view)
 
+    async def profileEmbed(self, userId: int, row: asyncpg.Record) -> discord.Embed:
+        """プロフィールを取得して埋め込みにします。/otoge profileからも使われます。"""
+        session, _ = await SegaSessions.acquire(userId, row)
+        aime: MaiMaiAime = session.aime
+        return (
+            discord.Embed(
+                title=aime.name,
+                description=aime.comment,
+                colour=discord.Colour.purple(),
+            )
+            .set_thumbnail(
+                url=f"https://beats-api.nennneko5787.net/icon/{userId}/maimai"
+            )
+            .set_author(name=aime.trophy)
+            .set_footer(text="maimai")
+        )
+
     @group.command(name="profile", description="プロフィールを確認します。")
     async def profileCommand(self, interaction: discord.Interaction):
-        await interaction.response.defer()
-        row = await Database.pool.fetchrow(
-            "SELECT * FROM aime WHERE id = $1", interaction.user.id
-        )
+        with tracing.span("discord.defer"):
+            await interaction.response.defer()
+        row = await Database.fetchrow("aimeAccount", interaction.user.id)
         if not row:
             embed = discord.Embed(
                 title="エラーが発生しました！",
@@ -101,14 +125,8 @@ class MaimaiCog(commands.Cog):
             )
             await interaction.followup.send(embed=embed)
             return
-        client = MaiMaiClient()
         try:
-            aimeList = await client.login(
-                self.cipherSuite.decrypt(row["segaid"].encode()).decode(),
-                self.cipherSuite.decrypt(row["password"].encode()).decode(),
-            )
-            aime: MaiMaiAime = aimeList[row["aime"]]
-            await aime.select()
+            embed = await self.profileEmbed(interaction.user.id, row)
         except Exception as e:
             embed = discord.Embed(
                 title="エラーが発生しました！",
@@ -118,19 +136,8 @@ class MaimaiCog(commands.Cog):
             await interaction.followup.send(embed=embed)
             raise e
 
-        embed = (
-            discord.Embed(
-                title=aime.name,
-                description=aime.comment,
-                colour=discord.Colour.purple(),
-            )
-            .set_thumbnail(
-                url=f"https://beats-api.nennneko5787.net/icon/{interaction.user.id}/maimai"
-            )
-            .set_author(name=aime.trophy)
-            .set_footer(text="maimai")
-        )
-        await interaction.followup.send(embed=embed)
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embed=embed)
 
     def difficultToColor(self, difficult: str):
         match difficult:
@@ -145,111 +152,282 @@ class MaimaiCog(commands.Cog):
             case "REMASTER":
                 return discord.Colour.dark_purple()
 
-    @group.command(name="record", description="プレイ履歴を確認します。")
-    async def recordCommand(self, _interaction: discord.Interaction):
-        await _interaction.response.defer()
-        row = await Database.pool.fetchrow(
-            "SELECT * FROM aime WHERE id = $1", _interaction.user.id
+    def recordEmbeds(
+        self, userId: int, player: asyncpg.Record, record: MaiMaiPlayRecord
+    ) -> list[discord.Embed]:
+        embed = (
+            discord.Embed(
+                title=record.name,
+                description=f"`{record.percentage} ({record.scoreRank.replace('PLUS', '+')})` {'**NEW RECORD**' if record.percentageIsNewRecord else ''}\nでらっくスコア: `{record.deluxeScore}` {'**NEW RECORD**' if record.deluxeScoreIsNewRecord else ''}\n-# {'クリア' if record.cleared else '未クリア'} \\| {'フルコンボ' if record.fullCombo else '未フルコンボ'} \\| {'SYNC PLAY' if record.sync else 'NO SYNC PLAY'}",
+                colour=self.difficultToColor(record.difficult),
+                timestamp=record.playedAt,
+            )
+            .set_author(
+                name=player["name"],
+                icon_url=f"https://beats-api.nennneko5787.net/icon/{userId}/maimai",
+            )
+            .set_thumbnail(
+                url=f"https://beats-api.nennneko5787.net/imageProxy?url={record.jacketUrl}&w=160&format=webp",
+            )
+            .set_footer(text=record.difficult)
+        )
+        return [embed]
+
+    def recordCard(self, record: MaiMaiPlayRecord) -> Card:
+        colour = self.difficultToColor(record.difficult) or discord.Colour.light_grey()
+        return Card(
+            title=record.name,
+            lines=[
+                f"{record.percentage} ({record.scoreRank.replace('PLUS', '+')})",
+                f"でらっくスコア: {record.deluxeScore}",
+                record.difficult,
+            ],
+            colour=colour.value,
+            jacketUrl=record.jacketUrl,
+            badges=[
+                badge
+                for badge, achieved in (
+                    ("CLEAR", record.cleared),
+                    ("FC", record.fullCombo),
+                    ("SYNC", record.sync),
+                )
+                if achieved
+            ],
         )
+
+    @group.command(name="record", description="プレイ履歴を確認します。")
+    async def recordCommand(self, interaction: discord.Interaction):
+        with tracing.span("discord.defer"):
+            await interaction.response.defer()
+        row = await Database.fetchrow("aimeAccount", interaction.user.id)
         if not row:
             embed = discord.Embed(
                 title="エラーが発生しました！",
                 description="あなたはまだアカウントをリンクしていません！\n`/maimai link`コマンドを使用してアカウントをリンクしてください！",
                 colour=discord.Colour.red(),
             )
-            await _interaction.followup.send(embed=embed)
+            await interaction.followup.send(embed=embed)
             return
-        client = MaiMaiClient()
         try:
-            aimeList = await client.login(
-                self.cipherSuite.decrypt(row["segaid"].encode()).decode(),
-                self.cipherSuite.decrypt(row["password"].encode()).decode(),
+            await recordSync.ensureHistory("maimai", interaction.user.id, row)
+        except Exception as e:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description=f"{e}",
+                colour=discord.Colour.red(),
             )
-            aime: MaiMaiAime = aimeList[row["aime"]]
-            await aime.select()
-            records = await aime.record()
+            await interaction.followup.send(embed=embed)
+            raise e
+
+        if not await RecordPaginator.send(interaction, "maimai"):
+            embed = discord.Embed(
+                title="プレイ履歴がありません。",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+
+    @group.command(name="card", description="プレイ履歴を画像で確認します。")
+    @app_commands.rename(page="ページ")
+    @app_commands.describe(page="表示するページ。1ページに20件まで表示します。")
+    async def cardCommand(
+        self, interaction: discord.Interaction, page: app_commands.Range[int, 1] = 1
+    ):
+        with tracing.span("discord.defer"):
+            await interaction.response.defer()
+        row = await Database.fetchrow("aimeAccount", interaction.user.id)
+        if not row:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description="あなたはまだアカウントをリンクしていません！\n`/maimai link`コマンドを使用してアカウントをリンクしてください！",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            return
+        try:
+            await recordSync.ensureHistory("maimai", interaction.user.id, row)
         except Exception as e:
             embed = discord.Embed(
                 title="エラーが発生しました！",
                 description=f"{e}",
                 colour=discord.Colour.red(),
             )
-            await _interaction.followup.send(embed=embed)
+            await interaction.followup.send(embed=embed)
             raise e
 
-        view = discord.ui.View(timeout=None)
+        if not await RecordCards.send(interaction, "maimai", page - 1):
+            embed = discord.Embed(
+                title="プレイ履歴がありません。",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
 
-        leftButton = discord.ui.Button(
-            emoji="⏪", style=discord.ButtonStyle.blurple, custom_id="-1", disabled=True
-        )
-        infoButton = discord.ui.Button(label=f"1 / {len(records)}", disabled=True)
-        rightButton = discord.ui.Button(
-            emoji="⏩", style=discord.ButtonStyle.blurple, custom_id="1", disabled=False
+    def ratingLines(self, entries: list[RatingEntry]) -> str:
+        return "\n".join(
+            f"`{entry.rating:>3}` {entry.name} [{entry.difficult}] "
+            f"{entry.constant:.1f} / {entry.achievement:.4f}%"
+            for entry in entries
         )
 
-        async def panel(interaction: discord.Interaction, edit: bool = True):
-            leftButton.disabled = int(leftButton.custom_id) + 1 + 1 <= 1
-            rightButton.disabled = int(rightButton.custom_id) >= len(records)
+    @group.command(name="rating", description="レートの内訳を確認します。")
+    async def ratingCommand(self, interaction: discord.Interaction):
+        with tracing.span("discord.defer"):
+            await interaction.response.defer()
+        if MaimaiRating.charts is None:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description="譜面定数表が読み込まれていません。",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            return
+        row = await Database.fetchrow("aimeAccount", interaction.user.id)
+        if not row:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description="あなたはまだアカウントをリンクしていません！\n`/maimai link`コマンドを使用してアカウントをリンクしてください！",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            return
+        try:
+            await recordSync.ensureHistory("maimai", interaction.user.id, row)
+        except Exception as e:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description=f"{e}",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            raise e
 
-            record: MaiMaiPlayRecord = records[int(leftButton.custom_id) + 1]
-            embed = (
-                discord.Embed(
-                    title=record.name,
-                    description=f"`{record.percentage} ({record.scoreRank.replace('PLUS', '+')})` {'**NEW RECORD**' if record.percentageIsNewRecord else ''}\nでらっくスコア: `{record.deluxeScore}` {'**NEW RECORD**' if record.deluxeScoreIsNewRecord else ''}\n-# {'クリア' if record.cleared else '未クリア'} \\| {'フルコンボ' if record.fullCombo else '未フルコンボ'} \\| {'SYNC PLAY' if record.sync else 'NO SYNC PLAY'}",
-                    colour=self.difficultToColor(record.difficult),
-                    timestamp=record.playedAt,
-                )
-                .set_author(
-                    name=aime.name,
-                    icon_url=f"https://beats-api.nennneko5787.net/icon/{interaction.user.id}/maimai",
-                )
-                .set_thumbnail(
-                    url=f"https://beats-api.nennneko5787.net/imageProxy?url={record.jacketUrl}",
-                )
-                .set_footer(text=record.difficult)
+        with tracing.span("rating"):
+            breakdown = await MaimaiRating.breakdown(interaction.user.id)
+        embeds = [
+            discord.Embed(
+                title=f"レート: {breakdown.total}",
+                description=self.ratingLines(breakdown.new) or "なし",
+                colour=discord.Colour.purple(),
+            )
+            .set_author(
+                name=interaction.user.display_name,
+                icon_url=f"https://beats-api.nennneko5787.net/icon/{interaction.user.id}/maimai",
             )
-            if edit:
-                await interaction.edit_original_response(embed=embed, view=view)
-            else:
-                await interaction.followup.send(embed=embed, view=view)
+            .set_footer(
+                text=f"新曲枠: {sum(entry.rating for entry in breakdown.new)}"
+            ),
+            discord.Embed(
+                description=self.ratingLines(breakdown.old) or "なし",
+                colour=discord.Colour.purple(),
+            ).set_footer(
+                text=f"旧曲枠: {sum(entry.rating for entry in breakdown.old)}"
+            ),
+        ]
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embeds=embeds)
 
-        async def left(interaction: discord.Interaction):
-            if _interaction.user.id != interaction.user.id:
-                embed = discord.Embed(
-                    title="他の人は操作できません！", colour=discord.Colour.red()
-                )
-                await interaction.response.send_message(embed=embed, ephemeral=True)
-                return
+    @group.command(name="leaderboard", description="サーバー内のランキングを表示します。")
+    @app_commands.rename(song="曲名", difficulty="難易度")
+    @app_commands.describe(
+        song="ランキングを表示する曲名。省略するとレートのランキングを表示します。",
+        difficulty="ランキングを表示する難易度。",
+    )
+    @app_commands.choices(
+        difficulty=[
+            app_commands.Choice(name=name, value=name)
+            for name in ("BASIC", "ADVANCED", "EXPERT", "MASTER", "REMASTER")
+        ]
+    )
+    async def leaderboardCommand(
+        self,
+        interaction: discord.Interaction,
+        song: str | None = None,
+        difficulty: str = "MASTER",
+    ):
+        with tracing.span("discord.defer"):
             await interaction.response.defer()
-            leftButton.custom_id = str(int(leftButton.custom_id) - 1)
-            infoButton.label = f"{int(leftButton.custom_id) + 1 + 1} / {len(records)}"
-            rightButton.custom_id = str(int(rightButton.custom_id) - 1)
-
-            await panel(interaction)
-
-        async def right(interaction: discord.Interaction):
-            if _interaction.user.id != interaction.user.id:
-                embed = discord.Embed(
-                    title="他の人は操作できません！", colour=discord.Colour.red()
-                )
-                await interaction.response.send_message(embed=embed, ephemeral=True)
-                return
+        if interaction.guild_id is None:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description="このコマンドはサーバー内でのみ使用できます。",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            return
+        if song is None:
+            embed = await Leaderboards.stat(
+                interaction.guild_id, "maimai", "rating", "レート"
+            )
+        else:
+            embed = await Leaderboards.song(
+                interaction.guild_id, "maimai", song, difficulty
+            )
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embed=embed)
 
+    @group.command(name="song", description="曲の情報と自己ベストを確認します。")
+    @app_commands.rename(song="曲名")
+    @app_commands.describe(song="確認する曲名。")
+    async def songCommand(self, interaction: discord.Interaction, song: str):
+        with tracing.span("discord.defer"):
             await interaction.response.defer()
-            leftButton.custom_id = str(int(leftButton.custom_id) + 1)
-            infoButton.label = f"{int(leftButton.custom_id) + 1 + 1} / {len(records)}"
-            rightButton.custom_id = str(int(rightButton.custom_id) + 1)
-
-            await panel(interaction)
+        embed = await SongLookup.embed("maimai", interaction.user.id, song)
+        if embed is None:
+            embed = discord.Embed(
+                title="曲が見つかりませんでした。",
+                colour=discord.Colour.red(),
+            )
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embed=embed)
 
-        leftButton.callback = left
-        rightButton.callback = right
+    @songCommand.autocomplete("song")
+    @leaderboardCommand.autocomplete("song")
+    async def songAutocomplete(
+        self, interaction: discord.Interaction, current: str
+    ) -> list[app_commands.Choice[str]]:
+        return await SongLookup.choices("maimai", current)
 
-        view.add_item(leftButton)
-        view.add_item(infoButton)
-        view.add_item(rightButton)
+    @group.command(name="export", description="プレイ履歴をファイルに書き出します。")
+    @app_commands.rename(format="形式")
+    @app_commands.describe(format="書き出すファイルの形式。")
+    @app_commands.choices(
+        format=[
+            app_commands.Choice(name="CSV", value="csv"),
+            app_commands.Choice(name="JSON Lines", value="jsonl"),
+        ]
+    )
+    async def exportCommand(
+        self, interaction: discord.Interaction, format: str = "csv"
+    ):
+        with tracing.span("discord.defer"):
+            await interaction.response.defer(ephemeral=True)
+        row = await Database.fetchrow("aimeAccount", interaction.user.id)
+        if not row:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description="あなたはまだアカウントをリンクしていません！\n`/maimai link`コマンドを使用してアカウントをリンクしてください！",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            return
+        try:
+            await recordSync.ensureHistory("maimai", interaction.user.id, row)
+        except Exception as e:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description=f"{e}",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            raise e
 
-        await panel(_interaction, False)
+        RecordExports.start(interaction, "maimai", format)
+        embed = discord.Embed(
+            title="書き出しを開始しました。",
+            description="完了したらファイルを送信します。",
+            colour=discord.Colour.blurple(),
+        )
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embed=embed)
 
 
 async def setup(bot: commands.Bot):
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import os
+
+import discord
+import dotenv
+from discord import app_commands
+from discord.ext import commands
+
+from services import tracing
+from services.database import Database
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# (ゲーム, 表示名, Cogの名前, アカウントの種類)
+games = [
+    ("maimai", "maimai", "MaimaiCog", "aimeAccount"),
+    ("popn", "pop'n music", "POPNMusicCog", "konamiAccount"),
+    ("polaris", "ポラリスコード", "PolarisChordCog", "konamiAccount"),
+    ("nostalgia", "ノスタルジア", "NostalgiaCog", "konamiAccount"),
+]
+
+
+class OtogeCog(commands.Cog):
+    """全機種をまとめて扱うコマンドです。"""
+
+    # 最初の返信までに待つ時間と、ゲームごとに結果を待つ時間
+    firstReplySeconds: float = float(os.getenv("otoge_profile_first_reply", "3"))
+    deadlines: dict[str, float] = {
+        game: float(os.getenv(f"{game}_profile_deadline", "20")) for game, *_ in games
+    }
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+
+    group = app_commands.Group(name="otoge", description="全機種共通のコマンド。")
+
+    def profileEmbeds(self, tasks: dict[str, asyncio.Task]) -> list[discord.Embed]:
+        embeds = []
+        for game, label, *_ in games:
+            task = tasks.get(game)
+            if task is None:
+                continue
+            if not task.done():
+                embed = discord.Embed(
+                    description=f"{label}: 取得中です…",
+                    colour=discord.Colour.light_grey(),
+                )
+            elif task.cancelled() or isinstance(task.exception(), TimeoutError):
+                embed = discord.Embed(
+                    description=f"{label}: 時間内に取得できませんでした。",
+                    colour=discord.Colour.red(),
+                )
+            elif task.exception() is not None:
+                embed = discord.Embed(
+                    description=f"{label}: {task.exception()}",
+                    colour=discord.Colour.red(),
+                )
+            else:
+                embed = task.result()
+            embeds.append(embed)
+        return embeds
+
+    @group.command(name="profile", description="全機種のプロフィールをまとめて確認します。")
+    async def profileCommand(self, interaction: discord.Interaction):
+        with tracing.span("discord.defer"):
+            await interaction.response.defer()
+        aimeRow, konamiRow = await asyncio.gather(
+            Database.fetchrow("aimeAccount", interaction.user.id),
+            Database.fetchrow("konamiAccount", interaction.user.id),
+        )
+        rows = {"aimeAccount": aimeRow, "konamiAccount": konamiRow}
+
+        # 各ゲームは同時に取得し、それぞれの期限で打ち切る
+        tasks: dict[str, asyncio.Task] = {}
+        for game, _, cogName, account in games:
+            cog = self.bot.get_cog(cogName)
+            if cog is None or not rows[account]:
+                continue
+            tasks[game] = asyncio.create_task(
+                asyncio.wait_for(
+                    cog.profileEmbed(interaction.user.id, rows[account]),
+                    self.deadlines[game],
+                )
+            )
+        if not tasks:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description="あなたはまだアカウントをリンクしていません！\n`/maimai link`コマンドなどを使用してアカウントをリンクしてください！",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            return
+
+        _, pending = await asyncio.wait(tasks.values(), timeout=self.firstReplySeconds)
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embeds=self.profileEmbeds(tasks))
+        # 間に合わなかったゲームは、取得でき次第メッセージを書き換える
+        while pending:
+            _, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            with tracing.span("discord.edit"):
+                await interaction.edit_original_response(
+                    embeds=self.profileEmbeds(tasks)
+                )
+
+        for game, task in tasks.items():
+            if not task.cancelled() and task.exception() is not None:
+                logger.warning(
+                    "failed to fetch the %s profile of %s",
+                    game,
+                    interaction.user.id,
+                    exc_info=task.exception(),
+                )
+
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(OtogeCog(bot))
@@ -1,5 +1,6 @@
 import os
 
+import asyncpg
 import discord
 import dotenv
 import orjson
@@ -8,7 +9,16 @@ from discord import app_commands
 from discord.ext import commands
 from otoge import PolarisChordClient, PolarisChordPlayRecord, PolarisChordDifficultyType
 
+from services import konami, recordSync, tracing
 from services.database import Database
+from services.invalidation import Invalidation
+from services.renderer import Card
+from services.songCatalog import SongCatalog
+from views.leaderboard import Leaderboards
+from views.recordCard import RecordCards
+from views.recordExport import RecordExports
+from views.recordPaginator import RecordPaginator
+from views.songLookup import SongLookup
 
 dotenv.load_dotenv()
 
@@ -37,14 +47,8 @@ class KonamiCodeModal(discord.ui.Modal, title="KONAMI IDログイン"):
             )
             await interaction.followup.send(embed=embed, ephemeral=True)
             raise e
-        await Database.pool.execute(
-            """
-                INSERT INTO konami (id, cookies)
-                VALUES ($1, $2)
-                ON CONFLICT (id)
-                DO UPDATE SET
-                    cookies = EXCLUDED.cookies
-            """,
+        await Database.execute(
+            "saveKonamiAccount",
             interaction.user.id,
             cipherSuite.encrypt(
                 orjson.dumps(
@@ -55,6 +59,7 @@ class KonamiCodeModal(discord.ui.Modal, title="KONAMI IDログイン"):
                 )
             ).decode(),
         )
+        await Invalidation.publish(interaction.user.id, "popn")
         embed = discord.Embed(
             title="ログインしました。",
             colour=discord.Colour.green(),
@@ -67,6 +72,8 @@ class PolarisChordCog(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        RecordPaginator.renderers["polaris"] = self.recordEmbeds
+        RecordCards.builders["polaris"] = self.recordCard
 
     group = app_commands.Group(
         name="polaris", description="ポラリスコード関連のコマンド。"
@@ -110,12 +117,26 @@ class PolarisChordCog(commands.Cog):
         view.add_item(button)
         await interaction.followup.send(embed=embed, view=view)
 
+    async def profileEmbed(self, userId: int, row: asyncpg.Record) -> discord.Embed:
+        """プロフィールを取得して埋め込みにします。/otoge profileからも使われます。"""
+        profile = await konami.fetchProfile(PolarisChordClient, userId, row)
+        return (
+            discord.Embed(
+                description=f"ソロプレー数: `{profile.soloPlayCount}`\nローカルマッチングプレー数: `{profile.localMatchingPlayCount}`\nグローバルマッチングプレイ数: `{profile.globalMatchingPlayCount}`\nPA CLASS: `{profile.paClass}` / PA SKILL: `{profile.paSkill}`",
+                timestamp=profile.lastPlayDate,
+                colour=discord.Colour.pink(),
+            )
+            .set_author(
+                name=profile.name,
+            )
+            .set_footer(text="ポラリスコード ･ 最終プレイ日時")
+        )
+
     @group.command(name="profile", description="プロフィールを確認します。")
     async def profileCommand(self, interaction: discord.Interaction):
-        await interaction.response.defer()
-        row = await Database.pool.fetchrow(
-            "SELECT * FROM konami WHERE id = $1", interaction.user.id
-        )
+        with tracing.span("discord.defer"):
+            await interaction.response.defer()
+        row = await Database.fetchrow("konamiAccount", interaction.user.id)
         if not row:
             embed = discord.Embed(
                 title="エラーが発生しました！",
@@ -124,12 +145,8 @@ class PolarisChordCog(commands.Cog):
             )
             await interaction.followup.send(embed=embed)
             return
-        client = PolarisChordClient(skipKonami=True)
         try:
-            client.loginWithCookie(
-                orjson.loads(cipherSuite.decrypt(row["cookies"].encode()).decode())
-            )
-            profile = await client.fetchProfile()
+            embed = await self.profileEmbed(interaction.user.id, row)
         except Exception as e:
             embed = discord.Embed(
                 title="エラーが発生しました！",
@@ -139,18 +156,8 @@ class PolarisChordCog(commands.Cog):
             await interaction.followup.send(embed=embed)
             raise e
 
-        embed = (
-            discord.Embed(
-                description=f"ソロプレー数: `{profile.soloPlayCount}`\nローカルマッチングプレー数: `{profile.localMatchingPlayCount}`\nグローバルマッチングプレイ数: `{profile.globalMatchingPlayCount}`\nPA CLASS: `{profile.paClass}` / PA SKILL: `{profile.paSkill}`",
-                timestamp=profile.lastPlayDate,
-                colour=discord.Colour.pink(),
-            )
-            .set_author(
-                name=profile.name,
-            )
-            .set_footer(text="ポラリスコード ･ 最終プレイ日時")
-        )
-        await interaction.followup.send(embed=embed)
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embed=embed)
 
     def switchColor(self, type: PolarisChordDifficultyType):
         match type:
@@ -163,115 +170,212 @@ class PolarisChordCog(commands.Cog):
             case _:
                 return discord.Colour.pink()
 
-    @group.command(name="record", description="プレイ履歴を確認します。")
-    async def recordCommand(self, _interaction: discord.Interaction):
-        await _interaction.response.defer()
-        row = await Database.pool.fetchrow(
-            "SELECT * FROM konami WHERE id = $1", _interaction.user.id
+    def recordEmbeds(
+        self, userId: int, player: asyncpg.Record, record: PolarisChordPlayRecord
+    ) -> list[discord.Embed]:
+        embed = (
+            discord.Embed(
+                title=f"{record.name} [{record.chartDifficultyType.name}]",
+                description=f"{record.achievementRate}%\nCLEAR STATUS: `{record.clearStatus.name}`",
+                colour=self.switchColor(record.chartDifficultyType),
+                timestamp=record.playedAt,
+            )
+            .set_author(
+                name=player["name"],
+            )
+            .set_footer(text=record.license)
+            .set_thumbnail(
+                url=f"https://beats-api.nennneko5787.net/imageProxy?url={SongCatalog.jacketUrl('polaris', str(record.musicId))}&w=160&format=webp"
+            )
         )
+        embed2 = discord.Embed(
+            description=f"Perfect: `{record.judges.perfect}`\nGreat: `{record.judges.great}`\nGood: `{record.judges.good}`\nBad: `{record.judges.bad}`\nMiss: `{record.judges.miss}`\nFast: `{record.judges.fast}` / Slow: `{record.judges.slow}`",
+            colour=self.switchColor(record.chartDifficultyType),
+        ).set_footer(text=f"{record.chartDifficultyType.name} {record.difficult}")
+
+        return [embed, embed2]
+
+    def recordCard(self, record: PolarisChordPlayRecord) -> Card:
+        return Card(
+            title=record.name,
+            lines=[
+                f"{record.achievementRate}%",
+                f"{record.chartDifficultyType.name} {record.difficult}",
+            ],
+            colour=self.switchColor(record.chartDifficultyType).value,
+            jacketUrl=SongCatalog.jacketUrl("polaris", str(record.musicId)),
+            badges=[record.clearStatus.name],
+        )
+
+    @group.command(name="record", description="プレイ履歴を確認します。")
+    async def recordCommand(self, interaction: discord.Interaction):
+        with tracing.span("discord.defer"):
+            await interaction.response.defer()
+        row = await Database.fetchrow("konamiAccount", interaction.user.id)
         if not row:
             embed = discord.Embed(
                 title="エラーが発生しました！",
                 description="あなたはまだアカウントをリンクしていません！\n`/maimai link`コマンドを使用してアカウントをリンクしてください！",
                 colour=discord.Colour.red(),
             )
-            await _interaction.followup.send(embed=embed)
+            await interaction.followup.send(embed=embed)
             return
-        client = PolarisChordClient(skipKonami=True)
         try:
-            client.loginWithCookie(
-                orjson.loads(cipherSuite.decrypt(row["cookies"].encode()).decode())
-            )
-            profile = await client.fetchProfile()
-            records = await client.fetchPlayRecords()
+            await recordSync.ensureHistory("polaris", interaction.user.id, row)
         except Exception as e:
             embed = discord.Embed(
                 title="エラーが発生しました！",
                 description=f"{e}",
                 colour=discord.Colour.red(),
             )
-            await _interaction.followup.send(embed=embed)
+            await interaction.followup.send(embed=embed)
             raise e
 
-        view = discord.ui.View(timeout=None)
-
-        leftButton = discord.ui.Button(
-            emoji="⏪", style=discord.ButtonStyle.blurple, custom_id="-1", disabled=True
-        )
-        infoButton = discord.ui.Button(label=f"1 / {len(records)}", disabled=True)
-        rightButton = discord.ui.Button(
-            emoji="⏩", style=discord.ButtonStyle.blurple, custom_id="1", disabled=False
-        )
-
-        async def panel(interaction: discord.Interaction, edit: bool = True):
-            leftButton.disabled = int(leftButton.custom_id) + 1 + 1 <= 1
-            rightButton.disabled = int(rightButton.custom_id) >= len(records)
-
-            record: PolarisChordPlayRecord = records[int(leftButton.custom_id) + 1]
-            embed = (
-                discord.Embed(
-                    title=f"{record.name} [{record.chartDifficultyType.name}]",
-                    description=f"{record.achievementRate}%\nCLEAR STATUS: `{record.clearStatus.name}`",
-                    colour=self.switchColor(record.chartDifficultyType),
-                    timestamp=record.playedAt,
-                )
-                .set_author(
-                    name=profile.name,
-                )
-                .set_footer(text=record.license)
-                .set_thumbnail(
-                    url=f"https://beats-api.nennneko5787.net/imageProxy?url=https://p.eagate.573.jp/game/polarischord/pc/img/music/jacket.html?c={record.musicId}"
-                )
+        if not await RecordPaginator.send(interaction, "polaris"):
+            embed = discord.Embed(
+                title="プレイ履歴がありません。",
+                colour=discord.Colour.red(),
             )
-            embed2 = discord.Embed(
-                description=f"Perfect: `{record.judges.perfect}`\nGreat: `{record.judges.great}`\nGood: `{record.judges.good}`\nBad: `{record.judges.bad}`\nMiss: `{record.judges.miss}`\nFast: `{record.judges.fast}` / Slow: `{record.judges.slow}`",
-                colour=self.switchColor(record.chartDifficultyType),
-            ).set_footer(text=f"{record.chartDifficultyType.name} {record.difficult}")
-
-            if edit:
-                await interaction.edit_original_response(
-                    embeds=[embed, embed2], view=view
-                )
-            else:
-                await interaction.followup.send(embeds=[embed, embed2], view=view)
+            await interaction.followup.send(embed=embed)
 
-        async def left(interaction: discord.Interaction):
-            if _interaction.user.id != interaction.user.id:
-                embed = discord.Embed(
-                    title="他の人は操作できません！", colour=discord.Colour.red()
-                )
-                await interaction.response.send_message(embed=embed, ephemeral=True)
-                return
+    @group.command(name="card", description="プレイ履歴を画像で確認します。")
+    @app_commands.rename(page="ページ")
+    @app_commands.describe(page="表示するページ。1ページに20件まで表示します。")
+    async def cardCommand(
+        self, interaction: discord.Interaction, page: app_commands.Range[int, 1] = 1
+    ):
+        with tracing.span("discord.defer"):
             await interaction.response.defer()
-            leftButton.custom_id = str(int(leftButton.custom_id) - 1)
-            infoButton.label = f"{int(leftButton.custom_id) + 1 + 1} / {len(records)}"
-            rightButton.custom_id = str(int(rightButton.custom_id) - 1)
-
-            await panel(interaction)
+        row = await Database.fetchrow("konamiAccount", interaction.user.id)
+        if not row:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description="あなたはまだアカウントをリンクしていません！\n`/maimai link`コマンドを使用してアカウントをリンクしてください！",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            return
+        try:
+            await recordSync.ensureHistory("polaris", interaction.user.id, row)
+        except Exception as e:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description=f"{e}",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            raise e
 
-        async def right(interaction: discord.Interaction):
-            if _interaction.user.id != interaction.user.id:
-                embed = discord.Embed(
-                    title="他の人は操作できません！", colour=discord.Colour.red()
-                )
-                await interaction.response.send_message(embed=embed, ephemeral=True)
-                return
+        if not await RecordCards.send(interaction, "polaris", page - 1):
+            embed = discord.Embed(
+                title="プレイ履歴がありません。",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
 
+    @group.command(name="leaderboard", description="サーバー内のランキングを表示します。")
+    @app_commands.rename(song="曲名", difficulty="難易度")
+    @app_commands.describe(
+        song="ランキングを表示する曲名。省略するとPA SKILLのランキングを表示します。",
+        difficulty="ランキングを表示する難易度。",
+    )
+    @app_commands.choices(
+        difficulty=[
+            app_commands.Choice(name=name, value=name)
+            for name in PolarisChordDifficultyType.__members__
+        ]
+    )
+    async def leaderboardCommand(
+        self,
+        interaction: discord.Interaction,
+        song: str | None = None,
+        difficulty: str = "HARD",
+    ):
+        with tracing.span("discord.defer"):
             await interaction.response.defer()
-            leftButton.custom_id = str(int(leftButton.custom_id) + 1)
-            infoButton.label = f"{int(leftButton.custom_id) + 1 + 1} / {len(records)}"
-            rightButton.custom_id = str(int(rightButton.custom_id) + 1)
-
-            await panel(interaction)
+        if interaction.guild_id is None:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description="このコマンドはサーバー内でのみ使用できます。",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            return
+        if song is None:
+            embed = await Leaderboards.stat(
+                interaction.guild_id, "polaris", "paskill", "PA SKILL"
+            )
+        else:
+            embed = await Leaderboards.song(
+                interaction.guild_id, "polaris", song, difficulty
+            )
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embed=embed)
 
-        leftButton.callback = left
-        rightButton.callback = right
+    @group.command(name="song", description="曲の情報と自己ベストを確認します。")
+    @app_commands.rename(song="曲名")
+    @app_commands.describe(song="確認する曲名。")
+    async def songCommand(self, interaction: discord.Interaction, song: str):
+        with tracing.span("discord.defer"):
+            await interaction.response.defer()
+        embed = await SongLookup.embed("polaris", interaction.user.id, song)
+        if embed is None:
+            embed = discord.Embed(
+                title="曲が見つかりませんでした。",
+                colour=discord.Colour.red(),
+            )
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embed=embed)
 
-        view.add_item(leftButton)
-        view.add_item(infoButton)
-        view.add_item(rightButton)
+    @songCommand.autocomplete("song")
+    @leaderboardCommand.autocomplete("song")
+    async def songAutocomplete(
+        self, interaction: discord.Interaction, current: str
+    ) -> list[app_commands.Choice[str]]:
+        return await SongLookup.choices("polaris", current)
+
+    @group.command(name="export", description="プレイ履歴をファイルに書き出します。")
+    @app_commands.rename(format="形式")
+    @app_commands.describe(format="書き出すファイルの形式。")
+    @app_commands.choices(
+        format=[
+            app_commands.Choice(name="CSV", value="csv"),
+            app_commands.Choice(name="JSON Lines", value="jsonl"),
+        ]
+    )
+    async def exportCommand(
+        self, interaction: discord.Interaction, format: str = "csv"
+    ):
+        with tracing.span("discord.defer"):
+            await interaction.response.defer(ephemeral=True)
+        row = await Database.fetchrow("konamiAccount", interaction.user.id)
+        if not row:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description="あなたはまだアカウントをリンクしていません！\n`/maimai link`コマンドを使用してアカウントをリンクしてください！",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            return
+        try:
+            await recordSync.ensureHistory("polaris", interaction.user.id, row)
+        except Exception as e:
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description=f"{e}",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed)
+            raise e
 
-        await panel(_interaction, False)
+        RecordExports.start(interaction, "polaris", format)
+        embed = discord.Embed(
+            title="書き出しを開始しました。",
+            description="完了したらファイルを送信します。",
+            colour=discord.Colour.blurple(),
+        )
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embed=embed)
 
 
 async def setup(bot: commands.Bot):
@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import os
+
+import asyncpg
+import dotenv
+from discord.ext import commands, tasks
+
+from services import recordSync
+from services.database import Database
+from services.scheduler import Priority, currentPriority
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class RecordSyncCog(commands.Cog):
+    """リンクされているアカウントのプレイ履歴を定期的にPostgresへ取り込みます。"""
+
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.semaphore = asyncio.Semaphore(
+            int(os.getenv("record_sync_concurrency", "4"))
+        )
+        self.syncLoop.change_interval(
+            minutes=float(os.getenv("record_sync_interval_minutes", "15"))
+        )
+        # 続けて失敗したゲーム (遊んでいない機種など) は、しばらく取り込みを飛ばす
+        self.maxFailures = int(os.getenv("record_sync_max_failures", "3"))
+        self.retryLoops = int(os.getenv("record_sync_retry_loops", "96"))
+        self.failures: dict[tuple[str, int, str | None], int] = {}
+
+    async def cog_load(self):
+        self.syncLoop.start()
+
+    async def cog_unload(self):
+        self.syncLoop.cancel()
+
+    def skipped(self, key: tuple[str, int, str | None]) -> bool:
+        failures = self.failures.get(key, 0)
+        if failures < self.maxFailures:
+            return False
+        return self.syncLoop.current_loop % self.retryLoops != 0
+
+    async def syncOne(self, game: str, row: asyncpg.Record):
+        # リンクし直すとCookieの暗号文が変わるので、失敗の回数も数え直しになる
+        key = (game, row["id"], row.get("cookies"))
+        if self.skipped(key):
+            return
+        async with self.semaphore:
+            try:
+                await recordSync.sync(game, row["id"], row)
+            except Exception:
+                failures = self.failures.get(key, 0) + 1
+                self.failures[key] = failures
+                if failures > self.maxFailures:
+                    logger.debug(
+                        "failed to sync %s records of %s again", game, row["id"]
+                    )
+                    return
+                logger.warning(
+                    "failed to sync %s records of %s", game, row["id"], exc_info=True
+                )
+                if failures == self.maxFailures:
+                    logger.info(
+                        "skipping %s records of %s after %s failures",
+                        game,
+                        row["id"],
+                        failures,
+                    )
+            else:
+                self.failures.pop(key, None)
+
+    @tasks.loop(minutes=15)
+    async def syncLoop(self):
+        # 取り込みはスラッシュコマンドより後回しにする
+        currentPriority.set(Priority.BACKGROUND)
+        aimeRows = await Database.fetch("aimeAccounts")
+        konamiRows = await Database.fetch("konamiAccounts")
+        await asyncio.gather(
+            *[self.syncOne("maimai", row) for row in aimeRows],
+            *[
+                self.syncOne(game, row)
+                for game in recordSync.konamiGames
+                for row in konamiRows
+            ],
+        )
+
+    @syncLoop.before_loop
+    async def beforeSyncLoop(self):
+        await self.bot.wait_until_ready()
+
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(RecordSyncCog(bot))
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import os
+import sys
+
+import discord
+import dotenv
+from httpx import AsyncClient
+
+dotenv.load_dotenv()
+
+discord.utils.setup_logging()
+
+logger = logging.getLogger(__name__)
+
+
+async def recommendedShardCount() -> int:
+    async with AsyncClient() as http:
+        response = await http.get(
+            "https://discord.com/api/v10/gateway/bot",
+            headers={"Authorization": f"Bot {os.getenv('discord')}"},
+        )
+        response.raise_for_status()
+        return response.json()["shards"]
+
+
+def splitShards(shardCount: int, clusterCount: int) -> list[list[int]]:
+    """シャードを連続した範囲に分けて、クラスターにできるだけ均等に割り振ります。"""
+    clusterCount = min(clusterCount, shardCount)
+    clusters = []
+    start = 0
+    for cluster in range(clusterCount):
+        size = shardCount // clusterCount + (cluster < shardCount % clusterCount)
+        clusters.append(list(range(start, start + size)))
+        start += size
+    return clusters
+
+
+async def runCluster(clusterId: int, shardCount: int, shardIds: list[int]):
+    """クラスターを一つのプロセスとして起動し、落ちたら起動し直します。"""
+    env = {
+        **os.environ,
+        "cluster_id": str(clusterId),
+        "shard_count": str(shardCount),
+        "shard_ids": ",".join(map(str, shardIds)),
+    }
+    while True:
+        logger.info("starting cluster %s with shards %s", clusterId, shardIds)
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "bot.py", env=env
+        )
+        returnCode = await process.wait()
+        logger.warning("cluster %s exited with %s", clusterId, returnCode)
+        await asyncio.sleep(5)
+
+
+async def main():
+    """シャードを複数のプロセス (クラスター) に分けてボットを起動します。
+    shard_countを省略するとDiscordの推奨値を使い、clustersでプロセス数を指定します。
+    """
+    shardCount = int(os.getenv("shard_count") or await recommendedShardCount())
+    clusterCount = int(os.getenv("clusters", str(os.cpu_count() or 1)))
+    await asyncio.gather(
+        *[
+            runCluster(clusterId, shardCount, shardIds)
+            for clusterId, shardIds in enumerate(splitShards(shardCount, clusterCount))
+        ]
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
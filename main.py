@@ -2,53 +2,63 @@ import asyncio
 import os
 from contextlib import asynccontextmanager
 
-import discord
 import dotenv
-from discord.ext import commands, tasks
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
 
-from routes import userIcon, imageProxy
+from bot import bot
+from routes import userIcon, imageProxy, prometheus, stats
+from services import metrics, tracing
 from services.database import Database
+from services.http import HTTPClientPool
+from services.imageCache import ImageCache
+from services.imageTransform import ImageTransformer
+from services.invalidation import Invalidation
+from services.records import PlayRecords
+from services.renderer import Renderer
 
 dotenv.load_dotenv()
 
-discord.utils.setup_logging()
-
-bot = commands.Bot("otogebot#", intents=discord.Intents.default())
-
-
-@tasks.loop(seconds=20)
-async def precenseLoop():
-    appInfo = await bot.application_info()
-    game = discord.Game(
-        f"/help | {len(bot.guilds)} servers | {appInfo.approximate_user_install_count} users"
-    )
-    await bot.change_presence(status=discord.Status.online, activity=game)
-
-
-@bot.event
-async def on_ready():
-    precenseLoop.start()
-
-
-@bot.event
-async def setup_hook():
-    await bot.load_extension("cogs.maimai")
-    await bot.load_extension("cogs.popn")
-    await bot.load_extension("cogs.polaris")
-    await bot.load_extension("cogs.nostalgia")
-    await bot.tree.sync()
+# all: APIとボットを同じプロセスで動かす
+# api: APIだけを動かす。ボットは別にpython bot.pyで一つだけ起動する
+role = os.getenv("role", "all")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await Database.connect()
-    asyncio.create_task(bot.start(os.getenv("discord")))
+    await Invalidation.listen()
+    HTTPClientPool.open()
+    ImageCache.open()
+    ImageTransformer.open()
+    asyncio.create_task(metrics.monitorEventLoopLag())
+    asyncio.create_task(metrics.monitorPool(Database.pool))
+    if ImageCache.enabled():
+        asyncio.create_task(ImageCache.rescan())
+    if role == "all":
+        await PlayRecords.createTables()
+        Renderer.open()
+        asyncio.create_task(bot.start(os.getenv("discord")))
     yield
     async with asyncio.timeout(60):
+        if role == "all":
+            await bot.close()
+            Renderer.close()
+        await Invalidation.close()
         await Database.pool.close()
+        await HTTPClientPool.close()
+        ImageTransformer.close()
 
 
 app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def traceRequest(request: Request, call_next):
+    with tracing.span(f"http {request.method}", path=request.url.path):
+        return await call_next(request)
+
+
 app.include_router(userIcon.router)
 app.include_router(imageProxy.router)
+app.include_router(stats.router)
+app.include_router(prometheus.router)
@@ -1,13 +1,223 @@
-from fastapi import APIRouter
-from fastapi.responses import StreamingResponse
-from httpx import AsyncClient
+import asyncio
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import AsyncIterator, BinaryIO
+
+import httpx
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import Response, StreamingResponse
+
+from services.http import HTTPClientPool
+from services.imageCache import CacheEntry, ImageCache
+from services.imageTransform import ImageTransformer
 
 router = APIRouter()
 
+# ジャケット画像などは変わらないので、Discord側にも長くキャッシュさせる
+cacheHeaders = {
+    "Cache-Control": "public, max-age=604800, immutable",
+    "X-Content-Type-Options": "nosniff",
+}
+
+# キャッシュせずに中継する場合に、上流とやり取りするヘッダー
+forwardedRequestHeaders = ("range", "if-range", "if-none-match", "if-modified-since")
+forwardedResponseHeaders = (
+    "content-length",
+    "content-range",
+    "accept-ranges",
+    "etag",
+    "last-modified",
+)
+
+# キャッシュしたファイルを送るときに、一度に読む大きさ
+fileChunkBytes = 64 * 1024
+
+
+def validators(entry: CacheEntry) -> dict[str, str]:
+    return {
+        "ETag": f'"{entry.path.stem}-{entry.size}"',
+        "Last-Modified": formatdate(entry.modifiedAt, usegmt=True),
+    }
+
+
+def notModified(request: Request, headers: dict[str, str], entry: CacheEntry) -> bool:
+    ifNoneMatch = request.headers.get("if-none-match")
+    if ifNoneMatch is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in ifNoneMatch.split(",")]
+        return "*" in tags or headers["ETag"] in tags
+    ifModifiedSince = request.headers.get("if-modified-since")
+    if ifModifiedSince is not None:
+        try:
+            since = parsedate_to_datetime(ifModifiedSince).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(entry.modifiedAt) <= since
+    return False
+
+
+def byteRange(request: Request, etag: str, size: int) -> tuple[int, int] | None:
+    """単一のRangeだけを扱います。複数の範囲や解釈できない指定は全体を返します。"""
+    header = request.headers.get("range")
+    if header is None or request.headers.get("if-range", etag) != etag:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    try:
+        if start == "":
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(416, headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+async def relay(response: httpx.Response) -> AsyncIterator[bytes]:
+    """上流の本文をそのまま流します。
+    途中で上限を超えたり切断されたりするとBackgroundTaskは実行されないので、
+    ここで必ず上流の接続を返します。
+    """
+    try:
+        async for chunk in ImageCache.body(response):
+            yield chunk
+    finally:
+        await response.aclose()
+
+
+async def cachedImage(
+    url: str, width: int | None, format: str | None
+) -> tuple[CacheEntry, bytes | None, BinaryIO | None]:
+    """キャッシュした画像を、メモリ上の中身か開いたファイルとして返します。
+    ファイルは開いてから返すので、送っている間に別のワーカーが削除しても読み続けられます。
+    開く前に削除されていた場合は、一度だけ取得し直します。
+    """
+    for attempt in range(2):
+        if width is None and format is None:
+            entry, data = await ImageCache.fetch(url)
+        else:
+            entry, data = await ImageCache.variant(url, width, format)
+        if data is not None:
+            return entry, data, None
+        try:
+            return entry, None, await asyncio.to_thread(entry.path.open, "rb")
+        except FileNotFoundError:
+            if attempt:
+                raise
+            ImageCache.forget(entry)
+
+
+async def readFile(file: BinaryIO, start: int, end: int) -> AsyncIterator[bytes]:
+    """開いたファイルのstartからendまでを少しずつ流し、最後に閉じます。"""
+    try:
+        await asyncio.to_thread(file.seek, start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await asyncio.to_thread(file.read, min(fileChunkBytes, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        await asyncio.to_thread(file.close)
+
+
+def sendFile(
+    request: Request, entry: CacheEntry, file: BinaryIO, headers: dict[str, str]
+) -> StreamingResponse:
+    try:
+        size = os.fstat(file.fileno()).st_size
+        selected = byteRange(request, headers["ETag"], size)
+    except BaseException:
+        file.close()
+        raise
+    start, end = selected or (0, size - 1)
+    headers["Content-Length"] = str(end - start + 1)
+    if selected is not None:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(
+        readFile(file, start, end),
+        status_code=206 if selected is not None else 200,
+        media_type=entry.contentType,
+        headers=headers,
+    )
+
+
+async def passthrough(request: Request, url: str) -> StreamingResponse:
+    """キャッシュが無効な場合に、上流の本文を読みながらそのまま流します。"""
+    response = await HTTPClientPool.stream(
+        url,
+        headers={
+            name: request.headers[name]
+            for name in forwardedRequestHeaders
+            if name in request.headers
+        },
+    )
+    if response.status_code not in (200, 206, 304):
+        await response.aclose()
+        raise HTTPException(502)
+    # 送り始めてからでは502を返せないので、分かる場合は先に大きさを確かめる
+    length = response.headers.get("content-length", "")
+    if length.isdigit() and int(length) > ImageCache.maxObjectBytes:
+        await response.aclose()
+        raise HTTPException(502, "Upstream image is too large")
+    try:
+        contentType = ImageCache.contentTypeOf(response)
+    except HTTPException:
+        await response.aclose()
+        raise
+    return StreamingResponse(
+        relay(response),
+        status_code=response.status_code,
+        media_type=contentType,
+        headers=cacheHeaders
+        | {
+            name: response.headers[name]
+            for name in forwardedResponseHeaders
+            if name in response.headers
+        },
+    )
+
 
 @router.get("/imageProxy")
-async def imageProxy(url: str):
-    """単に画像をプロキシします。"""
-    http = AsyncClient(verify=False)
-    response = await http.get(url)
-    return StreamingResponse(response.aiter_bytes(), media_type="image/png")
+async def imageProxy(
+    request: Request,
+    url: str,
+    w: int | None = Query(None, ge=16, le=2048),
+    format: str | None = None,
+):
+    """画像をプロキシします。
+    取得した画像はディスクにキャッシュされます。
+    wを指定すると幅wまで縮小し、formatを指定するとその形式 (webp・avifなど) に変換します。
+    """
+    # このPillowで書き出せない形式は、元の形式のまま返す
+    if format not in ImageTransformer.formats:
+        format = None
+    # 縮小・変換はキャッシュしたファイルから行うので、キャッシュが無効なら元画像を返す
+    if not ImageCache.enabled():
+        return await passthrough(request, url)
+    entry, data, file = await cachedImage(url, w, format)
+
+    headers = cacheHeaders | validators(entry)
+    if notModified(request, headers, entry):
+        if file is not None:
+            file.close()
+        return Response(status_code=304, headers=headers)
+    headers["Accept-Ranges"] = "bytes"
+    if file is not None:
+        return sendFile(request, entry, file, headers)
+
+    selected = byteRange(request, headers["ETag"], len(data))
+    if selected is None:
+        return Response(data, media_type=entry.contentType, headers=headers)
+    start, end = selected
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+    return Response(
+        data[start : end + 1],
+        status_code=206,
+        media_type=entry.contentType,
+        headers=headers,
+    )
@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+from fastapi.responses import Response
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from services import metrics
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def prometheusMetrics():
+    """Prometheus形式でメトリクスを返します。"""
+    return Response(metrics.render(), media_type=CONTENT_TYPE_LATEST)
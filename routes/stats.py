@@ -0,0 +1,35 @@
+from fastapi import APIRouter
+
+from services.database import Database
+from services.http import HTTPClientPool
+from services.scheduler import Scheduler
+
+router = APIRouter()
+
+
+@router.get("/stats/http")
+async def httpStats():
+    """上流ホストごとのHTTPコネクションプールの使用状況を返します。"""
+    return HTTPClientPool.stats()
+
+
+@router.get("/stats/upstream")
+async def upstreamStats():
+    """上流ごとの待ち行列の長さと待ち時間を返します。"""
+    return Scheduler.stats()
+
+
+@router.get("/stats/database")
+async def databaseStats():
+    """名前付きクエリごとの実行回数と所要時間を返します。"""
+    return {
+        "preparedStatements": Database.preparedStatements,
+        "queries": {
+            name: {
+                "count": stats.count,
+                "averageSeconds": stats.totalSeconds / stats.count,
+                "maxSeconds": stats.maxSeconds,
+            }
+            for name, stats in Database.stats.items()
+        },
+    }
@@ -1,60 +1,76 @@
-import os
-
-import dotenv
-import orjson
-from cryptography.fernet import Fernet
 from fastapi import APIRouter, HTTPException
-from fastapi.responses import StreamingResponse
-from httpx import AsyncClient
-from otoge import MaiMaiAime, MaiMaiClient, POPNClient
+from fastapi.responses import Response
+from otoge import POPNClient
 from typing import Literal
 
+from services import konami
 from services.database import Database
+from services.http import HTTPClientPool, cookieHeader
+from services.iconCache import IconCache
+from services.scheduler import Scheduler
+from services.segaSession import (
+    SegaSession,
+    SegaSessions,
+    SessionRejected,
+    rejectedResponse,
+)
 
 router = APIRouter()
 
-dotenv.load_dotenv()
 
-cipherSuite = Fernet(os.getenv("fernet_key").encode())
+async def fetchMaimaiIcon(userId: int) -> tuple[bytes, str]:
+    row = await Database.fetchrow("aimeAccount", userId)
+    if not row:
+        raise HTTPException(404)
+
+    async def download(session: SegaSession) -> tuple[bytes, str]:
+        async with Scheduler.slot("sega"):
+            response = await HTTPClientPool.get(
+                session.aime.iconUrl,
+                headers=cookieHeader(
+                    session.client.http.cookies, session.aime.iconUrl
+                ),
+            )
+        # 拒否されたセッションは、SegaSessions.runでログインし直して再試行される
+        if rejectedResponse(response):
+            raise SessionRejected()
+        if response.status_code != 200:
+            raise HTTPException(502)
+        return response.content, response.headers.get("content-type", "image/png")
+
+    return await SegaSessions.run(userId, row, download)
+
+
+async def fetchPopnBanner(userId: int) -> tuple[bytes, str]:
+    row = await Database.fetchrow("konamiAccount", userId)
+    if not row:
+        raise HTTPException(404)
+    profile = await konami.fetchProfile(POPNClient, userId, row)
+    cookies = konami.createClient(POPNClient, row).http.cookies
+
+    async with Scheduler.slot("eagate"):
+        response = await HTTPClientPool.get(
+            profile.bannerUrl, headers=cookieHeader(cookies, profile.bannerUrl)
+        )
+    if response.status_code != 200:
+        raise HTTPException(502)
+    return response.content, response.headers.get("content-type", "image/png")
 
 
 @router.get("/icon/{userId:int}/{game:str}")
 async def fetchUserIcon(userId: int, game: Literal["maimai", "popn"]):
     """ユーザーのアイコンを取得します。
-    なお、アイコンはキャッシュしておくことを推奨します。
+    アイコンはキャッシュされ、期限が切れると裏で取得し直されます。
     """
     match game:
         case "maimai":
-            row = await Database.pool.fetchrow(
-                "SELECT * FROM aime WHERE id = $1", userId
-            )
-            if not row:
-                raise HTTPException(404)
-            client = MaiMaiClient()
-            aimeList = await client.login(
-                cipherSuite.decrypt(row["segaid"].encode()).decode(),
-                cipherSuite.decrypt(row["password"].encode()).decode(),
-            )
-            aime: MaiMaiAime = aimeList[row["aime"]]
-            await aime.select()
-
-            http = AsyncClient(cookies=client.http.cookies, verify=False)
-            response = await http.get(aime.iconUrl)
-            return StreamingResponse(response.aiter_bytes(), media_type="image/png")
+            entry = await IconCache.get(userId, game, lambda: fetchMaimaiIcon(userId))
         case "popn":
-            row = await Database.pool.fetchrow(
-                "SELECT * FROM konami WHERE id = $1", userId
-            )
-            if not row:
-                raise HTTPException(404)
-            client = POPNClient(skipKonami=True)
-            client.loginWithCookie(
-                orjson.loads(cipherSuite.decrypt(row["cookies"].encode()).decode())
-            )
-            profile = await client.fetchProfile()
-
-            http = AsyncClient(cookies=client.http.cookies, verify=False)
-            response = await http.get(profile.bannerUrl)
-            return StreamingResponse(response.aiter_bytes(), media_type="image/png")
+            entry = await IconCache.get(userId, game, lambda: fetchPopnBanner(userId))
         case _:
             raise HTTPException(404)
+    return Response(
+        entry.data,
+        media_type=entry.contentType,
+        headers={"Cache-Control": f"public, max-age={int(IconCache.ttl)}"},
+    )
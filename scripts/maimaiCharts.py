@@ -0,0 +1,93 @@
+"""maimaiのレート計算に使う譜面定数表 (data/maimaiCharts.json) を作ります。
+
+    python -m scripts.maimaiCharts --new-version 25000
+    python -m scripts.maimaiCharts --source music-ex.json --new-version 25000
+
+元データはotoge-db (https://github.com/zvuc/otoge-db) がまとめている
+maimai/data/music-ex.json で、曲ごとに譜面定数 (lev_*_i) と収録バージョンを持っています。
+新曲枠の対象は、収録バージョンが --new-version 以上の曲です。
+バージョンが上がって定数が変わったら、作り直してボットを再起動してください。
+"""
+
+import argparse
+from pathlib import Path
+from typing import Any
+
+import httpx
+import orjson
+
+defaultSource = (
+    "https://raw.githubusercontent.com/zvuc/otoge-db/master/maimai/data/music-ex.json"
+)
+
+# otoge-dbの項目と、プレイ履歴の難易度の表記
+difficulties = {
+    "bas": "BASIC",
+    "adv": "ADVANCED",
+    "exp": "EXPERT",
+    "mas": "MASTER",
+    "remas": "REMASTER",
+}
+
+
+def constantOf(song: dict[str, Any], prefix: str, difficulty: str) -> float | None:
+    try:
+        return float(song.get(f"{prefix}lev_{difficulty}_i") or "")
+    except ValueError:
+        return None
+
+
+def build(songs: list[dict[str, Any]], newVersion: int) -> list[dict[str, Any]]:
+    """曲ごとの元データを、ChartTableが読む {"name", "difficult", "constant", "isNew"}
+    の配列にします。
+    プレイ履歴は曲名と難易度しか持たず、スタンダード譜面とでらっくす譜面を区別できないので、
+    両方ある場合はでらっくす譜面の定数を使います。
+    """
+    charts = {}
+    for song in songs:
+        name = song.get("title")
+        if not name:
+            continue
+        try:
+            isNew = int(song.get("version") or 0) >= newVersion
+        except ValueError:
+            isNew = False
+        for difficulty, difficult in difficulties.items():
+            constant = constantOf(song, "dx_", difficulty)
+            if constant is None:
+                constant = constantOf(song, "", difficulty)
+            if constant is None:
+                continue
+            charts[(name, difficult)] = {
+                "name": name,
+                "difficult": difficult,
+                "constant": constant,
+                "isNew": isNew,
+            }
+    return list(charts.values())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", default=defaultSource)
+    parser.add_argument("--output", default="data/maimaiCharts.json")
+    parser.add_argument("--new-version", type=int, required=True)
+    args = parser.parse_args()
+
+    if args.source.startswith(("http://", "https://")):
+        response = httpx.get(args.source, timeout=30)
+        response.raise_for_status()
+        songs = orjson.loads(response.content)
+    else:
+        songs = orjson.loads(Path(args.source).read_bytes())
+
+    charts = build(songs, args.new_version)
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_bytes(orjson.dumps(charts, option=orjson.OPT_INDENT_2))
+    newCount = sum(1 for chart in charts if chart["isNew"])
+    print(f"wrote {len(charts)} charts ({newCount} new) to {output}")
+
+
+if __name__ == "__main__":
+    main()
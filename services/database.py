@@ -1,14 +1,116 @@
 import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator
+from urllib.parse import urlsplit
 
 import asyncpg
 import dotenv
 
+from services import metrics, tracing
+from services.queries import queries
+
 dotenv.load_dotenv()
 
 
+@dataclass
+class QueryStats:
+    count: int = 0
+    totalSeconds: float = 0.0
+    maxSeconds: float = 0.0
+
+
 class Database:
     pool: asyncpg.Pool = None
+    preparedStatements: bool = False
+    stats: dict[str, QueryStats] = {}
+
+    @staticmethod
+    def usePreparedStatements(dsn: str) -> bool:
+        """プリペアドステートメントを使うかどうかを決めます。
+        トランザクションモードのPgBouncerはプリペアドステートメントを扱えないため、
+        db_prepared_statementsがautoの場合は、PgBouncerらしい接続先では無効にします。
+        """
+        setting = os.getenv("db_prepared_statements", "auto")
+        if setting != "auto":
+            return setting == "on"
+        url = urlsplit(dsn or "")
+        return url.port != 6432 and "pgbouncer" not in (url.hostname or "")
 
     @classmethod
     async def connect(cls):
-        cls.pool = await asyncpg.create_pool(os.getenv("dsn"), statement_cache_size=0)
+        dsn = os.getenv("dsn")
+        cls.preparedStatements = cls.usePreparedStatements(dsn)
+        cls.pool = await asyncpg.create_pool(
+            dsn, statement_cache_size=100 if cls.preparedStatements else 0
+        )
+
+    @classmethod
+    async def run(
+        cls,
+        method: str,
+        name: str,
+        *args: Any,
+        connection: asyncpg.Connection | None = None,
+    ) -> Any:
+        if connection is None:
+            startedAt = time.perf_counter()
+            async with cls.pool.acquire() as connection:
+                metrics.poolWait.observe(time.perf_counter() - startedAt)
+                return await cls.run(method, name, *args, connection=connection)
+
+        startedAt = time.perf_counter()
+        try:
+            with tracing.span(f"db {name}"):
+                return await getattr(connection, method)(queries[name], *args)
+        finally:
+            elapsed = time.perf_counter() - startedAt
+            metrics.queryLatency.labels(name).observe(elapsed)
+            stats = cls.stats.setdefault(name, QueryStats())
+            stats.count += 1
+            stats.totalSeconds += elapsed
+            stats.maxSeconds = max(stats.maxSeconds, elapsed)
+
+    @classmethod
+    async def fetch(cls, name: str, *args: Any, **kwargs: Any) -> list[asyncpg.Record]:
+        return await cls.run("fetch", name, *args, **kwargs)
+
+    @classmethod
+    async def fetchrow(cls, name: str, *args: Any, **kwargs: Any) -> asyncpg.Record:
+        return await cls.run("fetchrow", name, *args, **kwargs)
+
+    @classmethod
+    async def execute(cls, name: str, *args: Any, **kwargs: Any) -> str:
+        return await cls.run("execute", name, *args, **kwargs)
+
+    @classmethod
+    async def fetchval(cls, name: str, *args: Any, **kwargs: Any) -> Any:
+        return await cls.run("fetchval", name, *args, **kwargs)
+
+    @classmethod
+    async def cursor(
+        cls, name: str, *args: Any, prefetch: int = 500
+    ) -> AsyncIterator[asyncpg.Record]:
+        """結果をprefetch件ずつ読み出します。
+        カーソルはトランザクション内でしか使えないので、読み終えるまで接続を一つ占有します。
+        """
+        async with cls.pool.acquire() as connection:
+            async with connection.transaction():
+                async for record in connection.cursor(
+                    queries[name], *args, prefetch=prefetch
+                ):
+                    yield record
+
+    @classmethod
+    @asynccontextmanager
+    async def lock(cls, name: str) -> AsyncIterator[None]:
+        """複数のプロセスで同時に行うと衝突する処理 (テーブルの作成など) を、
+        Postgresのアドバイザリーロックで一つずつ行います。
+        """
+        async with cls.pool.acquire() as connection:
+            await cls.execute("advisoryLock", name, connection=connection)
+            try:
+                yield
+            finally:
+                await cls.execute("advisoryUnlock", name, connection=connection)
@@ -0,0 +1,80 @@
+import asyncio
+import contextlib
+import csv
+import gzip
+import io
+import os
+from pathlib import Path
+from typing import Any
+
+import asyncpg
+import dotenv
+import orjson
+
+from services import tracing
+from services.database import Database
+
+dotenv.load_dotenv()
+
+columns = ["played_at", "music_id", "difficulty", "name", "data"]
+
+
+class RecordExport:
+    """プレイ履歴をgzipで圧縮したCSVまたはJSON Linesに書き出します。
+    データベースからはカーソルで少しずつ読み、一定量ごとに別スレッドで書き込むので、
+    履歴がどれだけ長くても使うメモリは変わりません。
+    """
+
+    semaphore = asyncio.Semaphore(int(os.getenv("export_concurrency", "2")))
+    chunkBytes: int = 64 * 1024
+
+    @staticmethod
+    def line(format: str, row: asyncpg.Record, writer: Any, buffer: io.StringIO):
+        playedAt = row["played_at"].isoformat()
+        if format == "csv":
+            writer.writerow(
+                [playedAt, row["music_id"], row["difficulty"], row["name"], row["data"]]
+            )
+            return
+        buffer.write(
+            orjson.dumps(
+                {
+                    "played_at": playedAt,
+                    "music_id": row["music_id"],
+                    "difficulty": row["difficulty"],
+                    "name": row["name"],
+                    "data": orjson.loads(row["data"]),
+                }
+            ).decode()
+        )
+        buffer.write("\n")
+
+    @classmethod
+    async def write(cls, userId: int, game: str, format: str, path: Path) -> int:
+        """書き出した記録の件数を返します。"""
+        async with cls.semaphore:
+            with tracing.span("export", game=game, format=format):
+                file = await asyncio.to_thread(
+                    gzip.open, path, "wt", encoding="utf-8", newline=""
+                )
+                try:
+                    count = 0
+                    buffer = io.StringIO()
+                    writer = csv.writer(buffer)
+                    if format == "csv":
+                        writer.writerow(columns)
+                    # 途中で失敗・キャンセルされても、すぐにカーソルと接続を返す
+                    async with contextlib.aclosing(
+                        Database.cursor("exportRecords", userId, game)
+                    ) as rows:
+                        async for row in rows:
+                            cls.line(format, row, writer, buffer)
+                            count += 1
+                            if buffer.tell() >= cls.chunkBytes:
+                                await asyncio.to_thread(file.write, buffer.getvalue())
+                                buffer.seek(0)
+                                buffer.truncate()
+                    await asyncio.to_thread(file.write, buffer.getvalue())
+                finally:
+                    await asyncio.to_thread(file.close)
+                return count
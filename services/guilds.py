@@ -0,0 +1,29 @@
+import os
+
+import dotenv
+
+from services.database import Database
+
+dotenv.load_dotenv()
+
+
+class GuildMembers:
+    """サーバー内ランキングの対象にするため、コマンドを使ったサーバーとユーザーの組を記録します。"""
+
+    maxEntries: int = int(os.getenv("guild_member_cache_entries", "100000"))
+    known: set[tuple[int, int]] = set()
+
+    @classmethod
+    async def remember(cls, guildId: int, userId: int):
+        if (guildId, userId) in cls.known:
+            return
+        await Database.execute("saveGuildMember", guildId, userId)
+        if len(cls.known) >= cls.maxEntries:
+            # 書き込みは冪等なので、溢れたら忘れて書き直せばよい
+            cls.known.clear()
+        cls.known.add((guildId, userId))
+
+    @classmethod
+    async def forget(cls, guildId: int):
+        await Database.execute("deleteGuildMembers", guildId)
+        cls.known = {key for key in cls.known if key[0] != guildId}
@@ -0,0 +1,175 @@
+import importlib.util
+import os
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import Any
+from urllib.parse import urlsplit
+
+import dotenv
+from httpx import AsyncClient, Cookies, Limits, Request, Response, Timeout
+
+from services import metrics, tracing
+
+dotenv.load_dotenv()
+
+# 専用のクライアントを持つ上流ホストと、その上流の名前
+knownHosts: dict[str, str] = {
+    "maimaidx.jp": "sega",
+    "maimaidx-eng.com": "sega",
+    "lng-tgk-aime-gw.am-all.net": "sega",
+    "p.eagate.573.jp": "eagate",
+    "eacache.s.konaminet.jp": "eagate",
+    "cdn.eagate.573.jp": "eagate",
+}
+# それ以外のホスト (/imageProxyに渡された任意のURLなど) は一つのクライアントを共有する
+otherHosts = "other"
+
+
+def poolKey(url: str) -> str:
+    host = urlsplit(url).netloc
+    return host if host in knownHosts else otherHosts
+
+
+def upstreamOf(url: str) -> str:
+    """メトリクスのラベルに使う上流の名前です。任意のホストを系列にしないようにまとめます。"""
+    return knownHosts.get(urlsplit(url).netloc, otherHosts)
+
+
+async def countResponse(response: Response):
+    metrics.upstreamResponses.labels(
+        upstreamOf(str(response.request.url)), str(response.status_code)
+    ).inc()
+
+
+def countResponses(client: Any) -> Any:
+    """otogeのクライアントが内部で使うhttpxクライアントのレスポンスも、状態ごとに数えます。"""
+    client.http.event_hooks["response"].append(countResponse)
+    return client
+
+
+class HTTPClientPool:
+    """上流ホストごとに使い回すhttpxクライアントのプールです。
+    クライアントを持つのは既知のホストだけなので、数は増え続けません。
+    """
+
+    clients: dict[str, AsyncClient] = {}
+    inFlight: dict[str, int] = {}
+    peakInFlight: dict[str, int] = {}
+    requestCount: dict[str, int] = {}
+    limits: Limits = None
+    timeout: Timeout = None
+    http2: bool = False
+
+    @classmethod
+    def open(cls):
+        cls.limits = Limits(
+            max_connections=int(os.getenv("http_max_connections", "20")),
+            max_keepalive_connections=int(os.getenv("http_max_keepalive", "10")),
+            keepalive_expiry=float(os.getenv("http_keepalive_expiry", "30")),
+        )
+        cls.timeout = Timeout(
+            float(os.getenv("http_timeout", "10")),
+            connect=float(os.getenv("http_connect_timeout", "5")),
+        )
+        # HTTP/2はh2が入っている環境でのみ有効にできる
+        cls.http2 = (
+            os.getenv("http2", "0") == "1"
+            and importlib.util.find_spec("h2") is not None
+        )
+
+    @classmethod
+    def client(cls, url: str) -> AsyncClient:
+        host = poolKey(url)
+        client = cls.clients.get(host)
+        if client is None:
+            # 複数のユーザーで共有するので、レスポンスのSet-Cookieは一切保存しない
+            client = AsyncClient(
+                cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+                verify=False,
+                limits=cls.limits,
+                timeout=cls.timeout,
+                http2=cls.http2,
+            )
+            cls.clients[host] = client
+        return client
+
+    @classmethod
+    async def get(
+        cls,
+        url: str,
+        *,
+        headers: dict[str, str] | None = None,
+        timeout: float | None = None,
+    ) -> Response:
+        host = poolKey(url)
+        cls.inFlight[host] = cls.inFlight.get(host, 0) + 1
+        cls.peakInFlight[host] = max(cls.peakInFlight.get(host, 0), cls.inFlight[host])
+        cls.requestCount[host] = cls.requestCount.get(host, 0) + 1
+        try:
+            with tracing.span("http.get", host=host):
+                response = await cls.client(url).get(
+                    url,
+                    headers=headers,
+                    timeout=timeout if timeout is not None else cls.timeout,
+                )
+            await countResponse(response)
+            return response
+        finally:
+            cls.inFlight[host] -= 1
+
+    @classmethod
+    async def stream(
+        cls, url: str, *, headers: dict[str, str] | None = None
+    ) -> Response:
+        """本文を読み込まずにレスポンスを返します。
+        呼び出し元は本文をaiter_bytes()で読み、最後に必ずaclose()してください。
+        """
+        host = poolKey(url)
+        cls.inFlight[host] = cls.inFlight.get(host, 0) + 1
+        cls.peakInFlight[host] = max(cls.peakInFlight.get(host, 0), cls.inFlight[host])
+        cls.requestCount[host] = cls.requestCount.get(host, 0) + 1
+        try:
+            client = cls.client(url)
+            with tracing.span("http.stream", host=host):
+                response = await client.send(
+                    client.build_request("GET", url, headers=headers), stream=True
+                )
+            await countResponse(response)
+            return response
+        finally:
+            cls.inFlight[host] -= 1
+
+    @classmethod
+    def stats(cls) -> dict[str, dict[str, int]]:
+        """既知のホストごとと、それ以外のホストをまとめたプールの使用状況を返します。"""
+        stats = {}
+        for host, client in cls.clients.items():
+            # httpcoreの接続プールは非公開属性なので、取れなければ0として扱う
+            pool = getattr(getattr(client, "_transport", None), "_pool", None)
+            connections = list(getattr(pool, "connections", []))
+            stats[host] = {
+                "inFlight": cls.inFlight.get(host, 0),
+                "peakInFlight": cls.peakInFlight.get(host, 0),
+                "requests": cls.requestCount.get(host, 0),
+                "connections": len(connections),
+                "idleConnections": sum(
+                    1 for connection in connections if connection.is_idle()
+                ),
+                "maxConnections": cls.limits.max_connections,
+            }
+        return stats
+
+    @classmethod
+    async def close(cls):
+        for client in cls.clients.values():
+            await client.aclose()
+        cls.clients.clear()
+
+
+def cookieHeader(cookies: Cookies, url: str) -> dict[str, str]:
+    """共有クライアントにCookieを持たせず、リクエスト単位で送るためのヘッダーを作ります。
+    httpxと同じように、ドメインとパスがurlに合うCookieだけを送ります。
+    """
+    request = Request("GET", url)
+    cookies.set_cookie_header(request)
+    header = request.headers.get("Cookie")
+    return {"Cookie": header} if header else {}
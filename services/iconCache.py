@@ -0,0 +1,97 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable
+
+import dotenv
+from fastapi import HTTPException
+
+from services.scheduler import Priority, currentPriority
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class IconEntry:
+    data: bytes
+    contentType: str
+    fetchedAt: float
+
+
+IconFetcher = Callable[[], Awaitable[tuple[bytes, str]]]
+
+
+class IconCache:
+    """ユーザーのアイコンやバナーを (userId, game) ごとにメモリへキャッシュします。
+    期限切れのエントリは古いまま返しつつ、裏で取得し直します。
+    """
+
+    ttl: float = float(os.getenv("icon_cache_ttl", "3600"))
+    maxStale: float = float(os.getenv("icon_cache_max_stale", "86400"))
+    maxEntries: int = int(os.getenv("icon_cache_max_entries", "4096"))
+    entries: OrderedDict[tuple[int, str], IconEntry] = OrderedDict()
+    refreshing: dict[tuple[int, str], asyncio.Task] = {}
+    generations: dict[tuple[int, str], int] = {}
+
+    @classmethod
+    async def get(cls, userId: int, game: str, fetcher: IconFetcher) -> IconEntry:
+        key = (userId, game)
+        entry = cls.entries.get(key)
+        if entry is not None:
+            cls.entries.move_to_end(key)
+            age = time.monotonic() - entry.fetchedAt
+            if age < cls.ttl:
+                return entry
+            if age < cls.maxStale:
+                cls.refresh(key, fetcher, Priority.BACKGROUND)
+                return entry
+        return await asyncio.shield(cls.refresh(key, fetcher, Priority.INTERACTIVE))
+
+    @classmethod
+    def refresh(
+        cls, key: tuple[int, str], fetcher: IconFetcher, priority: Priority
+    ) -> asyncio.Task:
+        task = cls.refreshing.get(key)
+        if task is None:
+            task = asyncio.create_task(cls.load(key, fetcher, priority))
+            cls.refreshing[key] = task
+            task.add_done_callback(lambda task: cls.finished(key, task))
+        return task
+
+    @classmethod
+    def finished(cls, key: tuple[int, str], task: asyncio.Task):
+        cls.refreshing.pop(key, None)
+        if task.cancelled() or task.exception() is None:
+            return
+        # リンクされていないユーザー (404) などは、呼び出し元にそのまま返すだけでよい
+        if isinstance(task.exception(), HTTPException):
+            return
+        logger.warning("failed to refresh icon %s", key, exc_info=task.exception())
+
+    @classmethod
+    async def load(
+        cls, key: tuple[int, str], fetcher: IconFetcher, priority: Priority
+    ) -> IconEntry:
+        # タスクはコンテキストのコピーで動くので、呼び出し元の優先度には影響しない
+        currentPriority.set(priority)
+        generation = cls.generations.get(key, 0)
+        data, contentType = await fetcher()
+        entry = IconEntry(data, contentType, time.monotonic())
+        # 取得中にリンクし直された場合は、古いアカウントの画像を保存しない
+        if cls.generations.get(key, 0) == generation:
+            cls.entries[key] = entry
+            cls.entries.move_to_end(key)
+            while len(cls.entries) > cls.maxEntries:
+                cls.entries.popitem(last=False)
+        return entry
+
+    @classmethod
+    def invalidate(cls, userId: int, game: str):
+        key = (userId, game)
+        cls.entries.pop(key, None)
+        cls.generations[key] = cls.generations.get(key, 0) + 1
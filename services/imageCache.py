@@ -0,0 +1,354 @@
+import asyncio
+import hashlib
+import mimetypes
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable
+
+import dotenv
+from fastapi import HTTPException
+from httpx import Response
+
+from services import metrics, tracing
+from services.http import HTTPClientPool
+from services.imageTransform import ImageTransformer
+
+dotenv.load_dotenv()
+
+# 再起動後に拡張子から形式を判別できるように登録しておく
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+
+
+@dataclass
+class CacheEntry:
+    path: Path
+    size: int
+    contentType: str
+    modifiedAt: float
+    usedAt: float
+
+
+class ImageCache:
+    """URLのハッシュをキーにして、画像をディスクにキャッシュします。
+    容量の上限を超えた場合は、最も長く使われていないものから削除します。
+    索引はワーカーごとに持つので、ディスク全体を定期的に数え直して上限を共有します。
+    """
+
+    directory: Path = None
+    maxBytes: int = 0
+    totalBytes: int = 0
+    entries: OrderedDict[str, CacheEntry] = OrderedDict()
+    hotMaxBytes: int = 0
+    hotEntryMaxBytes: int = 0
+    hotBytes: int = 0
+    hot: OrderedDict[str, bytes] = OrderedDict()
+    inFlight: dict[str, asyncio.Task] = {}
+    maxObjectBytes: int = 0
+    rescanSeconds: float = 0
+
+    @classmethod
+    def open(cls):
+        cls.directory = Path(os.getenv("image_cache_dir", "cache/images"))
+        cls.maxBytes = int(os.getenv("image_cache_max_bytes", str(512 * 1024 * 1024)))
+        cls.maxObjectBytes = int(
+            os.getenv("image_max_object_bytes", str(20 * 1024 * 1024))
+        )
+        cls.hotMaxBytes = int(os.getenv("image_cache_hot_bytes", str(32 * 1024 * 1024)))
+        cls.hotEntryMaxBytes = int(
+            os.getenv("image_cache_hot_entry_bytes", str(256 * 1024))
+        )
+        cls.rescanSeconds = float(os.getenv("image_cache_rescan_seconds", "60"))
+        cls.directory.mkdir(parents=True, exist_ok=True)
+
+        # 再起動後もディスク上のキャッシュを使えるように、最終アクセス順で索引を作り直す
+        for path, stat in cls.scan():
+            cls.entries[path.stem] = cls.entryOf(path, stat)
+            cls.totalBytes += stat.st_size
+        # 起動中はまだリクエストを受けていないので、そのまま削除してよい
+        cls.unlink(cls.evict())
+
+    @classmethod
+    def scan(cls) -> list[tuple[Path, os.stat_result]]:
+        """ディスク上のキャッシュファイルを、最終アクセスの古い順に返します。"""
+        files = []
+        for path in cls.directory.iterdir():
+            if path.name.endswith(".tmp"):
+                continue
+            try:
+                files.append((path, path.stat()))
+            except FileNotFoundError:
+                # 別のワーカーが削除した場合
+                continue
+        files.sort(key=lambda file: file[1].st_atime)
+        return files
+
+    @staticmethod
+    def entryOf(path: Path, stat: os.stat_result) -> CacheEntry:
+        contentType = mimetypes.guess_type(path.name)[0] or "image/png"
+        return CacheEntry(path, stat.st_size, contentType, stat.st_mtime, stat.st_atime)
+
+    @classmethod
+    async def merge(cls, files: list[tuple[Path, os.stat_result]], scannedAt: float):
+        """他のワーカーが書き込んだファイルと削除したファイルを索引に反映します。
+        各ワーカーは自分の書き込みしか数えないので、そのままではディスク全体で
+        上限のワーカー数倍まで使ってしまいます。
+        """
+        onDisk = {path.stem: (path, stat) for path, stat in files}
+        for key, entry in list(cls.entries.items()):
+            # 数え直している間に書き込んだものは、まだ一覧に載っていないことがある
+            if key not in onDisk and entry.modifiedAt < scannedAt:
+                del cls.entries[key]
+                cls.dropHot(key)
+        for key, (path, stat) in onDisk.items():
+            entry = cls.entries.get(key)
+            if entry is None:
+                cls.entries[key] = cls.entryOf(path, stat)
+            else:
+                # 他のワーカーが読んだ場合は、最終アクセス日時だけが進んでいる
+                entry.usedAt = max(entry.usedAt, stat.st_atime)
+        # 他のワーカーのファイルも、最後に使われた日時の順に並べる
+        cls.entries = OrderedDict(
+            sorted(cls.entries.items(), key=lambda item: item[1].usedAt)
+        )
+        cls.totalBytes = sum(entry.size for entry in cls.entries.values())
+        await cls.trim()
+
+    @classmethod
+    async def rescan(cls):
+        """ディスク全体の使用量を定期的に数え直し、全ワーカー合計で上限を守ります。"""
+        while True:
+            await asyncio.sleep(cls.rescanSeconds)
+            scannedAt = time.time()
+            try:
+                files = await asyncio.to_thread(cls.scan)
+            except OSError:
+                continue
+            await cls.merge(files, scannedAt)
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    @classmethod
+    def evict(cls) -> list[Path]:
+        """上限を超えた分を古いものから索引から外し、削除するファイルを返します。"""
+        evicted = []
+        while cls.totalBytes > cls.maxBytes and cls.entries:
+            key, entry = cls.entries.popitem(last=False)
+            cls.totalBytes -= entry.size
+            cls.dropHot(key)
+            evicted.append(entry.path)
+        return evicted
+
+    @staticmethod
+    def unlink(paths: list[Path]):
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    @classmethod
+    async def trim(cls):
+        """上限を超えた分を、イベントループを止めないように削除します。"""
+        evicted = cls.evict()
+        if evicted:
+            await asyncio.to_thread(cls.unlink, evicted)
+
+    @classmethod
+    def forget(cls, entry: CacheEntry):
+        """ファイルが削除されていたエントリーを索引から外します。"""
+        key = entry.path.stem
+        if cls.entries.get(key) is entry:
+            del cls.entries[key]
+            cls.totalBytes -= entry.size
+            cls.dropHot(key)
+
+    @classmethod
+    def dropHot(cls, key: str):
+        data = cls.hot.pop(key, None)
+        if data is not None:
+            cls.hotBytes -= len(data)
+
+    @classmethod
+    def remember(cls, key: str, data: bytes):
+        if len(data) > cls.hotEntryMaxBytes:
+            return
+        cls.dropHot(key)
+        cls.hot[key] = data
+        cls.hotBytes += len(data)
+        while cls.hotBytes > cls.hotMaxBytes and cls.hot:
+            _, evicted = cls.hot.popitem(last=False)
+            cls.hotBytes -= len(evicted)
+
+    @classmethod
+    async def lookup(cls, key: str) -> CacheEntry | None:
+        entry = cls.entries.get(key)
+        if entry is None:
+            return None
+        # メモリ上にあるものはファイルを読まずに返せる。それ以外は別のワーカーが
+        # 削除していないかを、イベントループを止めないように確かめる
+        if key not in cls.hot and not await asyncio.to_thread(entry.path.exists):
+            cls.forget(entry)
+            return None
+        # 確かめている間に削除・置き換えされた場合に備えて引き直す
+        entry = cls.entries.get(key)
+        if entry is None:
+            return None
+        entry.usedAt = time.time()
+        cls.entries.move_to_end(key)
+        if key in cls.hot:
+            cls.hot.move_to_end(key)
+        return entry
+
+    @classmethod
+    async def cached(
+        cls, key: str, factory: Callable[[], Awaitable[CacheEntry]]
+    ) -> tuple[CacheEntry, bytes | None]:
+        entry = await cls.lookup(key)
+        if entry is not None:
+            metrics.imageCacheRequests.labels("hit").inc()
+            return entry, cls.hot.get(key)
+
+        metrics.imageCacheRequests.labels("miss").inc()
+        task = cls.inFlight.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            cls.inFlight[key] = task
+            task.add_done_callback(lambda _: cls.inFlight.pop(key, None))
+        entry = await asyncio.shield(task)
+        return entry, cls.hot.get(key)
+
+    @classmethod
+    async def fetch(cls, url: str) -> tuple[CacheEntry, bytes | None]:
+        """画像をキャッシュから取得します。なければ上流から取得して保存します。
+        同じURLへの同時のキャッシュミスは、一度の取得にまとめられます。
+        """
+        key = cls.key(url)
+        return await cls.cached(key, lambda: cls.download(key, url))
+
+    @classmethod
+    async def variant(
+        cls, url: str, width: int | None, format: str | None
+    ) -> tuple[CacheEntry, bytes | None]:
+        """縮小・変換した画像を取得します。変換結果も元画像と同じようにキャッシュされます。
+        formatを省略した場合は、元画像の形式のまま縮小します。
+        """
+        key = cls.key(f"{url}#w={width}&format={format}")
+        return await cls.cached(key, lambda: cls.transform(key, url, width, format))
+
+    @classmethod
+    def enabled(cls) -> bool:
+        """image_cache_max_bytesが0の場合は、キャッシュせずにそのまま中継します。"""
+        return cls.maxBytes > 0
+
+    @classmethod
+    def path(cls, key: str, contentType: str) -> Path:
+        extension = mimetypes.guess_extension(contentType) or ".png"
+        return cls.directory / f"{key}{extension}"
+
+    @classmethod
+    async def body(cls, response: Response) -> AsyncIterator[bytes]:
+        """上流の本文を少しずつ返します。上限を超えた場合は途中で打ち切ります。"""
+        length = response.headers.get("content-length")
+        if length is not None and length.isdigit() and int(length) > cls.maxObjectBytes:
+            raise HTTPException(502, "Upstream image is too large")
+        received = 0
+        async for chunk in response.aiter_bytes():
+            received += len(chunk)
+            if received > cls.maxObjectBytes:
+                raise HTTPException(502, "Upstream image is too large")
+            yield chunk
+
+    @staticmethod
+    def contentTypeOf(response: Response) -> str:
+        """上流のContent-Typeを返します。
+        APIと同じオリジンから配信するので、画像以外 (HTMLやスクリプト、スクリプトを
+        含められるSVG) は中継もキャッシュもせずに502にします。
+        """
+        contentType = response.headers.get("content-type", "image/png")
+        contentType = contentType.split(";")[0].strip().lower()
+        if not contentType.startswith("image/") or contentType == "image/svg+xml":
+            raise HTTPException(502, "Upstream response is not an image")
+        return contentType
+
+    @classmethod
+    async def download(cls, key: str, url: str) -> CacheEntry:
+        response = await HTTPClientPool.stream(url)
+        try:
+            if response.status_code != 200:
+                raise HTTPException(502)
+            contentType = cls.contentTypeOf(response)
+            path = cls.path(key, contentType)
+            with tracing.span("imageCache.write"):
+                size, data = await cls.receive(response, path)
+        finally:
+            await response.aclose()
+        return await cls.register(key, path, size, contentType, data)
+
+    @classmethod
+    async def receive(cls, response: Response, path: Path) -> tuple[int, bytes | None]:
+        """本文を一時ファイルに書き込みながら受け取り、書き終えてから置き換えます。
+        書き込みを待ってから次を読むので、メモリに溜まるのは一度に一塊だけです。
+        メモリ上にも置ける小さな画像の場合は、その中身も返します。
+        """
+        temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        size = 0
+        chunks: list[bytes] | None = []
+        file = await asyncio.to_thread(temporary.open, "wb")
+        try:
+            async for chunk in cls.body(response):
+                size += len(chunk)
+                if chunks is not None and size <= cls.hotEntryMaxBytes:
+                    chunks.append(chunk)
+                else:
+                    chunks = None
+                await asyncio.to_thread(file.write, chunk)
+            await asyncio.to_thread(file.close)
+            await asyncio.to_thread(os.replace, temporary, path)
+        except BaseException:
+            file.close()
+            temporary.unlink(missing_ok=True)
+            raise
+        return size, b"".join(chunks) if chunks is not None else None
+
+    @classmethod
+    async def transform(
+        cls, key: str, url: str, width: int | None, format: str | None
+    ) -> CacheEntry:
+        source, _ = await cls.fetch(url)
+        format = format or ImageTransformer.formatOf(source.contentType)
+        with tracing.span("imageCache.transform", width=width, format=format):
+            data = await ImageTransformer.transform(source.path, width, format)
+        return await cls.store(key, data, ImageTransformer.formats[format])
+
+    @classmethod
+    async def store(cls, key: str, data: bytes, contentType: str) -> CacheEntry:
+        path = cls.path(key, contentType)
+        with tracing.span("imageCache.write", bytes=len(data)):
+            await asyncio.to_thread(cls.write, path, data)
+        return await cls.register(key, path, len(data), contentType, data)
+
+    @classmethod
+    async def register(
+        cls, key: str, path: Path, size: int, contentType: str, data: bytes | None
+    ) -> CacheEntry:
+        previous = cls.entries.pop(key, None)
+        if previous is not None:
+            cls.totalBytes -= previous.size
+        cls.dropHot(key)
+        now = time.time()
+        entry = CacheEntry(path, size, contentType, now, now)
+        cls.entries[key] = entry
+        cls.totalBytes += entry.size
+        if data is not None:
+            cls.remember(key, data)
+        await cls.trim()
+        return entry
+
+    @staticmethod
+    def write(path: Path, data: bytes):
+        temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        temporary.write_bytes(data)
+        os.replace(temporary, path)
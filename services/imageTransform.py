@@ -0,0 +1,81 @@
+import asyncio
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import dotenv
+from fastapi import HTTPException
+from PIL import Image, UnidentifiedImageError, features
+
+dotenv.load_dotenv()
+
+# 非可逆圧縮の形式で使う画質
+quality = 80
+
+
+def render(source: str, width: int | None, format: str) -> bytes:
+    """ワーカープロセスで画像を縮小・変換します。"""
+    with Image.open(source) as image:
+        image.load()
+        if width is not None and image.width > width:
+            image.thumbnail((width, image.height), Image.Resampling.LANCZOS)
+        if format == "jpeg":
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+
+        buffer = io.BytesIO()
+        if format == "png":
+            image.save(buffer, format="PNG", optimize=True)
+        else:
+            image.save(buffer, format=format.upper(), quality=quality)
+        return buffer.getvalue()
+
+
+class ImageTransformer:
+    """Pillowによる画像の縮小・変換を、イベントループの外のプロセスプールで行います。"""
+
+    pool: ProcessPoolExecutor = None
+    formats: dict[str, str] = {}
+
+    @classmethod
+    def open(cls):
+        # 親のイベントループやスレッド、ソケットを引き継がないように、forkを使わない
+        cls.pool = ProcessPoolExecutor(
+            max_workers=int(os.getenv("image_transform_workers", "2")),
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+        cls.formats = {"png": "image/png", "jpeg": "image/jpeg"}
+        # WebPやAVIFはPillowのビルドによっては使えない
+        modules = features.get_supported_modules()
+        if "webp" in modules:
+            cls.formats["webp"] = "image/webp"
+        if "avif" in modules:
+            cls.formats["avif"] = "image/avif"
+
+    @classmethod
+    def formatOf(cls, contentType: str) -> str:
+        """元画像の形式のまま縮小する場合の出力形式を返します。"""
+        for format, formatContentType in cls.formats.items():
+            if formatContentType == contentType:
+                return format
+        return "png"
+
+    @classmethod
+    async def transform(cls, source: Path, width: int | None, format: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(
+                cls.pool, render, str(source), width, format
+            )
+        except UnidentifiedImageError:
+            # 上流が画像以外を返した場合
+            raise HTTPException(502)
+
+    @classmethod
+    def close(cls):
+        if cls.pool is not None:
+            cls.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,52 @@
+import logging
+import os
+
+import asyncpg
+import dotenv
+
+from services.database import Database
+from services.iconCache import IconCache
+from services.segaSession import SegaSessions
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+class Invalidation:
+    """アカウントのリンクし直しを、PostgresのLISTEN/NOTIFYで全プロセスに伝えます。
+    ボットとAPIを別プロセスで動かしていても、キャッシュとセッションを破棄できます。
+    """
+
+    channel: str = "otogebot_invalidate"
+    connection: asyncpg.Connection = None
+
+    @classmethod
+    def apply(cls, userId: int, game: str):
+        IconCache.invalidate(userId, game)
+        if game == "maimai":
+            SegaSessions.invalidate(userId)
+
+    @classmethod
+    def onNotify(cls, connection, pid, channel, payload: str):
+        userId, game = payload.split(":", 1)
+        cls.apply(int(userId), game)
+
+    @classmethod
+    async def listen(cls):
+        # プールの接続を専有しないように、専用の接続でLISTENする
+        cls.connection = await asyncpg.connect(os.getenv("dsn"))
+        await cls.connection.add_listener(cls.channel, cls.onNotify)
+
+    @classmethod
+    async def publish(cls, userId: int, game: str):
+        cls.apply(userId, game)
+        try:
+            await Database.execute("notify", cls.channel, f"{userId}:{game}")
+        except Exception:
+            logger.warning("failed to publish invalidation", exc_info=True)
+
+    @classmethod
+    async def close(cls):
+        if cls.connection is not None:
+            await cls.connection.close()
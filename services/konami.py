@@ -0,0 +1,53 @@
+import os
+from typing import Any
+
+import asyncpg
+import dotenv
+import orjson
+from cryptography.fernet import Fernet
+
+from services import tracing
+from services.http import countResponses
+from services.scheduler import Scheduler
+from services.singleflight import upstream
+
+dotenv.load_dotenv()
+
+cipherSuite = Fernet(os.getenv("fernet_key").encode())
+
+
+def loadCookies(row: asyncpg.Record) -> list[dict[str, str]]:
+    with tracing.span("decrypt"):
+        return orjson.loads(cipherSuite.decrypt(row["cookies"].encode()).decode())
+
+
+def createClient(clientClass: type, row: asyncpg.Record) -> Any:
+    client = countResponses(clientClass(skipKonami=True))
+    client.loginWithCookie(loadCookies(row))
+    return client
+
+
+async def fetchProfile(clientClass: type, userId: int, row: asyncpg.Record) -> Any:
+    """プロフィールを取得します。同じユーザーへの同時の取得は一つにまとめられます。"""
+
+    async def fetch():
+        client = createClient(clientClass, row)
+        async with Scheduler.slot("eagate"):
+            with tracing.span(f"{clientClass.__name__}.fetchProfile"):
+                return await client.fetchProfile()
+
+    return await upstream.do((clientClass.__name__, "profile", userId), fetch)
+
+
+async def fetchPlayRecords(
+    clientClass: type, userId: int, row: asyncpg.Record
+) -> list[Any]:
+    """プレイ履歴を取得します。同じユーザーへの同時の取得は一つにまとめられます。"""
+
+    async def fetch():
+        client = createClient(clientClass, row)
+        async with Scheduler.slot("eagate"):
+            with tracing.span(f"{clientClass.__name__}.fetchPlayRecords"):
+                return await client.fetchPlayRecords()
+
+    return await upstream.do((clientClass.__name__, "records", userId), fetch)
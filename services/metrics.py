@@ -0,0 +1,95 @@
+import asyncio
+import os
+from typing import Any
+
+import dotenv
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+dotenv.load_dotenv()
+
+commandLatency = Histogram(
+    "otogebot_command_seconds",
+    "スラッシュコマンドの受信から完了までの時間",
+    ["command"],
+)
+commandErrors = Counter(
+    "otogebot_command_errors_total",
+    "エラーで終わったスラッシュコマンドの数",
+    ["command"],
+)
+upstreamLatency = Histogram(
+    "otogebot_upstream_seconds",
+    "上流 (SEGA・eagate) への呼び出しにかかった時間",
+    ["upstream", "outcome"],
+)
+upstreamWait = Histogram(
+    "otogebot_upstream_wait_seconds",
+    "上流への呼び出しが順番待ちをした時間",
+    ["upstream"],
+)
+upstreamResponses = Counter(
+    "otogebot_upstream_responses_total",
+    "上流 (sega・eagate・other) から受け取ったレスポンスの数",
+    ["upstream", "status"],
+)
+queryLatency = Histogram(
+    "otogebot_query_seconds",
+    "名前付きクエリの実行時間",
+    ["query"],
+)
+poolWait = Histogram(
+    "otogebot_db_pool_wait_seconds",
+    "接続プールから接続を取得するまでの待ち時間",
+)
+# 値はmonitorPoolが定期的に設定する。複数プロセスの場合は生きているプロセスの合計
+poolSize = Gauge(
+    "otogebot_db_pool_size", "接続プールの接続数", multiprocess_mode="livesum"
+)
+poolIdle = Gauge(
+    "otogebot_db_pool_idle", "接続プールの空いている接続数", multiprocess_mode="livesum"
+)
+imageCacheRequests = Counter(
+    "otogebot_image_cache_requests_total",
+    "画像キャッシュへのリクエスト数",
+    ["result"],
+)
+eventLoopLag = Histogram(
+    "otogebot_event_loop_lag_seconds",
+    "イベントループの遅延",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+
+async def monitorEventLoopLag(interval: float = 0.5):
+    """一定間隔で眠り、予定より遅れて起きた時間をイベントループの遅延とします。"""
+    loop = asyncio.get_running_loop()
+    while True:
+        startedAt = loop.time()
+        await asyncio.sleep(interval)
+        eventLoopLag.observe(max(0.0, loop.time() - startedAt - interval))
+
+
+async def monitorPool(pool: Any, interval: float = 5):
+    """接続プールの接続数を定期的に記録します。
+    set_functionの値はPROMETHEUS_MULTIPROC_DIRでは集計されないので、値を直接設定します。
+    """
+    while True:
+        poolSize.set(pool.get_size())
+        poolIdle.set(pool.get_idle_size())
+        await asyncio.sleep(interval)
+
+
+def render() -> bytes:
+    # uvicornを複数ワーカーで動かす場合は、PROMETHEUS_MULTIPROC_DIRで集計する
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest()
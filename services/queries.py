@@ -0,0 +1,194 @@
+# アプリ全体で使うSQLを名前付きで定義します。
+# 必要な列だけを取得し、Database.fetch("名前", ...) のように名前で呼び出します。
+queries: dict[str, str] = {
+    "aimeAccount": "SELECT id, segaid, password, aime FROM aime WHERE id = $1",
+    "aimeAccounts": "SELECT id, segaid, password, aime FROM aime",
+    "saveAimeAccount": """
+        INSERT INTO aime (id, segaid, password, aime)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (id)
+        DO UPDATE SET
+            segaid = EXCLUDED.segaid,
+            password = EXCLUDED.password,
+            aime = excluded.aime
+    """,
+    "konamiAccount": "SELECT id, cookies FROM konami WHERE id = $1",
+    "konamiAccounts": "SELECT id, cookies FROM konami",
+    "saveKonamiAccount": """
+        INSERT INTO konami (id, cookies)
+        VALUES ($1, $2)
+        ON CONFLICT (id)
+        DO UPDATE SET
+            cookies = EXCLUDED.cookies
+    """,
+    "createRecordStaging": """
+        CREATE TEMPORARY TABLE play_records_staging
+        (LIKE play_records INCLUDING DEFAULTS)
+        ON COMMIT DROP
+    """,
+    "insertStagedRecords": """
+        INSERT INTO play_records
+            (user_id, game, music_id, difficulty, played_at, name, data)
+        SELECT
+            user_id, game, music_id, difficulty, played_at, name, data
+        FROM play_records_staging
+        ORDER BY id
+        ON CONFLICT DO NOTHING
+        RETURNING data
+    """,
+    "savePlayer": """
+        INSERT INTO players (user_id, game, name, icon_url, stats, synced_at)
+        VALUES ($1, $2, $3, $4, $5::jsonb, now())
+        ON CONFLICT (user_id, game)
+        DO UPDATE SET
+            name = EXCLUDED.name,
+            icon_url = EXCLUDED.icon_url,
+            stats = EXCLUDED.stats,
+            synced_at = EXCLUDED.synced_at
+    """,
+    "player": """
+        SELECT name, icon_url, synced_at FROM players
+        WHERE user_id = $1 AND game = $2
+    """,
+    "recordSnapshot": """
+        SELECT coalesce(max(id), 0) AS snapshot, count(*) AS total
+        FROM play_records
+        WHERE user_id = $1 AND game = $2
+    """,
+    "recordHistory": """
+        SELECT data FROM play_records
+        WHERE user_id = $1 AND game = $2 AND id <= $3
+        ORDER BY played_at DESC, id DESC
+        LIMIT $4 OFFSET $5
+    """,
+    "createBotState": """
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """,
+    "botState": "SELECT value FROM bot_state WHERE key = $1",
+    "saveBotState": """
+        INSERT INTO bot_state (key, value)
+        VALUES ($1, $2)
+        ON CONFLICT (key)
+        DO UPDATE SET
+            value = EXCLUDED.value
+    """,
+    "notify": "SELECT pg_notify($1, $2)",
+    "createClusterStats": """
+        CREATE TABLE IF NOT EXISTS cluster_stats (
+            cluster_id INTEGER PRIMARY KEY,
+            guild_count INTEGER NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """,
+    "saveClusterStats": """
+        INSERT INTO cluster_stats (cluster_id, guild_count, updated_at)
+        VALUES ($1, $2, now())
+        ON CONFLICT (cluster_id)
+        DO UPDATE SET
+            guild_count = EXCLUDED.guild_count,
+            updated_at = EXCLUDED.updated_at
+    """,
+    "totalGuildCount": """
+        SELECT coalesce(sum(guild_count), 0) FROM cluster_stats
+        WHERE updated_at > now() - interval '2 minutes'
+    """,
+    "maimaiAchievements": """
+        SELECT id, music_id, difficulty, data->>'percentage' AS percentage
+        FROM play_records
+        WHERE user_id = $1 AND game = 'maimai' AND id > $2
+    """,
+    "saveSongBests": """
+        INSERT INTO song_bests
+            (user_id, game, music_id, difficulty, name, score, updated_at)
+        SELECT $1, $2, music_id, difficulty, name, score, now()
+        FROM unnest($3::text[], $4::text[], $5::text[], $6::float8[])
+            AS bests (music_id, difficulty, name, score)
+        ON CONFLICT (user_id, game, music_id, difficulty)
+        DO UPDATE SET
+            name = EXCLUDED.name,
+            score = EXCLUDED.score,
+            updated_at = EXCLUDED.updated_at
+        WHERE song_bests.score < EXCLUDED.score
+    """,
+    "hasSongBests": """
+        SELECT EXISTS (SELECT 1 FROM song_bests)
+    """,
+    "recordsAfter": """
+        SELECT id, user_id, game, data FROM play_records
+        WHERE id > $1
+        ORDER BY id
+        LIMIT $2
+    """,
+    "saveGuildMember": """
+        INSERT INTO guild_members (guild_id, user_id)
+        VALUES ($1, $2)
+        ON CONFLICT DO NOTHING
+    """,
+    "deleteGuildMembers": """
+        DELETE FROM guild_members WHERE guild_id = $1
+    """,
+    "songLeaderboard": """
+        SELECT song_bests.user_id, players.name, song_bests.score
+        FROM guild_members
+        JOIN song_bests ON song_bests.user_id = guild_members.user_id
+        LEFT JOIN players
+            ON players.user_id = song_bests.user_id
+            AND players.game = song_bests.game
+        WHERE guild_members.guild_id = $1
+            AND song_bests.game = $2
+            AND song_bests.name = $3
+            AND song_bests.difficulty = $4
+        ORDER BY song_bests.score DESC
+        LIMIT $5
+    """,
+    "statLeaderboard": """
+        SELECT players.user_id, players.name, (players.stats->>$3)::float8 AS score
+        FROM guild_members
+        JOIN players ON players.user_id = guild_members.user_id
+        WHERE guild_members.guild_id = $1
+            AND players.game = $2
+            AND players.stats ? $3
+        ORDER BY score DESC
+        LIMIT $4
+    """,
+    "hasSongs": """
+        SELECT EXISTS (SELECT 1 FROM songs)
+    """,
+    "backfillSongs": """
+        INSERT INTO songs (game, music_id, name, jacket_url)
+        SELECT DISTINCT ON (game, music_id)
+            game, music_id, name, data->>'jacketUrl'
+        FROM play_records
+        ORDER BY game, music_id, id DESC
+        ON CONFLICT DO NOTHING
+    """,
+    "saveSongs": """
+        INSERT INTO songs (game, music_id, name, jacket_url)
+        SELECT $1, music_id, name, jacket_url
+        FROM unnest($2::text[], $3::text[], $4::text[])
+            AS songs (music_id, name, jacket_url)
+        ON CONFLICT DO NOTHING
+    """,
+    "songs": """
+        SELECT game, music_id, name, jacket_url FROM songs
+    """,
+    "songBests": """
+        SELECT difficulty, score FROM song_bests
+        WHERE user_id = $1 AND game = $2 AND name = $3
+        ORDER BY score DESC
+    """,
+    "userSongBests": """
+        SELECT music_id, difficulty, score FROM song_bests
+        WHERE user_id = $1 AND game = $2
+    """,
+    "exportRecords": """
+        SELECT played_at, music_id, difficulty, name, data FROM play_records
+        WHERE user_id = $1 AND game = $2
+        ORDER BY played_at, id
+    """,
+    "advisoryLock": "SELECT pg_advisory_lock(hashtext($1))",
+    "advisoryUnlock": "SELECT pg_advisory_unlock(hashtext($1))",
+}
@@ -0,0 +1,196 @@
+import logging
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import dotenv
+import numpy as np
+import orjson
+
+from services.database import Database
+from services.records import toScore
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger("otogebot.rating")
+
+# 達成率 (%) の下限と、それ以上で使う係数 (maimai でらっくす)
+rankCoefficients = [
+    (100.5, 22.4),  # SSS+
+    (100.4999, 22.2),
+    (100.0, 21.6),  # SSS
+    (99.9999, 21.4),
+    (99.5, 21.1),  # SS+
+    (99.0, 20.8),  # SS
+    (98.9999, 20.6),
+    (98.0, 20.3),  # S+
+    (97.0, 20.0),  # S
+    (96.9999, 17.6),
+    (94.0, 16.8),  # AAA
+    (90.0, 15.2),  # AA
+    (80.0, 13.6),  # A
+    (79.9999, 12.8),
+    (75.0, 12.0),  # BBB
+    (70.0, 11.2),  # BB
+    (60.0, 9.6),  # B
+    (50.0, 8.0),  # C
+    (40.0, 6.4),  # D
+    (30.0, 4.8),
+    (20.0, 3.2),
+    (10.0, 1.6),
+    (0.0, 0.0),
+]
+thresholds = np.array([threshold for threshold, _ in reversed(rankCoefficients)])
+coefficients = np.array([coefficient for _, coefficient in reversed(rankCoefficients)])
+
+# 新曲枠と旧曲枠の対象数
+newCount = 15
+oldCount = 35
+
+
+def ratings(constants: np.ndarray, achievements: np.ndarray) -> np.ndarray:
+    """譜面定数と達成率 (%) から、譜面ごとの単曲レートをまとめて計算します。"""
+    coefficient = coefficients[np.searchsorted(thresholds, achievements, "right") - 1]
+    # 浮動小数点の誤差で切り捨てが一つずれないように、わずかに足してから切り捨てる
+    values = constants * np.minimum(achievements, 100.5) * coefficient / 100
+    return np.floor(values + 1e-9).astype(np.int64)
+
+
+def bestPerChart(
+    charts: np.ndarray, achievements: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """譜面ごとに最も高い達成率だけを残します。"""
+    order = np.lexsort((-achievements, charts))
+    charts, achievements = charts[order], achievements[order]
+    first = np.ones(len(charts), dtype=bool)
+    first[1:] = charts[1:] != charts[:-1]
+    return charts[first], achievements[first]
+
+
+class ChartTable:
+    """(曲名, 難易度) から譜面定数を引く表です。
+    JSONファイルは {"name", "difficult", "constant", "isNew"} の配列で、
+    python -m scripts.maimaiCharts で作れます。
+    """
+
+    def __init__(self, charts: list[dict]):
+        self.names = [chart["name"] for chart in charts]
+        self.difficulties = [chart["difficult"] for chart in charts]
+        self.constants = np.array([chart["constant"] for chart in charts], dtype=float)
+        self.isNew = np.array(
+            [chart.get("isNew", False) for chart in charts], dtype=bool
+        )
+        self.index = {
+            (chart["name"], chart["difficult"]): index
+            for index, chart in enumerate(charts)
+        }
+
+    @classmethod
+    def load(cls, path: Path) -> "ChartTable":
+        return cls(orjson.loads(path.read_bytes()))
+
+
+@dataclass
+class UserBests:
+    maxId: int
+    charts: np.ndarray
+    achievements: np.ndarray
+
+
+@dataclass
+class RatingEntry:
+    name: str
+    difficult: str
+    constant: float
+    achievement: float
+    rating: int
+
+
+@dataclass
+class RatingBreakdown:
+    total: int
+    new: list[RatingEntry]
+    old: list[RatingEntry]
+
+
+class MaimaiRating:
+    """保存済みのプレイ履歴から、maimaiのレート (新曲15 + 旧曲35) を計算します。
+    譜面ごとのベストはユーザーごとに保持し、前回より後に保存された記録だけを読み足します。
+    """
+
+    charts: ChartTable | None = None
+    maxUsers: int = int(os.getenv("maimai_rating_cache_users", "1024"))
+    users: OrderedDict[int, UserBests] = OrderedDict()
+
+    @classmethod
+    def open(cls):
+        path = Path(os.getenv("maimai_chart_constants", "data/maimaiCharts.json"))
+        if not path.exists():
+            logger.warning("Chart constant table %s was not found", path)
+            return
+        cls.charts = ChartTable.load(path)
+        cls.users.clear()
+
+    @classmethod
+    async def bests(cls, userId: int) -> UserBests:
+        bests = cls.users.get(userId)
+        if bests is None:
+            bests = UserBests(0, np.empty(0, dtype=np.int64), np.empty(0))
+        rows = await Database.fetch("maimaiAchievements", userId, bests.maxId)
+        if rows:
+            # 達成率が "-" などで読めない記録は対象外
+            scored = [
+                (row, score)
+                for row in rows
+                if (score := toScore(row["percentage"])) is not None
+            ]
+            charts = np.array(
+                [
+                    cls.charts.index.get((row["music_id"], row["difficulty"]), -1)
+                    for row, _ in scored
+                ],
+                dtype=np.int64,
+            )
+            achievements = np.array([score for _, score in scored], dtype=float)
+            # 定数表にない譜面 (宴など) は対象外
+            known = charts >= 0
+            bests = UserBests(
+                max(row["id"] for row in rows),
+                *bestPerChart(
+                    np.concatenate([bests.charts, charts[known]]),
+                    np.concatenate([bests.achievements, achievements[known]]),
+                ),
+            )
+        cls.users[userId] = bests
+        cls.users.move_to_end(userId)
+        while len(cls.users) > cls.maxUsers:
+            cls.users.popitem(last=False)
+        return bests
+
+    @classmethod
+    def entries(
+        cls, charts: np.ndarray, achievements: np.ndarray, count: int
+    ) -> list[RatingEntry]:
+        values = ratings(cls.charts.constants[charts], achievements)
+        # レートが同じなら達成率の高い順
+        top = np.lexsort((-achievements, -values))[:count]
+        return [
+            RatingEntry(
+                cls.charts.names[charts[index]],
+                cls.charts.difficulties[charts[index]],
+                float(cls.charts.constants[charts[index]]),
+                float(achievements[index]),
+                int(values[index]),
+            )
+            for index in top
+        ]
+
+    @classmethod
+    async def breakdown(cls, userId: int) -> RatingBreakdown:
+        bests = await cls.bests(userId)
+        isNew = cls.charts.isNew[bests.charts]
+        new = cls.entries(bests.charts[isNew], bests.achievements[isNew], newCount)
+        old = cls.entries(bests.charts[~isNew], bests.achievements[~isNew], oldCount)
+        total = sum(entry.rating for entry in new) + sum(entry.rating for entry in old)
+        return RatingBreakdown(total, new, old)
@@ -0,0 +1,72 @@
+from types import SimpleNamespace
+from typing import Any
+
+import asyncpg
+from otoge import NostalgiaClient, POPNClient, PolarisChordClient
+from otoge.maimai import MaiMaiAime, MaiMaiPlayRecord
+
+from services import konami, tracing
+from services.records import PlayRecords, playerStats
+from services.scheduler import Scheduler
+from services.segaSession import SegaSession, SegaSessions
+from services.singleflight import upstream
+
+konamiGames: dict[str, type] = {
+    "popn": POPNClient,
+    "polaris": PolarisChordClient,
+    "nostalgia": NostalgiaClient,
+}
+
+
+async def fetchMaimaiRecords(
+    session: SegaSession,
+) -> tuple[MaiMaiAime, list[MaiMaiPlayRecord]]:
+    async with Scheduler.slot("sega"):
+        with tracing.span("aime.record"):
+            return session.aime, await session.aime.record()
+
+
+async def syncMaimai(userId: int, row: asyncpg.Record) -> list[SimpleNamespace]:
+    """maimaiのプレイ履歴を取得して保存し、新しく保存された記録を返します。"""
+    aime, records = await upstream.do(
+        ("maimai", "records", userId),
+        lambda: SegaSessions.run(userId, row, fetchMaimaiRecords),
+    )
+    await PlayRecords.savePlayer(
+        userId, "maimai", aime.name, stats=playerStats("maimai", aime)
+    )
+    with tracing.span("ingest", records=len(records)):
+        return await PlayRecords.ingest(userId, "maimai", records)
+
+
+async def syncKonami(
+    game: str, userId: int, row: asyncpg.Record
+) -> list[SimpleNamespace]:
+    """KONAMIのゲームのプレイ履歴を取得して保存し、新しく保存された記録を返します。"""
+    clientClass = konamiGames[game]
+    profile: Any = await konami.fetchProfile(clientClass, userId, row)
+    if game == "popn":
+        records = await PlayRecords.changed(userId, game, profile.records)
+        iconUrl = profile.usedCharacters[0].iconUrl
+    else:
+        records = await konami.fetchPlayRecords(clientClass, userId, row)
+        iconUrl = None
+    await PlayRecords.savePlayer(
+        userId, game, profile.name, iconUrl, playerStats(game, profile)
+    )
+    with tracing.span("ingest", records=len(records)):
+        return await PlayRecords.ingest(
+            userId, game, records, getattr(profile, "lastPlayedAt", None)
+        )
+
+
+async def sync(game: str, userId: int, row: asyncpg.Record) -> list[SimpleNamespace]:
+    if game == "maimai":
+        return await syncMaimai(userId, row)
+    return await syncKonami(game, userId, row)
+
+
+async def ensureHistory(game: str, userId: int, row: asyncpg.Record):
+    """まだ一度も同期していないユーザーの場合は、その場で同期します。"""
+    if await PlayRecords.player(userId, game) is None:
+        await sync(game, userId, row)
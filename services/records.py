@@ -0,0 +1,356 @@
+from datetime import datetime, timezone
+from enum import Enum
+from types import SimpleNamespace
+from typing import Any, Callable
+from zoneinfo import ZoneInfo
+
+import asyncpg
+import orjson
+import otoge
+
+from services.database import Database
+
+# 各サイトの日時はタイムゾーンを持たない日本時間で返ってくる
+siteTimezone = ZoneInfo("Asia/Tokyo")
+
+# 日時のない記録 (pop'n musicのスコア一覧など) に使う日時
+unknownPlayedAt = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# ゲームごとに、記録から (musicId, 難易度) を取り出す方法
+recordKeys: dict[str, Callable[[Any], tuple[str, str]]] = {
+    "maimai": lambda record: (record.name, record.difficult),
+    "popn": lambda record: (record.name, "ALL"),
+    "polaris": lambda record: (str(record.musicId), record.chartDifficultyType.name),
+    "nostalgia": lambda record: (str(record.musicId), record.difficulty.name),
+}
+
+
+def toScore(value: Any) -> float | None:
+    """サイト上のスコア表記 ("100.5000%" や "-" など) を数値にします。"""
+    try:
+        return float(str(value).replace(",", "").rstrip("%"))
+    except ValueError:
+        return None
+
+
+def popnScores(record: Any) -> list[tuple[str, float | None]]:
+    return [
+        ("EASY", toScore(record.easyScore)),
+        ("NORMAL", toScore(record.normalScore)),
+        ("HYPER", toScore(record.hyperScore)),
+        ("EX", toScore(record.exScore)),
+    ]
+
+
+# ゲームごとに、記録から (難易度, スコア) の組を取り出す方法。ランキングに使う
+recordScores: dict[str, Callable[[Any], list[tuple[str, float | None]]]] = {
+    "maimai": lambda record: [(record.difficult, toScore(record.percentage))],
+    "popn": popnScores,
+    "polaris": lambda record: [
+        (record.chartDifficultyType.name, toScore(record.achievementRate))
+    ],
+    "nostalgia": lambda record: [(record.difficulty.name, toScore(record.score))],
+}
+
+# ゲームごとに、プレイヤー単位のランキングに使うプロフィールの属性
+statAttributes: dict[str, dict[str, str]] = {
+    "maimai": {"rating": "rating"},
+    "polaris": {"paskill": "paSkill"},
+}
+
+
+def playerStats(game: str, profile: Any) -> dict[str, float]:
+    stats = {}
+    for stat, attribute in statAttributes.get(game, {}).items():
+        value = toScore(getattr(profile, attribute, None))
+        if value is not None:
+            stats[stat] = value
+    return stats
+
+
+schema = """
+    CREATE TABLE IF NOT EXISTS play_records (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        game TEXT NOT NULL,
+        music_id TEXT NOT NULL,
+        difficulty TEXT NOT NULL,
+        played_at TIMESTAMPTZ NOT NULL,
+        name TEXT NOT NULL,
+        data JSONB NOT NULL,
+        UNIQUE (user_id, game, music_id, difficulty, played_at)
+    );
+    CREATE INDEX IF NOT EXISTS play_records_history
+        ON play_records (user_id, game, played_at DESC, id DESC);
+    CREATE TABLE IF NOT EXISTS players (
+        user_id BIGINT NOT NULL,
+        game TEXT NOT NULL,
+        name TEXT NOT NULL,
+        icon_url TEXT,
+        synced_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (user_id, game)
+    );
+    ALTER TABLE players ADD COLUMN IF NOT EXISTS stats JSONB NOT NULL DEFAULT '{}';
+    CREATE TABLE IF NOT EXISTS song_bests (
+        user_id BIGINT NOT NULL,
+        game TEXT NOT NULL,
+        music_id TEXT NOT NULL,
+        difficulty TEXT NOT NULL,
+        name TEXT NOT NULL,
+        score DOUBLE PRECISION NOT NULL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (user_id, game, music_id, difficulty)
+    );
+    CREATE INDEX IF NOT EXISTS song_bests_ranking
+        ON song_bests (game, name, difficulty, score DESC);
+    CREATE TABLE IF NOT EXISTS guild_members (
+        guild_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        PRIMARY KEY (guild_id, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS guild_members_user ON guild_members (user_id);
+    CREATE TABLE IF NOT EXISTS songs (
+        game TEXT NOT NULL,
+        music_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        jacket_url TEXT,
+        PRIMARY KEY (game, music_id)
+    );
+"""
+
+
+def dump(value: Any) -> Any:
+    """otogeの記録をJSONにできる形へ変換します。"""
+    if isinstance(value, Enum):
+        return {"enum": type(value).__name__, "name": value.name}
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    if isinstance(value, (list, tuple)):
+        return [dump(item) for item in value]
+    if isinstance(value, dict):
+        return {key: dump(item) for key, item in value.items()}
+    if hasattr(value, "__dict__"):
+        return {
+            key: dump(item)
+            for key, item in vars(value).items()
+            if not key.startswith("_")
+        }
+    return value
+
+
+def load(value: Any) -> Any:
+    """dumpで変換したものを、属性でアクセスできる形に戻します。"""
+    if isinstance(value, list):
+        return [load(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if value.keys() == {"enum", "name"}:
+        enum = getattr(otoge, value["enum"], None)
+        if enum is not None and value["name"] in enum.__members__:
+            return enum[value["name"]]
+        return SimpleNamespace(name=value["name"])
+    if value.keys() == {"datetime"}:
+        return datetime.fromisoformat(value["datetime"])
+    return SimpleNamespace(**{key: load(item) for key, item in value.items()})
+
+
+def toAware(playedAt: datetime | None) -> datetime:
+    if playedAt is None:
+        return unknownPlayedAt
+    if playedAt.tzinfo is None:
+        return playedAt.replace(tzinfo=siteTimezone)
+    return playedAt
+
+
+class PlayRecords:
+    """プレイ履歴をPostgresに保存し、読み出します。"""
+
+    @classmethod
+    async def createTables(cls):
+        # 全クラスターが同時に起動するので、テーブルの作成と埋め戻しは一つずつ行う
+        async with Database.lock("schema"):
+            await Database.pool.execute(schema)
+            await cls.backfillBests()
+            if not await Database.fetchval("hasSongs"):
+                await Database.execute("backfillSongs")
+
+    @classmethod
+    async def backfillBests(cls):
+        """ランキング用のベストスコアを、保存済みのプレイ履歴から一度だけ作ります。
+        以降はingestのたびに差分だけ更新されます。
+        """
+        if await Database.fetchval("hasSongBests"):
+            return
+        lastId = 0
+        while True:
+            rows = await Database.fetch("recordsAfter", lastId, 5000)
+            if not rows:
+                return
+            batches: dict[tuple[int, str], list[SimpleNamespace]] = {}
+            for row in rows:
+                batches.setdefault((row["user_id"], row["game"]), []).append(
+                    load(orjson.loads(row["data"]))
+                )
+            for (userId, game), records in batches.items():
+                await cls.saveBests(userId, game, records)
+            lastId = rows[-1]["id"]
+
+    @classmethod
+    async def ingest(
+        cls,
+        userId: int,
+        game: str,
+        records: list[Any],
+        fallbackPlayedAt: datetime | None = None,
+    ) -> list[SimpleNamespace]:
+        """記録をまとめて保存し、新しく保存されたものを返します。"""
+        rows = []
+        # サイトは新しい順に返すので、古いものから保存してidの順序を揃える
+        for record in reversed(records):
+            musicId, difficulty = recordKeys[game](record)
+            playedAt = toAware(getattr(record, "playedAt", None) or fallbackPlayedAt)
+            rows.append(
+                (
+                    userId,
+                    game,
+                    musicId,
+                    difficulty,
+                    playedAt,
+                    record.name,
+                    orjson.dumps(dump(record)).decode(),
+                )
+            )
+        if not rows:
+            return []
+
+        async with Database.pool.acquire() as connection:
+            async with connection.transaction():
+                await Database.execute("createRecordStaging", connection=connection)
+                await connection.copy_records_to_table(
+                    "play_records_staging",
+                    records=rows,
+                    columns=[
+                        "user_id",
+                        "game",
+                        "music_id",
+                        "difficulty",
+                        "played_at",
+                        "name",
+                        "data",
+                    ],
+                )
+                inserted = await Database.fetch(
+                    "insertStagedRecords", connection=connection
+                )
+                saved = [load(orjson.loads(row["data"])) for row in inserted]
+                await cls.saveBests(userId, game, saved, connection=connection)
+                await cls.saveSongs(game, saved, connection=connection)
+        return saved
+
+    @classmethod
+    async def changed(cls, userId: int, game: str, records: list[Any]) -> list[Any]:
+        """日時のない記録のうち、保存済みのベストよりスコアが上がったものだけを返します。
+        pop'n musicのスコア一覧は同期のたびに全曲分が返ってくるので、そのまま保存すると
+        最終プレイ日時が変わるたびに全曲が重複して保存されてしまいます。
+        """
+        rows = await Database.fetch("userSongBests", userId, game)
+        bests = {(row["music_id"], row["difficulty"]): row["score"] for row in rows}
+        return [
+            record
+            for record in records
+            if any(
+                score is not None
+                and score > bests.get((recordKeys[game](record)[0], difficulty), -1)
+                for difficulty, score in recordScores[game](record)
+            )
+        ]
+
+    @classmethod
+    async def saveBests(
+        cls,
+        userId: int,
+        game: str,
+        records: list[Any],
+        connection: asyncpg.Connection | None = None,
+    ):
+        """記録のスコアで、譜面ごとのベストスコアを更新します。"""
+        bests: dict[tuple[str, str], tuple[str, float]] = {}
+        for record in records:
+            musicId, _ = recordKeys[game](record)
+            for difficulty, score in recordScores[game](record):
+                if score is None:
+                    continue
+                best = bests.get((musicId, difficulty))
+                if best is None or score > best[1]:
+                    bests[(musicId, difficulty)] = (record.name, score)
+        if not bests:
+            return
+        await Database.execute(
+            "saveSongBests",
+            userId,
+            game,
+            [musicId for musicId, _ in bests],
+            [difficulty for _, difficulty in bests],
+            [name for name, _ in bests.values()],
+            [score for _, score in bests.values()],
+            connection=connection,
+        )
+
+    @classmethod
+    async def saveSongs(
+        cls,
+        game: str,
+        records: list[Any],
+        connection: asyncpg.Connection | None = None,
+    ):
+        """記録に含まれる曲を、曲の一覧に追加します。"""
+        songs = {recordKeys[game](record)[0]: record for record in records}
+        if not songs:
+            return
+        await Database.execute(
+            "saveSongs",
+            game,
+            list(songs),
+            [record.name for record in songs.values()],
+            [getattr(record, "jacketUrl", None) for record in songs.values()],
+            connection=connection,
+        )
+
+    @classmethod
+    async def savePlayer(
+        cls,
+        userId: int,
+        game: str,
+        name: str,
+        iconUrl: str | None = None,
+        stats: dict[str, float] | None = None,
+    ):
+        await Database.execute(
+            "savePlayer",
+            userId,
+            game,
+            name,
+            iconUrl,
+            orjson.dumps(stats or {}).decode(),
+        )
+
+    @classmethod
+    async def player(cls, userId: int, game: str):
+        return await Database.fetchrow("player", userId, game)
+
+    @classmethod
+    async def snapshot(cls, userId: int, game: str) -> tuple[int, int]:
+        """現時点の最新の記録のidと件数を返します。
+        ページ送りはこのidより後に取り込まれた記録を無視します。
+        """
+        row = await Database.fetchrow("recordSnapshot", userId, game)
+        return row["snapshot"], row["total"]
+
+    @classmethod
+    async def history(
+        cls, userId: int, game: str, snapshot: int, limit: int, offset: int = 0
+    ) -> list[SimpleNamespace]:
+        rows = await Database.fetch(
+            "recordHistory", userId, game, snapshot, limit, offset
+        )
+        return [load(orjson.loads(row["data"])) for row in rows]
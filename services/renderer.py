@@ -0,0 +1,191 @@
+import asyncio
+import io
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import dotenv
+from PIL import Image, ImageDraw, ImageFont
+
+from services import tracing
+from services.imageCache import ImageCache
+
+dotenv.load_dotenv()
+
+columns = 2
+cellWidth = 480
+cellHeight = 120
+headerHeight = 56
+jacketSize = 100
+padding = 10
+background = (30, 31, 34)
+cellBackground = (43, 45, 49)
+textColour = (242, 243, 245)
+subTextColour = (181, 186, 193)
+
+
+@dataclass
+class Card:
+    """記録カード一枚分の内容です。ワーカープロセスに渡すので、単純な値だけを持ちます。"""
+
+    title: str
+    lines: list[str]
+    colour: int
+    jacketUrl: str | None = None
+    badges: list[str] = field(default_factory=list)
+
+
+# 以下はワーカープロセス内でだけ使う状態
+fonts: dict[str, ImageFont.ImageFont] = {}
+jackets: OrderedDict[str, Image.Image] = OrderedDict()
+jacketCacheSize = 256
+
+
+def preload(fontPath: str | None):
+    """ワーカーの起動時に一度だけフォントを読み込みます。"""
+    for name, size in (("header", 28), ("title", 18), ("text", 15), ("badge", 13)):
+        if fontPath:
+            fonts[name] = ImageFont.truetype(fontPath, size)
+        else:
+            # 日本語の曲名を表示するには、card_font_pathにCJKフォントを指定する
+            fonts[name] = ImageFont.load_default(size)
+
+
+def jacket(path: str) -> Image.Image | None:
+    image = jackets.get(path)
+    if image is not None:
+        jackets.move_to_end(path)
+        return image
+    try:
+        with Image.open(path) as source:
+            image = source.convert("RGBA")
+    except (OSError, ValueError):
+        return None
+    image.thumbnail((jacketSize, jacketSize), Image.Resampling.LANCZOS)
+    jackets[path] = image
+    while len(jackets) > jacketCacheSize:
+        jackets.popitem(last=False)
+    return image
+
+
+def fit(text: str, font: ImageFont.ImageFont, width: int) -> str:
+    if font.getlength(text) <= width:
+        return text
+    while text and font.getlength(f"{text}…") > width:
+        text = text[:-1]
+    return f"{text}…"
+
+
+def drawCard(
+    draw: ImageDraw.ImageDraw,
+    canvas: Image.Image,
+    card: Card,
+    path: str | None,
+    x: int,
+    y: int,
+):
+    colour = ((card.colour >> 16) & 255, (card.colour >> 8) & 255, card.colour & 255)
+    draw.rounded_rectangle(
+        (x, y, x + cellWidth - padding, y + cellHeight - padding),
+        radius=8,
+        fill=cellBackground,
+    )
+    draw.rectangle((x, y + 8, x + 4, y + cellHeight - padding - 8), fill=colour)
+
+    textX = x + padding + 4
+    image = jacket(path) if path is not None else None
+    if image is not None:
+        top = y + (cellHeight - padding - image.height) // 2
+        canvas.paste(image, (textX, top), image)
+        textX += jacketSize + padding
+    textWidth = x + cellWidth - padding * 2 - textX
+
+    draw.text(
+        (textX, y + 8),
+        fit(card.title, fonts["title"], textWidth),
+        textColour,
+        fonts["title"],
+    )
+    for index, line in enumerate(card.lines[:3]):
+        draw.text(
+            (textX, y + 34 + index * 20),
+            fit(line, fonts["text"], textWidth),
+            subTextColour,
+            fonts["text"],
+        )
+
+    badgeX = x + cellWidth - padding * 2
+    for badge in reversed(card.badges):
+        width = int(fonts["badge"].getlength(badge)) + 12
+        badgeX -= width
+        draw.rounded_rectangle(
+            (badgeX, y + 8, badgeX + width, y + 26), radius=4, fill=colour
+        )
+        draw.text((badgeX + 6, y + 10), badge, textColour, fonts["badge"])
+        badgeX -= 4
+
+
+def draw(title: str, cards: list[Card], jacketPaths: list[str | None]) -> bytes:
+    """記録カードを格子状に並べたPNGを作ります。ワーカープロセスで呼ばれます。"""
+    rows = (len(cards) + columns - 1) // columns
+    canvas = Image.new(
+        "RGB",
+        (columns * cellWidth + padding, headerHeight + rows * cellHeight + padding),
+        background,
+    )
+    context = ImageDraw.Draw(canvas)
+    context.text((padding * 2, 14), title, textColour, fonts["header"])
+    for index, (card, path) in enumerate(zip(cards, jacketPaths)):
+        x = padding + index % columns * cellWidth
+        y = headerHeight + index // columns * cellHeight
+        drawCard(context, canvas, card, path, x, y)
+
+    buffer = io.BytesIO()
+    canvas.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+class Renderer:
+    """記録カード画像の描画を、フォントを読み込み済みのプロセスプールで行います。"""
+
+    pool: ProcessPoolExecutor = None
+
+    @classmethod
+    def open(cls):
+        # 親のイベントループやスレッド、ソケットを引き継がないように、forkを使わない
+        cls.pool = ProcessPoolExecutor(
+            max_workers=int(os.getenv("renderer_workers", "2")),
+            initializer=preload,
+            initargs=(os.getenv("card_font_path"),),
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+
+    @classmethod
+    async def jacketPath(cls, url: str | None) -> str | None:
+        if url is None:
+            return None
+        try:
+            entry, _ = await ImageCache.fetch(url)
+        except Exception:
+            # ジャケットが取れなくてもカードは描画する
+            return None
+        return str(entry.path)
+
+    @classmethod
+    async def render(cls, title: str, cards: list[Card]) -> bytes:
+        with tracing.span("renderer.jackets", cards=len(cards)):
+            jacketPaths = await asyncio.gather(
+                *(cls.jacketPath(card.jacketUrl) for card in cards)
+            )
+        loop = asyncio.get_running_loop()
+        with tracing.span("renderer.draw", cards=len(cards)):
+            return await loop.run_in_executor(
+                cls.pool, draw, title, cards, list(jacketPaths)
+            )
+
+    @classmethod
+    def close(cls):
+        if cls.pool is not None:
+            cls.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from enum import IntEnum
+
+import dotenv
+
+from services import metrics, tracing
+
+dotenv.load_dotenv()
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+# バックグラウンド処理はこれをBACKGROUNDにしてから上流を呼び出す
+currentPriority: ContextVar[Priority] = ContextVar(
+    "currentPriority", default=Priority.INTERACTIVE
+)
+
+
+class FlightPriority:
+    """SingleFlightでまとめられた処理の優先度です。
+    まとめられた処理は最初の呼び出し元の優先度を引き継ぐので、後から優先度の高い
+    呼び出し元が加わった場合は、待機中の枠も含めて優先度を引き上げます。
+    """
+
+    def __init__(self, priority: Priority):
+        self.priority = priority
+        self.waiters: list[tuple["UpstreamLimiter", asyncio.Future]] = []
+        # この処理の中で待っている、別のキーのまとめられた処理
+        self.children: list["FlightPriority"] = []
+
+    def raiseTo(self, priority: Priority):
+        if priority >= self.priority:
+            return
+        self.priority = priority
+        for limiter, future in self.waiters:
+            limiter.enqueue(priority, future)
+        for child in self.children:
+            child.raiseTo(priority)
+
+
+# SingleFlightのタスクの中では、その処理のFlightPriorityが入る
+currentFlight: ContextVar[FlightPriority | None] = ContextVar(
+    "currentFlight", default=None
+)
+
+
+def effectivePriority() -> Priority:
+    flight = currentFlight.get()
+    if flight is not None:
+        return flight.priority
+    return currentPriority.get()
+
+
+class UpstreamLimiter:
+    """トークンバケットと同時実行数の上限で、一つの上流への呼び出しを絞ります。
+    待機中の呼び出しは優先度の高いものから順に実行されます。
+    """
+
+    def __init__(self, name: str, rate: float, burst: int, concurrency: int):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.tokens = float(burst)
+        self.updatedAt = time.monotonic()
+        self.active = 0
+        self.waiters: list[tuple[int, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.timer: asyncio.TimerHandle | None = None
+        self.completed = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updatedAt) * self.rate)
+        self.updatedAt = now
+
+    def dispatch(self):
+        self.timer = None
+        while self.waiters and self.active < self.concurrency:
+            if self.waiters[0][2].done():
+                heapq.heappop(self.waiters)
+                continue
+            self.refill()
+            if self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                self.timer = asyncio.get_running_loop().call_later(delay, self.dispatch)
+                return
+            _, _, future = heapq.heappop(self.waiters)
+            self.tokens -= 1
+            self.active += 1
+            future.set_result(None)
+
+    def enqueue(self, priority: Priority, future: asyncio.Future):
+        # 優先度を引き上げる場合は同じfutureを積み直す。古い方は取り出したときに捨てる
+        if future.done():
+            return
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        if self.timer is None:
+            self.dispatch()
+
+    def release(self):
+        self.active -= 1
+        if self.timer is None:
+            self.dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority | None = None):
+        flight = currentFlight.get()
+        if priority is None:
+            priority = effectivePriority()
+        future = asyncio.get_running_loop().create_future()
+        startedAt = time.monotonic()
+        self.enqueue(priority, future)
+        if flight is not None:
+            flight.waiters.append((self, future))
+        try:
+            with tracing.span("scheduler.wait", upstream=self.name):
+                await future
+        except asyncio.CancelledError:
+            # 枠を渡された直後にキャンセルされた場合は、枠を返す
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            if flight is not None:
+                flight.waiters.remove((self, future))
+
+        waited = time.monotonic() - startedAt
+        self.completed += 1
+        self.totalWait += waited
+        self.maxWait = max(self.maxWait, waited)
+        metrics.upstreamWait.labels(self.name).observe(waited)
+        startedAt = time.monotonic()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            metrics.upstreamLatency.labels(self.name, outcome).observe(
+                time.monotonic() - startedAt
+            )
+            self.release()
+
+    def stats(self) -> dict[str, float]:
+        return {
+            # 優先度を引き上げた待機者は二重に積まれているので、futureで数える
+            "queued": len(
+                {id(future) for *_, future in self.waiters if not future.done()}
+            ),
+            "active": self.active,
+            "tokens": self.tokens,
+            "completed": self.completed,
+            "averageWait": self.totalWait / self.completed if self.completed else 0.0,
+            "maxWait": self.maxWait,
+        }
+
+
+def createLimiter(name: str) -> UpstreamLimiter:
+    return UpstreamLimiter(
+        name,
+        rate=float(os.getenv(f"{name}_rate", "5")),
+        burst=int(os.getenv(f"{name}_burst", "10")),
+        concurrency=int(os.getenv(f"{name}_concurrency", "8")),
+    )
+
+
+class Scheduler:
+    """上流ごとのリミッターをまとめます。"""
+
+    limiters: dict[str, UpstreamLimiter] = {
+        "sega": createLimiter("sega"),
+        "eagate": createLimiter("eagate"),
+    }
+
+    @classmethod
+    def slot(cls, upstream: str, priority: Priority | None = None):
+        return cls.limiters[upstream].slot(priority)
+
+    @classmethod
+    def stats(cls) -> dict[str, dict[str, float]]:
+        return {name: limiter.stats() for name, limiter in cls.limiters.items()}
@@ -0,0 +1,152 @@
+import os
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, TypeVar
+from urllib.parse import urlsplit
+
+import asyncpg
+import dotenv
+from cryptography.fernet import Fernet
+from httpx import HTTPStatusError, Response
+from otoge import MaiMaiClient
+from otoge.maimai import MaiMaiAime
+
+from services import tracing
+from services.http import countResponses
+from services.scheduler import Scheduler
+from services.singleflight import upstream
+
+dotenv.load_dotenv()
+
+T = TypeVar("T")
+
+cipherSuite = Fernet(os.getenv("fernet_key").encode())
+
+# セッションが切れていると、SEGAはこのホストのログインページへリダイレクトする
+loginHost = "lng-tgk-aime-gw.am-all.net"
+
+
+class SessionRejected(Exception):
+    """SEGAにセッションを拒否されたことを表します。"""
+
+
+def rejectedResponse(response: Response) -> bool:
+    """レスポンスが、ログインの切れたセッションへの拒否かどうかを返します。"""
+    if response.status_code in (401, 403):
+        return True
+    if response.is_redirect:
+        return urlsplit(response.headers.get("location", "")).netloc == loginHost
+    return bool(response.history) and response.url.host == loginHost
+
+
+def rejected(error: Exception) -> bool:
+    """エラーが、セッションを拒否されたことによるものかどうかを返します。"""
+    if isinstance(error, SessionRejected):
+        return True
+    if isinstance(error, HTTPStatusError):
+        return rejectedResponse(error.response)
+    # otogeはログインが切れたページを受け取ると、ログインを求めるエラーを投げる
+    return "login" in type(error).__name__.lower() or "ログイン" in str(error)
+
+
+@dataclass
+class SegaSession:
+    client: MaiMaiClient
+    aime: MaiMaiAime
+    fingerprint: tuple[str, str, int]
+    lastUsedAt: float
+    createdAt: float
+
+
+class SegaSessions:
+    """ログイン済みのMaiMaiClientをDiscordユーザーごとに保持して使い回します。"""
+
+    ttl: float = float(os.getenv("sega_session_ttl", "1800"))
+    # 使い続けていても、名前や称号などのaimeの情報を読み直すためにログインし直す
+    maxAge: float = float(os.getenv("sega_session_max_age", "3600"))
+    sessions: dict[int, SegaSession] = {}
+
+    @staticmethod
+    def fingerprint(row: asyncpg.Record) -> tuple[str, str, int]:
+        # 暗号文はリンクし直すたびに変わるので、そのまま比較に使える
+        return (row["segaid"], row["password"], row["aime"])
+
+    @classmethod
+    def invalidate(cls, userId: int):
+        cls.sessions.pop(userId, None)
+
+    @classmethod
+    def expired(cls, session: SegaSession, now: float) -> bool:
+        return (
+            now - session.lastUsedAt >= cls.ttl
+            or now - session.createdAt >= cls.maxAge
+        )
+
+    @classmethod
+    def sweep(cls):
+        now = time.monotonic()
+        for userId, session in list(cls.sessions.items()):
+            if cls.expired(session, now):
+                del cls.sessions[userId]
+
+    @classmethod
+    async def login(cls, userId: int, row: asyncpg.Record) -> SegaSession:
+        client = countResponses(MaiMaiClient())
+        with tracing.span("decrypt"):
+            segaId = cipherSuite.decrypt(row["segaid"].encode()).decode()
+            password = cipherSuite.decrypt(row["password"].encode()).decode()
+        async with Scheduler.slot("sega"):
+            with tracing.span("MaiMaiClient.login"):
+                aimeList = await client.login(segaId, password)
+        aime: MaiMaiAime = aimeList[row["aime"]]
+        async with Scheduler.slot("sega"):
+            with tracing.span("aime.select"):
+                await aime.select()
+        now = time.monotonic()
+        session = SegaSession(client, aime, cls.fingerprint(row), now, now)
+        cls.sweep()
+        cls.sessions[userId] = session
+        return session
+
+    @classmethod
+    async def acquire(
+        cls, userId: int, row: asyncpg.Record
+    ) -> tuple[SegaSession, bool]:
+        """セッションを取得します。2つ目の値は既存のセッションを使い回したかどうかです。
+        同じユーザーの同時のログインは一つにまとめられます。
+        """
+        session = cls.sessions.get(userId)
+        if (
+            session is not None
+            and session.fingerprint == cls.fingerprint(row)
+            and not cls.expired(session, time.monotonic())
+        ):
+            session.lastUsedAt = time.monotonic()
+            return session, True
+        session = await upstream.do(
+            ("sega", "login", userId, cls.fingerprint(row)),
+            lambda: cls.login(userId, row),
+        )
+        return session, False
+
+    @classmethod
+    async def run(
+        cls,
+        userId: int,
+        row: asyncpg.Record,
+        action: Callable[[SegaSession], Awaitable[T]],
+    ) -> T:
+        """セッションを使って処理を実行します。
+        使い回したセッションが拒否された場合は、ログインし直して一度だけ再試行します。
+        それ以外のエラーでは、ログインし直さずにそのまま投げます。
+        """
+        session, reused = await cls.acquire(userId, row)
+        try:
+            return await action(session)
+        except Exception as e:
+            if not reused or not rejected(e):
+                raise
+            if cls.sessions.get(userId) is session:
+                cls.invalidate(userId)
+        session, _ = await cls.acquire(userId, row)
+        return await action(session)
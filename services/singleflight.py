@@ -0,0 +1,55 @@
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from services.scheduler import FlightPriority, currentFlight, effectivePriority
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """同じキーで同時に呼ばれた処理を、実行中の一つのタスクにまとめます。
+    結果は共有されますが、保存はされません。
+    """
+
+    def __init__(self):
+        self.inFlight: dict[Hashable, tuple[asyncio.Task, FlightPriority]] = {}
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[T]]) -> T:
+        priority = effectivePriority()
+        entry = self.inFlight.get(key)
+        if entry is None:
+            flight = FlightPriority(priority)
+
+            async def run() -> T:
+                currentFlight.set(flight)
+                return await factory()
+
+            task = asyncio.create_task(run())
+            self.inFlight[key] = (task, flight)
+            task.add_done_callback(lambda task: self.finished(key, task))
+        else:
+            # 後から加わった呼び出し元の方が優先度が高ければ、処理全体を引き上げる
+            task, flight = entry
+            flight.raiseTo(priority)
+
+        parent = currentFlight.get()
+        if parent is not None:
+            parent.children.append(flight)
+        try:
+            # 呼び出し元の一つがキャンセルされても、他の待機者の処理は止めない
+            return await asyncio.shield(task)
+        finally:
+            if parent is not None:
+                parent.children.remove(flight)
+
+    def finished(self, key: Hashable, task: asyncio.Task):
+        entry = self.inFlight.get(key)
+        if entry is not None and entry[0] is task:
+            del self.inFlight[key]
+        if not task.cancelled():
+            # 待機者が全員キャンセルされた場合の未取得例外の警告を抑える
+            task.exception()
+
+
+# otogeクライアントへの呼び出し (ログイン・プロフィール・プレイ履歴) 用
+upstream = SingleFlight()
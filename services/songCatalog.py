@@ -0,0 +1,217 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+import unicodedata
+from collections import Counter
+from dataclasses import dataclass
+
+import dotenv
+
+from services.database import Database
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# ジャケット画像のURLが曲のIDから決まるゲーム
+jacketTemplates: dict[str, str] = {
+    "polaris": (
+        "https://p.eagate.573.jp/game/polarischord/pc/img/music/jacket.html?c={}"
+    ),
+    "nostalgia": "https://p.eagate.573.jp/game/nostalgia/op3/img/jacket.html?c={}",
+}
+
+romajiTable: dict[str, str] = dict(
+    pair.split(":")
+    for pair in (
+        "あ:a い:i う:u え:e お:o か:ka き:ki く:ku け:ke こ:ko "
+        "さ:sa し:shi す:su せ:se そ:so た:ta ち:chi つ:tsu て:te と:to "
+        "な:na に:ni ぬ:nu ね:ne の:no は:ha ひ:hi ふ:fu へ:he ほ:ho "
+        "ま:ma み:mi む:mu め:me も:mo や:ya ゆ:yu よ:yo "
+        "ら:ra り:ri る:ru れ:re ろ:ro わ:wa を:wo ん:n "
+        "が:ga ぎ:gi ぐ:gu げ:ge ご:go ざ:za じ:ji ず:zu ぜ:ze ぞ:zo "
+        "だ:da ぢ:ji づ:zu で:de ど:do ば:ba び:bi ぶ:bu べ:be ぼ:bo "
+        "ぱ:pa ぴ:pi ぷ:pu ぺ:pe ぽ:po ゔ:vu "
+        "ぁ:a ぃ:i ぅ:u ぇ:e ぉ:o ゃ:ya ゅ:yu ょ:yo ゎ:wa "
+        "きゃ:kya きゅ:kyu きょ:kyo しゃ:sha しゅ:shu しょ:sho "
+        "ちゃ:cha ちゅ:chu ちょ:cho にゃ:nya にゅ:nyu にょ:nyo "
+        "ひゃ:hya ひゅ:hyu ひょ:hyo みゃ:mya みゅ:myu みょ:myo "
+        "りゃ:rya りゅ:ryu りょ:ryo ぎゃ:gya ぎゅ:gyu ぎょ:gyo "
+        "じゃ:ja じゅ:ju じょ:jo びゃ:bya びゅ:byu びょ:byo "
+        "ぴゃ:pya ぴゅ:pyu ぴょ:pyo ふぁ:fa ふぃ:fi ふぇ:fe ふぉ:fo "
+        "てぃ:ti でぃ:di とぅ:tu どぅ:du うぃ:wi うぇ:we ゔぁ:va ゔぃ:vi "
+        "ゔぇ:ve ゔぉ:vo しぇ:she じぇ:je ちぇ:che"
+    ).split()
+)
+
+
+def normalize(text: str) -> str:
+    """全角・半角や大文字・小文字、カタカナ・ひらがなの違いをなくします。"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = "".join(
+        chr(ord(char) - 0x60) if "ァ" <= char <= "ヶ" else char for char in text
+    )
+    return "".join(char for char in text if char.isalnum() or char == "ー")
+
+
+def toRomaji(text: str) -> str:
+    """正規化済みの文字列のひらがなをローマ字にします。それ以外の文字はそのまま残します。"""
+    result = []
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if text[index : index + 2] in romajiTable:
+            result.append(romajiTable[text[index : index + 2]])
+            index += 2
+            continue
+        if char == "っ" and index + 1 < len(text):
+            # 促音は次の子音を重ねる
+            following = toRomaji(text[index + 1 : index + 3])
+            result.append(following[:1] if following[:1].isalpha() else "")
+        elif char == "ー" and result:
+            result.append(result[-1][-1:])
+        else:
+            result.append(romajiTable.get(char, char))
+        index += 1
+    return "".join(result)
+
+
+def searchForms(text: str) -> tuple[str, ...]:
+    normalized = normalize(text)
+    romaji = toRomaji(normalized)
+    return (normalized,) if romaji == normalized else (normalized, romaji)
+
+
+def grams(text: str) -> set[str]:
+    """一文字と二文字の部分文字列です。短い入力でも候補を絞れるように一文字も含めます。"""
+    return set(text) | {text[index : index + 2] for index in range(len(text) - 1)}
+
+
+@dataclass
+class Song:
+    game: str
+    musicId: str
+    name: str
+    jacketUrl: str | None = None
+
+
+class SongIndex:
+    """一つのゲームの曲名を、n-gramの転置索引で曖昧検索します。
+    前方一致は、並べ替えた検索用の文字列を二分探索して探します。
+    """
+
+    def __init__(self, songs: list[Song]):
+        self.songs = sorted(songs, key=lambda song: normalize(song.name))
+        self.forms = [searchForms(song.name) for song in self.songs]
+        self.postings: dict[str, list[int]] = {}
+        for index, forms in enumerate(self.forms):
+            for gram in set().union(*(grams(form) for form in forms)):
+                self.postings.setdefault(gram, []).append(index)
+        self.sortedForms = sorted(
+            (form, index) for index, forms in enumerate(self.forms) for form in forms
+        )
+        self.byName = {song.name: song for song in self.songs}
+
+    def prefixed(self, queryForm: str, limit: int) -> list[int]:
+        start = bisect.bisect_left(self.sortedForms, (queryForm,))
+        matches = []
+        for form, index in self.sortedForms[start : start + limit]:
+            if not form.startswith(queryForm):
+                break
+            matches.append(index)
+        return matches
+
+    def search(self, query: str, limit: int = 25) -> list[Song]:
+        queryForms = [form for form in searchForms(query) if form]
+        if not queryForms:
+            return self.songs[:limit]
+        counts = Counter()
+        for gram in set().union(*(grams(form) for form in queryForms)):
+            counts.update(self.postings.get(gram, ()))
+
+        def score(index: int) -> tuple[int, int, int]:
+            forms = self.forms[index]
+            prefix = any(
+                form.startswith(queryForm) for form in forms for queryForm in queryForms
+            )
+            contains = any(
+                queryForm in form for form in forms for queryForm in queryForms
+            )
+            return (prefix + contains, counts[index], -index)
+
+        # 前方一致するものと、一致するn-gramが多いものだけを詳しく比べる
+        candidates = {index for index, _ in counts.most_common(limit * 8)}
+        for queryForm in queryForms:
+            candidates.update(self.prefixed(queryForm, limit))
+        candidates = sorted(candidates, key=score, reverse=True)
+        return [self.songs[index] for index in candidates[:limit]]
+
+
+class SongCatalog:
+    """取り込んだプレイ履歴から作った曲の一覧を、ゲームごとにメモリ上で索引にします。
+    古くなった索引はそのまま使いながら、裏で作り直します。
+    """
+
+    ttl: float = float(os.getenv("song_catalog_ttl", "600"))
+    indexes: dict[str, SongIndex] = {}
+    loadedAt: float = float("-inf")
+    refreshing: asyncio.Task | None = None
+
+    @staticmethod
+    def jacketUrl(game: str, musicId: str, stored: str | None = None) -> str | None:
+        if stored is not None:
+            return stored
+        template = jacketTemplates.get(game)
+        return template.format(musicId) if template is not None else None
+
+    @classmethod
+    def build(cls, rows: list) -> dict[str, SongIndex]:
+        songs: dict[str, list[Song]] = {}
+        for row in rows:
+            songs.setdefault(row["game"], []).append(
+                Song(
+                    row["game"],
+                    row["music_id"],
+                    row["name"],
+                    cls.jacketUrl(row["game"], row["music_id"], row["jacket_url"]),
+                )
+            )
+        return {game: SongIndex(items) for game, items in songs.items()}
+
+    @classmethod
+    async def load(cls):
+        rows = await Database.fetch("songs")
+        # 数千曲分の索引を作るのには時間がかかるので、イベントループを止めないようにする
+        cls.indexes = await asyncio.to_thread(cls.build, rows)
+        cls.loadedAt = time.monotonic()
+
+    @classmethod
+    def refresh(cls) -> asyncio.Task:
+        if cls.refreshing is None:
+            cls.refreshing = asyncio.create_task(cls.load())
+            cls.refreshing.add_done_callback(cls.finished)
+        return cls.refreshing
+
+    @classmethod
+    def finished(cls, task: asyncio.Task):
+        cls.refreshing = None
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("failed to load the song catalog", exc_info=task.exception())
+
+    @classmethod
+    async def index(cls, game: str) -> SongIndex:
+        if cls.loadedAt == float("-inf"):
+            await asyncio.shield(cls.refresh())
+        elif time.monotonic() - cls.loadedAt >= cls.ttl:
+            cls.refresh()
+        return cls.indexes.get(game) or SongIndex([])
+
+    @classmethod
+    async def search(cls, game: str, query: str, limit: int = 25) -> list[Song]:
+        return (await cls.index(game)).search(query, limit)
+
+    @classmethod
+    async def song(cls, game: str, name: str) -> Song | None:
+        return (await cls.index(game)).byName.get(name)
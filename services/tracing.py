@@ -0,0 +1,122 @@
+import logging
+import os
+import random
+import secrets
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any
+
+import dotenv
+import orjson
+
+dotenv.load_dotenv()
+
+logger = logging.getLogger("otogebot.trace")
+
+# 0なら記録しない。1なら全てのインタラクション・リクエストを記録する
+sampleRate = float(os.getenv("tracing_sample_rate", "0"))
+# json: ログにJSONで出力する / otlp: OpenTelemetryのOTLPで送信する
+exporter = os.getenv("tracing_exporter", "json")
+
+tracer = None
+if sampleRate > 0 and exporter == "otlp":
+    # OpenTelemetryはOTLPで送る場合にのみ必要
+    from opentelemetry import trace
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    provider = TracerProvider(resource=Resource.create({"service.name": "otogebot"}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    tracer = provider.get_tracer("otogebot")
+
+
+@dataclass
+class Span:
+    name: str
+    traceId: str
+    spanId: str
+    parentId: str | None
+    sampled: bool
+    attributes: dict[str, Any] = field(default_factory=dict)
+    startedAt: float = field(default_factory=time.time)
+    otel: Any = None
+
+
+currentSpan: ContextVar[Span | None] = ContextVar("currentSpan", default=None)
+
+
+def startSpan(name: str, **attributes: Any) -> Span:
+    """スパンを開始して、現在のスパンにします。"""
+    parent = currentSpan.get()
+    if parent is None:
+        span = Span(
+            name,
+            secrets.token_hex(16),
+            secrets.token_hex(8),
+            None,
+            random.random() < sampleRate,
+            attributes,
+        )
+    else:
+        span = Span(
+            name,
+            parent.traceId,
+            secrets.token_hex(8),
+            parent.spanId,
+            parent.sampled,
+            attributes,
+        )
+    if span.sampled and tracer is not None:
+        context = trace.set_span_in_context(parent.otel) if parent else None
+        span.otel = tracer.start_span(name, context=context, attributes=attributes)
+    currentSpan.set(span)
+    return span
+
+
+def endSpan(span: Span, error: BaseException | None = None):
+    if not span.sampled:
+        return
+    if span.otel is not None:
+        if error is not None:
+            span.otel.record_exception(error)
+            span.otel.set_status(trace.StatusCode.ERROR)
+        span.otel.end()
+        return
+    logger.info(
+        orjson.dumps(
+            {
+                "name": span.name,
+                "traceId": span.traceId,
+                "spanId": span.spanId,
+                "parentId": span.parentId,
+                "startedAt": span.startedAt,
+                "durationMs": (time.time() - span.startedAt) * 1000,
+                "error": repr(error) if error is not None else None,
+                "attributes": span.attributes,
+            },
+            default=str,
+        ).decode()
+    )
+
+
+@contextmanager
+def span(name: str, **attributes: Any):
+    """処理の一区切りを計測します。サンプリングされなかった場合は何もしません。"""
+    parent = currentSpan.get()
+    if (parent is None and sampleRate <= 0) or (parent and not parent.sampled):
+        yield None
+        return
+    current = startSpan(name, **attributes)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        currentSpan.set(parent)
+        endSpan(current, error)
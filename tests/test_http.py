@@ -0,0 +1,47 @@
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("dotenv")
+pytest.importorskip("orjson")
+pytest.importorskip("prometheus_client")
+
+from services.http import cookieHeader, poolKey  # noqa: E402
+
+
+def cookies() -> "httpx.Cookies":
+    jar = httpx.Cookies()
+    jar.set("userId", "1", domain="maimaidx.jp", path="/")
+    # SEGA IDのログイン画面が設定するCookieと、同じ名前の別ドメインのCookie
+    jar.set("userId", "2", domain="lng-tgk-aime-gw.am-all.net", path="/")
+    jar.set("clal", "secret", domain=".am-all.net", path="/")
+    jar.set("page", "1", domain="maimaidx.jp", path="/maimai-mobile/record/")
+    return jar
+
+
+def test_cookieHeaderOnlySendsMatchingCookies():
+    header = cookieHeader(cookies(), "https://maimaidx.jp/maimai-mobile/img/Icon/a.png")
+    assert header == {"Cookie": "userId=1"}
+
+
+def test_cookieHeaderMatchesPath():
+    header = cookieHeader(cookies(), "https://maimaidx.jp/maimai-mobile/record/")
+    assert sorted(header["Cookie"].split("; ")) == ["page=1", "userId=1"]
+
+
+def test_cookieHeaderWithoutMatches():
+    assert cookieHeader(cookies(), "https://example.com/image.png") == {}
+
+
+def test_poolKey():
+    assert poolKey("https://maimaidx.jp/maimai-mobile/img/a.png") == "maimaidx.jp"
+    assert poolKey("https://p.eagate.573.jp/game/") == "p.eagate.573.jp"
+    # 任意のホストは一つのクライアントにまとめる
+    assert poolKey("https://a.example.com/") == poolKey("https://b.example.com/")
+
+
+def test_upstreamOf():
+    from services.http import upstreamOf
+
+    assert upstreamOf("https://maimaidx.jp/maimai-mobile/") == "sega"
+    assert upstreamOf("https://p.eagate.573.jp/game/") == "eagate"
+    assert upstreamOf("https://attacker.example/a.png") == "other"
@@ -0,0 +1,146 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("fastapi")
+pytest.importorskip("prometheus_client")
+
+from fastapi import HTTPException  # noqa: E402
+
+from services.iconCache import IconCache  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache(monkeypatch):
+    monkeypatch.setattr(IconCache, "entries", OrderedDict())
+    monkeypatch.setattr(IconCache, "refreshing", {})
+    monkeypatch.setattr(IconCache, "generations", {})
+    monkeypatch.setattr(IconCache, "ttl", 60)
+    monkeypatch.setattr(IconCache, "maxStale", 600)
+
+
+class Fetcher:
+    """呼ばれた回数を数え、releaseされるまで取得を終えない取得関数です。"""
+
+    def __init__(self, *icons: bytes):
+        self.icons = list(icons)
+        self.calls = 0
+        self.released = asyncio.Event()
+        self.released.set()
+
+    async def started(self):
+        while not self.calls:
+            await asyncio.sleep(0)
+
+    async def __call__(self) -> tuple[bytes, str]:
+        self.calls += 1
+        await self.released.wait()
+        return self.icons.pop(0), "image/png"
+
+
+def test_getCachesWithinTtl():
+    async def main():
+        fetcher = Fetcher(b"a", b"b")
+        first = await IconCache.get(1, "maimai", fetcher)
+        second = await IconCache.get(1, "maimai", fetcher)
+        return fetcher, first, second
+
+    fetcher, first, second = asyncio.run(main())
+    assert fetcher.calls == 1
+    assert first is second and first.data == b"a"
+
+
+def test_concurrentMissesShareOneFetch():
+    async def main():
+        fetcher = Fetcher(b"a")
+        fetcher.released.clear()
+        gets = [
+            asyncio.create_task(IconCache.get(1, "popn", fetcher)) for _ in range(3)
+        ]
+        await fetcher.started()
+        fetcher.released.set()
+        return fetcher, await asyncio.gather(*gets)
+
+    fetcher, entries = asyncio.run(main())
+    assert fetcher.calls == 1
+    assert {entry.data for entry in entries} == {b"a"}
+
+
+def test_staleEntryIsReturnedWhileRefreshing():
+    async def main():
+        fetcher = Fetcher(b"old", b"new")
+        entry = await IconCache.get(1, "maimai", fetcher)
+        entry.fetchedAt = time.monotonic() - IconCache.ttl - 1
+        stale = await IconCache.get(1, "maimai", fetcher)
+        await IconCache.refreshing[(1, "maimai")]
+        return stale, IconCache.entries[(1, "maimai")]
+
+    stale, refreshed = asyncio.run(main())
+    assert stale.data == b"old"
+    assert refreshed.data == b"new"
+
+
+def test_tooStaleEntryIsFetchedAgain():
+    async def main():
+        fetcher = Fetcher(b"old", b"new")
+        entry = await IconCache.get(1, "maimai", fetcher)
+        entry.fetchedAt = time.monotonic() - IconCache.maxStale - 1
+        return await IconCache.get(1, "maimai", fetcher)
+
+    assert asyncio.run(main()).data == b"new"
+
+
+def test_invalidateDuringFetchDiscardsOldIcon():
+    async def main():
+        fetcher = Fetcher(b"old", b"new")
+        fetcher.released.clear()
+        get = asyncio.create_task(IconCache.get(1, "maimai", fetcher))
+        await fetcher.started()
+        # 取得中にリンクし直された
+        IconCache.invalidate(1, "maimai")
+        fetcher.released.set()
+        old = await get
+        assert (1, "maimai") not in IconCache.entries
+        return old, await IconCache.get(1, "maimai", fetcher)
+
+    old, new = asyncio.run(main())
+    assert old.data == b"old"
+    assert new.data == b"new"
+
+
+def test_invalidateDropsEntry():
+    async def main():
+        await IconCache.get(1, "maimai", Fetcher(b"a"))
+        IconCache.invalidate(1, "maimai")
+
+    asyncio.run(main())
+    assert IconCache.entries == {}
+    assert IconCache.generations[(1, "maimai")] == 1
+
+
+def test_evictsLeastRecentlyUsed(monkeypatch):
+    monkeypatch.setattr(IconCache, "maxEntries", 2)
+
+    async def main():
+        fetcher = Fetcher(b"1", b"2", b"3")
+        for userId in (1, 2):
+            await IconCache.get(userId, "maimai", fetcher)
+        await IconCache.get(1, "maimai", fetcher)
+        await IconCache.get(3, "maimai", fetcher)
+
+    asyncio.run(main())
+    assert list(IconCache.entries) == [(1, "maimai"), (3, "maimai")]
+
+
+def test_httpExceptionIsNotLogged(caplog):
+    async def notLinked() -> tuple[bytes, str]:
+        raise HTTPException(404)
+
+    with pytest.raises(HTTPException):
+        asyncio.run(IconCache.get(1, "maimai", notLinked))
+    assert IconCache.refreshing == {}
+    assert IconCache.entries == {}
+    assert not caplog.records
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("fastapi")
+pytest.importorskip("httpx")
+pytest.importorskip("PIL")
+pytest.importorskip("prometheus_client")
+
+from services.imageCache import ImageCache  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ImageCache, "directory", tmp_path)
+    monkeypatch.setattr(ImageCache, "maxBytes", 10)
+    monkeypatch.setattr(ImageCache, "totalBytes", 0)
+    monkeypatch.setattr(ImageCache, "entries", OrderedDict())
+    monkeypatch.setattr(ImageCache, "hot", OrderedDict())
+    monkeypatch.setattr(ImageCache, "hotBytes", 0)
+    monkeypatch.setattr(ImageCache, "hotMaxBytes", 100)
+    monkeypatch.setattr(ImageCache, "hotEntryMaxBytes", 100)
+
+
+def write(key: str, size: int, usedAt: float | None = None):
+    path = ImageCache.directory / f"{key}.png"
+    path.write_bytes(b"x" * size)
+    if usedAt is not None:
+        os.utime(path, (usedAt, usedAt))
+    return path
+
+
+def put(key: str, size: int):
+    path = write(key, size)
+    asyncio.run(ImageCache.register(key, path, size, "image/png", b"x" * size))
+    return path
+
+
+def merge():
+    asyncio.run(ImageCache.merge(ImageCache.scan(), time.time() + 1))
+
+
+def test_registerEvictsLeastRecentlyUsed():
+    a, b = put("a", 4), put("b", 4)
+    assert asyncio.run(ImageCache.lookup("a")) is not None
+    put("c", 4)
+    assert list(ImageCache.entries) == ["a", "c"]
+    assert ImageCache.totalBytes == 8
+    assert "b" not in ImageCache.hot
+    assert a.exists() and not b.exists()
+
+
+def test_lookupForgetsDeletedFile():
+    put("a", 4).unlink()
+    ImageCache.hot.clear()
+    assert asyncio.run(ImageCache.lookup("a")) is None
+    assert "a" not in ImageCache.entries
+    assert ImageCache.totalBytes == 0
+
+
+def test_mergeOrdersOtherWorkersFilesByAccessTime():
+    put("a", 3)
+    write("old", 3, time.time() - 100)
+    write("new", 3, time.time() + 100)
+    merge()
+    assert list(ImageCache.entries) == ["old", "a", "new"]
+    assert ImageCache.totalBytes == 9
+
+
+def test_mergeKeepsLocalOrderWhenOtherWorkersReadFiles():
+    put("a", 3)
+    put("b", 3)
+    # 他のワーカーがaを読むと、aの最終アクセス日時だけが進む
+    later = time.time() + 100
+    os.utime(ImageCache.entries["a"].path, (later, later))
+    merge()
+    assert list(ImageCache.entries) == ["b", "a"]
+
+
+def test_mergeDropsDeletedFilesAndEnforcesLimit():
+    put("a", 4).unlink()
+    put("b", 4)
+    oldest = write("oldest", 4, time.time() - 200)
+    write("old", 4, time.time() - 100)
+    merge()
+    assert list(ImageCache.entries) == ["old", "b"]
+    assert ImageCache.totalBytes == 8
+    assert not oldest.exists()
+
+
+def test_mergeKeepsFilesWrittenDuringScan():
+    files = ImageCache.scan()
+    scannedAt = time.time() - 1
+    put("a", 4)
+    asyncio.run(ImageCache.merge(files, scannedAt))
+    assert list(ImageCache.entries) == ["a"]
@@ -0,0 +1,159 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("fastapi")
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("PIL")
+
+from fastapi import HTTPException  # noqa: E402
+
+from routes.imageProxy import byteRange, cachedImage, readFile, relay  # noqa: E402
+from services.imageCache import CacheEntry, ImageCache  # noqa: E402
+
+etag = '"abc-100"'
+
+
+def request(**headers: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        headers={name.replace("_", "-"): value for name, value in headers.items()}
+    )
+
+
+def test_noRange():
+    assert byteRange(request(), etag, 100) is None
+
+
+@pytest.mark.parametrize(
+    ("header", "expected"),
+    [
+        ("bytes=0-9", (0, 9)),
+        ("bytes=90-", (90, 99)),
+        ("bytes=90-500", (90, 99)),
+        ("bytes=-10", (90, 99)),
+        ("bytes=-500", (0, 99)),
+    ],
+)
+def test_singleRange(header: str, expected: tuple[int, int]):
+    assert byteRange(request(range=header), etag, 100) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=0-1,5-6", "items=0-9", "bytes=a-b"])
+def test_unsupportedRangeReturnsWholeBody(header: str):
+    assert byteRange(request(range=header), etag, 100) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=100-", "bytes=50-10", "bytes=-0"])
+def test_unsatisfiableRange(header: str):
+    with pytest.raises(HTTPException) as error:
+        byteRange(request(range=header), etag, 100)
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == "bytes */100"
+
+
+def test_ifRange():
+    assert byteRange(request(range="bytes=0-9", if_range=etag), etag, 100) == (0, 9)
+    assert byteRange(request(range="bytes=0-9", if_range='"old"'), etag, 100) is None
+
+
+class Chunks(httpx.AsyncByteStream):
+    def __init__(self, *chunks: bytes):
+        self.chunks = chunks
+        self.closed = False
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    async def aclose(self):
+        self.closed = True
+
+
+def upstream(*chunks: bytes, contentType: str = "image/png") -> "httpx.Response":
+    return httpx.Response(
+        200, headers={"content-type": contentType}, stream=Chunks(*chunks)
+    )
+
+
+async def drain(response: "httpx.Response") -> bytes:
+    return b"".join([chunk async for chunk in relay(response)])
+
+
+def test_relayClosesUpstream(monkeypatch):
+    monkeypatch.setattr(ImageCache, "maxObjectBytes", 1024)
+    response = upstream(b"ab", b"cd")
+    assert asyncio.run(drain(response)) == b"abcd"
+    assert response.stream.closed
+
+
+def test_relayClosesUpstreamWhenTooLarge(monkeypatch):
+    monkeypatch.setattr(ImageCache, "maxObjectBytes", 3)
+    response = upstream(b"ab", b"cd")
+    with pytest.raises(HTTPException):
+        asyncio.run(drain(response))
+    assert response.stream.closed
+
+
+def test_relayClosesUpstreamWhenAbandoned(monkeypatch):
+    monkeypatch.setattr(ImageCache, "maxObjectBytes", 1024)
+
+    async def main(response: "httpx.Response"):
+        body = relay(response)
+        await body.__anext__()
+        # クライアントが切断した場合と同じく、読み切らずに閉じる
+        await body.aclose()
+
+    response = upstream(b"ab", b"cd")
+    asyncio.run(main(response))
+    assert response.stream.closed
+
+
+@pytest.mark.parametrize(
+    ("contentType", "expected"),
+    [("image/webp", "image/webp"), ("image/PNG; charset=binary", "image/png")],
+)
+def test_contentTypeOfImages(contentType: str, expected: str):
+    assert ImageCache.contentTypeOf(upstream(contentType=contentType)) == expected
+
+
+@pytest.mark.parametrize(
+    "contentType", ["text/html", "application/javascript", "image/svg+xml"]
+)
+def test_contentTypeOfRejectsOtherTypes(contentType: str):
+    with pytest.raises(HTTPException) as error:
+        ImageCache.contentTypeOf(upstream(contentType=contentType))
+    assert error.value.status_code == 502
+
+
+def test_readFileRange(tmp_path):
+    path = tmp_path / "image.png"
+    path.write_bytes(b"0123456789")
+    file = path.open("rb")
+
+    async def main() -> bytes:
+        return b"".join([chunk async for chunk in readFile(file, 2, 5)])
+
+    assert asyncio.run(main()) == b"2345"
+    assert file.closed
+
+
+def test_cachedImageFetchesAgainWhenFileWasDeleted(tmp_path, monkeypatch):
+    # 取得してから開くまでの間に、別のワーカーが削除した場合
+    deleted = CacheEntry(tmp_path / "deleted.png", 4, "image/png", 0, 0)
+    path = tmp_path / "fetched.png"
+    path.write_bytes(b"data")
+    fetched = CacheEntry(path, 4, "image/png", 0, 0)
+    entries = [deleted, fetched]
+    forgotten = []
+
+    async def fetch(url: str):
+        return entries.pop(0), None
+
+    monkeypatch.setattr(ImageCache, "fetch", fetch)
+    monkeypatch.setattr(ImageCache, "forget", forgotten.append)
+    entry, data, file = asyncio.run(cachedImage("https://example.com", None, None))
+    with file:
+        assert entry is fetched and data is None
+        assert file.read() == b"data"
+    assert forgotten == [deleted]
@@ -0,0 +1,49 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("asyncpg")
+pytest.importorskip("dotenv")
+pytest.importorskip("prometheus_client")
+pytest.importorskip("otoge")
+
+from services.rating import ChartTable, bestPerChart, ratings  # noqa: E402
+
+
+def test_ratings():
+    constants = np.array([13.0, 13.0, 13.0, 13.0, 13.0, 14.7])
+    achievements = np.array([100.5, 101.0, 100.0, 97.0, 96.9999, 0.0])
+    assert ratings(constants, achievements).tolist() == [292, 292, 280, 252, 221, 0]
+
+
+def test_ratingsAtRankBoundaries():
+    constants = np.full(3, 12.5)
+    achievements = np.array([99.4999, 99.5, 80.0])
+    # 12.5 * 99.4999 * 20.8 / 100, 12.5 * 99.5 * 21.1 / 100, 12.5 * 80 * 13.6 / 100
+    assert ratings(constants, achievements).tolist() == [258, 262, 136]
+
+
+def test_bestPerChart():
+    charts, achievements = bestPerChart(
+        np.array([2, 1, 2, 1, 3]), np.array([99.0, 98.0, 100.5, 97.5, 50.0])
+    )
+    assert charts.tolist() == [1, 2, 3]
+    assert achievements.tolist() == [98.0, 100.5, 50.0]
+
+
+def test_bestPerChartEmpty():
+    charts, achievements = bestPerChart(
+        np.empty(0, dtype=np.int64), np.empty(0, dtype=float)
+    )
+    assert len(charts) == len(achievements) == 0
+
+
+def test_chartTable():
+    table = ChartTable(
+        [
+            {"name": "A", "difficult": "MASTER", "constant": 13.7, "isNew": True},
+            {"name": "A", "difficult": "EXPERT", "constant": 11.2},
+        ]
+    )
+    assert table.index[("A", "EXPERT")] == 1
+    assert table.constants.tolist() == [13.7, 11.2]
+    assert table.isNew.tolist() == [True, False]
@@ -0,0 +1,88 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import pytest
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("discord")
+pytest.importorskip("dotenv")
+pytest.importorskip("orjson")
+pytest.importorskip("otoge")
+pytest.importorskip("prometheus_client")
+
+from services.records import PlayRecords  # noqa: E402
+from views.recordPaginator import RecordSnapshots  # noqa: E402
+
+
+@pytest.fixture
+def history(monkeypatch):
+    """PlayRecords.historyの代わりに、読み込んだ範囲を記録して連番を返します。"""
+    monkeypatch.setattr(RecordSnapshots, "entries", OrderedDict())
+    monkeypatch.setattr(RecordSnapshots, "players", OrderedDict())
+    monkeypatch.setattr(RecordSnapshots, "chunkSize", 3)
+    monkeypatch.setattr(RecordSnapshots, "maxEntries", 2)
+    calls = []
+
+    async def fetch(userId: int, game: str, snapshot: int, limit: int, offset: int):
+        calls.append((userId, game, snapshot, limit, offset))
+        return list(range(offset, min(offset + limit, 7)))
+
+    monkeypatch.setattr(PlayRecords, "history", fetch)
+    return calls
+
+
+def record(index: int, snapshot: int = 100):
+    return asyncio.run(RecordSnapshots.record("popn", 1, snapshot, index))
+
+
+def test_recordLoadsOneChunk(history):
+    assert [record(index) for index in range(3)] == [0, 1, 2]
+    assert history == [(1, "popn", 100, 3, 0)]
+
+
+def test_recordLoadsNextChunkAtBoundary(history):
+    assert record(4) == 4
+    assert history == [(1, "popn", 100, 3, 3)]
+
+
+def test_recordPastTheEnd(history):
+    assert record(6) == 6
+    assert record(7) is None
+    assert len(history) == 1
+
+
+def test_snapshotsAreCachedSeparately(history):
+    record(0, snapshot=100)
+    record(0, snapshot=200)
+    assert [call[2] for call in history] == [100, 200]
+
+
+def test_sweepEvictsOldestChunks(history):
+    for index in (0, 3, 6):
+        record(index)
+    assert [key[3] for key in RecordSnapshots.entries] == [1, 2]
+    record(0)
+    assert len(history) == 4
+
+
+def test_sweepEvictsExpiredChunks(history):
+    record(0)
+    key = next(iter(RecordSnapshots.entries))
+    _, records = RecordSnapshots.entries[key]
+    RecordSnapshots.entries[key] = (time.monotonic() - RecordSnapshots.ttl, records)
+    record(3)
+    assert key not in RecordSnapshots.entries
+
+
+def test_playerIsCached(history, monkeypatch):
+    calls = []
+
+    async def player(userId: int, game: str):
+        calls.append((userId, game))
+        return {"name": "player"}
+
+    monkeypatch.setattr(PlayRecords, "player", player)
+    for _ in range(2):
+        assert asyncio.run(RecordSnapshots.player("popn", 1)) == {"name": "player"}
+    assert calls == [(1, "popn")]
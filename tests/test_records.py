@@ -0,0 +1,115 @@
+import asyncio
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("dotenv")
+orjson = pytest.importorskip("orjson")
+otoge = pytest.importorskip("otoge")
+pytest.importorskip("prometheus_client")
+
+from services.database import Database  # noqa: E402
+from services.records import (  # noqa: E402
+    PlayRecords,
+    dump,
+    load,
+    playerStats,
+    toAware,
+    toScore,
+)
+
+
+def roundTrip(value):
+    return load(orjson.loads(orjson.dumps(dump(value))))
+
+
+def test_dumpAndLoad():
+    difficulty = next(iter(otoge.PolarisChordDifficultyType))
+    record = SimpleNamespace(
+        name="曲",
+        musicId=42,
+        playedAt=datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc),
+        chartDifficultyType=difficulty,
+        judges=SimpleNamespace(perfect=1, miss=0),
+        tags=["a", "b"],
+        _client=object(),
+    )
+    loaded = roundTrip(record)
+    assert loaded.name == "曲"
+    assert loaded.musicId == 42
+    assert loaded.playedAt == record.playedAt
+    assert loaded.chartDifficultyType is difficulty
+    assert loaded.judges.perfect == 1
+    assert loaded.tags == ["a", "b"]
+    # 内部の属性は保存しない
+    assert not hasattr(loaded, "_client")
+
+
+def test_loadUnknownEnum():
+    loaded = load({"enum": "NoSuchEnum", "name": "MASTER"})
+    assert loaded.name == "MASTER"
+
+
+def test_loadPlainValues():
+    assert load([1, "a", None]) == [1, "a", None]
+    assert roundTrip({"key": [1, 2]}).key == [1, 2]
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    [
+        ("100.5000%", 100.5),
+        ("1,234,567", 1234567.0),
+        (98765, 98765.0),
+        ("-", None),
+        ("", None),
+        (None, None),
+    ],
+)
+def test_toScore(value, expected):
+    assert toScore(value) == expected
+
+
+def test_playerStats():
+    profile = SimpleNamespace(rating="15,234", name="player")
+    assert playerStats("maimai", profile) == {"rating": 15234.0}
+    assert playerStats("polaris", SimpleNamespace(paSkill="-")) == {}
+    assert playerStats("nostalgia", profile) == {}
+
+
+def test_toAware():
+    naive = datetime(2024, 5, 1, 21, 0)
+    assert toAware(naive).utcoffset().total_seconds() == 9 * 3600
+    assert toAware(None).year == 1970
+
+
+def popnRecord(name: str, easy="-", normal="-", hyper="-", ex="-") -> SimpleNamespace:
+    return SimpleNamespace(
+        name=name, easyScore=easy, normalScore=normal, hyperScore=hyper, exScore=ex
+    )
+
+
+def test_changedReturnsOnlyImprovedRecords(monkeypatch):
+    bests = [
+        {"music_id": "saved", "difficulty": "HYPER", "score": 90000.0},
+        {"music_id": "saved", "difficulty": "EX", "score": 80000.0},
+    ]
+    queries = []
+
+    async def fetch(query: str, *args):
+        queries.append((query, *args))
+        return bests
+
+    monkeypatch.setattr(Database, "fetch", fetch)
+    unchanged = popnRecord("saved", hyper="90,000", ex="80,000")
+    improved = popnRecord("saved", hyper="90,000", ex="85,000")
+    newDifficulty = popnRecord("saved", normal="70,000")
+    newSong = popnRecord("new", easy="50,000")
+    unplayed = popnRecord("unplayed")
+    records = [unchanged, improved, newDifficulty, newSong, unplayed]
+
+    changed = asyncio.run(PlayRecords.changed(1, "popn", records))
+    assert changed == [improved, newDifficulty, newSong]
+    assert queries == [("userSongBests", 1, "popn")]
@@ -0,0 +1,128 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("dotenv")
+pytest.importorskip("orjson")
+pytest.importorskip("prometheus_client")
+
+from services.scheduler import Priority, UpstreamLimiter, currentPriority  # noqa: E402
+from services.singleflight import SingleFlight  # noqa: E402
+
+
+def limiter(rate: float = 1000, burst: int = 1000, concurrency: int = 1):
+    return UpstreamLimiter("test", rate=rate, burst=burst, concurrency=concurrency)
+
+
+async def hold(
+    upstream: UpstreamLimiter,
+    order: list[str],
+    name: str,
+    priority: Priority | None = None,
+):
+    async with upstream.slot(priority):
+        order.append(name)
+        await asyncio.sleep(0.01)
+
+
+def test_interactiveRunsBeforeBackground():
+    async def main():
+        upstream = limiter()
+        order = []
+        first = asyncio.create_task(hold(upstream, order, "first"))
+        await asyncio.sleep(0)
+        waiters = [
+            asyncio.create_task(
+                hold(upstream, order, "background", Priority.BACKGROUND)
+            ),
+            asyncio.create_task(
+                hold(upstream, order, "interactive", Priority.INTERACTIVE)
+            ),
+        ]
+        await asyncio.gather(first, *waiters)
+        return order, upstream.stats()
+
+    order, stats = asyncio.run(main())
+    assert order == ["first", "interactive", "background"]
+    assert stats["completed"] == 3
+    assert stats["active"] == 0
+    assert stats["queued"] == 0
+
+
+def test_concurrencyLimit():
+    async def main():
+        upstream = limiter(concurrency=2)
+        active = peak = 0
+
+        async def call():
+            nonlocal active, peak
+            async with upstream.slot():
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+
+        await asyncio.gather(*(call() for _ in range(6)))
+        return peak
+
+    assert asyncio.run(main()) == 2
+
+
+def test_tokenBucket():
+    async def main():
+        upstream = limiter(rate=50, burst=1, concurrency=10)
+        startedAt = time.monotonic()
+        for _ in range(3):
+            async with upstream.slot():
+                pass
+        return time.monotonic() - startedAt
+
+    # 最初の一回はバーストで、残りの二回はそれぞれ1/50秒待つ
+    assert asyncio.run(main()) >= 0.035
+
+
+def test_cancelledWaiterDoesNotLeakSlot():
+    async def main():
+        upstream = limiter()
+        order = []
+        first = asyncio.create_task(hold(upstream, order, "first"))
+        await asyncio.sleep(0)
+        cancelled = asyncio.create_task(hold(upstream, order, "cancelled"))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.gather(first, hold(upstream, order, "after"))
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        return order, upstream.active
+
+    order, active = asyncio.run(main())
+    assert order == ["first", "after"]
+    assert active == 0
+
+
+def test_singleFlightRaisesPriority():
+    async def main():
+        upstream = limiter()
+        flights = SingleFlight()
+        order = []
+        first = asyncio.create_task(hold(upstream, order, "first"))
+        await asyncio.sleep(0)
+
+        async def background(name: str):
+            currentPriority.set(Priority.BACKGROUND)
+            await hold(upstream, order, name)
+
+        async def backgroundFlight():
+            currentPriority.set(Priority.BACKGROUND)
+            return await flights.do("key", lambda: hold(upstream, order, "flight"))
+
+        others = [asyncio.create_task(background(f"background{i}")) for i in range(2)]
+        joined = asyncio.create_task(backgroundFlight())
+        await asyncio.sleep(0)
+        # 対話的な呼び出し元が同じ処理に加わると、処理全体が先に実行される
+        await flights.do("key", lambda: hold(upstream, order, "unused"))
+        await asyncio.gather(first, joined, *others)
+        return order
+
+    assert asyncio.run(main()) == ["first", "flight", "background0", "background1"]
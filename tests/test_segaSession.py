@@ -0,0 +1,110 @@
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("dotenv")
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("otoge")
+pytest.importorskip("prometheus_client")
+fernet = pytest.importorskip("cryptography.fernet")
+
+# 暗号化はテストしないので、鍵が無ければ使い捨ての鍵で読み込む
+if not os.getenv("fernet_key"):
+    os.environ["fernet_key"] = fernet.Fernet.generate_key().decode()
+
+from services.segaSession import (  # noqa: E402
+    SegaSessions,
+    SessionRejected,
+    rejected,
+    rejectedResponse,
+)
+
+
+class Sessions:
+    """SegaSessions.acquireの代わりに、使い回しかどうかを順に返します。"""
+
+    def __init__(self, *reused: bool):
+        self.reused = list(reused)
+        self.acquired = []
+
+    async def acquire(self, userId: int, row) -> tuple[object, bool]:
+        session = object()
+        self.acquired.append(session)
+        return session, self.reused.pop(0)
+
+
+def run(monkeypatch, sessions: Sessions, errors: list[Exception]):
+    monkeypatch.setattr(SegaSessions, "acquire", sessions.acquire)
+    used = []
+
+    async def action(session: object) -> object:
+        used.append(session)
+        if errors:
+            raise errors.pop(0)
+        return session
+
+    result = asyncio.run(SegaSessions.run(1, None, action))
+    return result, used
+
+
+def test_runRetriesRejectedReusedSession(monkeypatch):
+    sessions = Sessions(True, False)
+    result, used = run(monkeypatch, sessions, [SessionRejected()])
+    assert used == sessions.acquired
+    assert result is sessions.acquired[1]
+
+
+def test_runDoesNotRetryOtherErrors(monkeypatch):
+    sessions = Sessions(True, False)
+    with pytest.raises(TimeoutError):
+        run(monkeypatch, sessions, [TimeoutError()])
+    assert len(sessions.acquired) == 1
+
+
+def test_runDoesNotRetryFreshSession(monkeypatch):
+    sessions = Sessions(False, False)
+    with pytest.raises(SessionRejected):
+        run(monkeypatch, sessions, [SessionRejected()])
+    assert len(sessions.acquired) == 1
+
+
+def test_runRetriesOnlyOnce(monkeypatch):
+    sessions = Sessions(True, False)
+    with pytest.raises(SessionRejected):
+        run(monkeypatch, sessions, [SessionRejected(), SessionRejected()])
+    assert len(sessions.acquired) == 2
+
+
+@pytest.mark.parametrize(
+    ("status", "headers", "expected"),
+    [
+        (200, {}, False),
+        (401, {}, True),
+        (403, {}, True),
+        (404, {}, False),
+        (302, {"location": "https://lng-tgk-aime-gw.am-all.net/common_auth/"}, True),
+        (302, {"location": "https://maimaidx.jp/maimai-mobile/home/"}, False),
+    ],
+)
+def test_rejectedResponse(status: int, headers: dict[str, str], expected: bool):
+    assert rejectedResponse(httpx.Response(status, headers=headers)) is expected
+
+
+def test_rejectedHTTPStatusError():
+    request = httpx.Request("GET", "https://maimaidx.jp/")
+    for status, expected in [(403, True), (500, False)]:
+        response = httpx.Response(status, request=request)
+        error = httpx.HTTPStatusError("", request=request, response=response)
+        assert rejected(error) is expected
+
+
+def test_rejectedLoginErrors():
+    class LoginRequired(Exception):
+        pass
+
+    assert rejected(LoginRequired())
+    assert rejected(Exception("ログインしてください"))
+    assert not rejected(ValueError("invalid literal"))
+    assert not rejected(TimeoutError())
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+pytest.importorskip("discord")
+pytest.importorskip("httpx")
+pytest.importorskip("dotenv")
+
+from launcher import splitShards  # noqa: E402
+
+
+def parseShardIds(value: str | None) -> list[int] | None:
+    # bot.pyは読み込むだけでセッションの暗号化に使う鍵を要求する
+    fernet = pytest.importorskip("cryptography.fernet")
+    pytest.importorskip("otoge")
+    os.environ.setdefault("fernet_key", fernet.Fernet.generate_key().decode())
+    import bot
+
+    return bot.parseShardIds(value)
+
+
+def test_splitShards():
+    assert splitShards(10, 3) == [[0, 1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    assert splitShards(4, 4) == [[0], [1], [2], [3]]
+    # シャードより多いクラスターは作らない
+    assert splitShards(2, 5) == [[0], [1]]
+    shards = [shard for cluster in splitShards(37, 6) for shard in cluster]
+    assert shards == list(range(37))
+
+
+def test_parseShardIds():
+    assert parseShardIds(None) is None
+    assert parseShardIds("") is None
+    assert parseShardIds("3") == [3]
+    assert parseShardIds("0,1,2") == [0, 1, 2]
+    assert parseShardIds("0-3") == [0, 1, 2, 3]
+    assert parseShardIds("0-1,4,6-7") == [0, 1, 4, 6, 7]
+
+
+def test_splitShardsRoundTrip():
+    # launcher.pyが渡すshard_idsを、bot.pyがそのまま読み取れる
+    for shardIds in splitShards(16, 3):
+        assert parseShardIds(",".join(map(str, shardIds))) == shardIds
@@ -0,0 +1,86 @@
+import pytest
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("dotenv")
+pytest.importorskip("orjson")
+pytest.importorskip("prometheus_client")
+
+from services.songCatalog import (  # noqa: E402
+    Song,
+    SongCatalog,
+    SongIndex,
+    normalize,
+    toRomaji,
+)
+
+
+@pytest.mark.parametrize(
+    ("text", "expected"),
+    [
+        ("さくら", "sakura"),
+        ("きゃりー", "kyarii"),
+        ("がっこう", "gakkou"),
+        ("しんじつ", "shinjitsu"),
+        ("abcあ", "abca"),
+    ],
+)
+def test_toRomaji(text: str, expected: str):
+    assert toRomaji(text) == expected
+
+
+def test_normalize():
+    # 全角・半角、大文字・小文字、カタカナ・ひらがなの違いと記号をなくす
+    assert normalize("ＡＢＣ！ ヒバナ") == "abcひばな"
+    assert toRomaji(normalize("ニャー")) == "nyaa"
+
+
+def index() -> SongIndex:
+    return SongIndex(
+        [
+            Song("maimai", name, name)
+            for name in (
+                "Oshama Scramble!",
+                "おじゃま虫",
+                "ヒバナ",
+                "花と、雪と、ドラムンベース。",
+                "系ぎて",
+                "ヒバナ (Remix)",
+            )
+        ]
+    )
+
+
+def names(songs: list[Song]) -> list[str]:
+    return [song.name for song in songs]
+
+
+def test_searchPrefix():
+    assert names(index().search("ひば"))[:2] == ["ヒバナ", "ヒバナ (Remix)"]
+
+
+def test_searchRomaji():
+    assert names(index().search("hibana"))[0] == "ヒバナ"
+    assert names(index().search("ojama"))[0] == "おじゃま虫"
+
+
+def test_searchSubstring():
+    assert names(index().search("scramble"))[0] == "Oshama Scramble!"
+    assert names(index().search("ドラムン"))[0] == "花と、雪と、ドラムンベース。"
+
+
+def test_searchSingleCharacter():
+    assert "系ぎて" in names(index().search("系"))
+
+
+def test_searchLimitAndEmptyQuery():
+    assert len(index().search("", limit=3)) == 3
+    assert len(index().search("a", limit=2)) <= 2
+    assert SongIndex([]).search("hibana") == []
+
+
+def test_jacketUrl():
+    assert SongCatalog.jacketUrl("polaris", "123").endswith("?c=123")
+    assert SongCatalog.jacketUrl("polaris", "123", "https://example.com/a.png") == (
+        "https://example.com/a.png"
+    )
+    assert SongCatalog.jacketUrl("maimai", "123") is None
@@ -0,0 +1,43 @@
+import asyncpg
+import discord
+
+from services.database import Database
+
+
+def formatScore(score: float) -> str:
+    return str(int(score)) if score.is_integer() else str(score)
+
+
+class Leaderboards:
+    """サーバー内のランキングを、事前に集計したベストスコアから一度の読み出しで作ります。"""
+
+    size: int = 10
+
+    @staticmethod
+    def embed(title: str, rows: list[asyncpg.Record]) -> discord.Embed:
+        lines = []
+        for rank, row in enumerate(rows, 1):
+            name = row["name"] or "?"
+            score = formatScore(row["score"])
+            lines.append(f"`{rank:>2}.` {name} (<@{row['user_id']}>): `{score}`")
+        return discord.Embed(
+            title=title,
+            description="\n".join(lines) or "まだ記録がありません。",
+            colour=discord.Colour.gold(),
+        )
+
+    @classmethod
+    async def song(
+        cls, guildId: int, game: str, song: str, difficulty: str
+    ) -> discord.Embed:
+        rows = await Database.fetch(
+            "songLeaderboard", guildId, game, song, difficulty, cls.size
+        )
+        return cls.embed(f"{song} [{difficulty}]", rows)
+
+    @classmethod
+    async def stat(
+        cls, guildId: int, game: str, stat: str, label: str
+    ) -> discord.Embed:
+        rows = await Database.fetch("statLeaderboard", guildId, game, stat, cls.size)
+        return cls.embed(label, rows)
@@ -0,0 +1,43 @@
+import io
+from types import SimpleNamespace
+from typing import Callable
+
+import discord
+
+from services import tracing
+from services.records import PlayRecords
+from services.renderer import Card, Renderer
+
+# 記録から記録カードの内容を作る関数。各Cogが登録する
+CardBuilder = Callable[[SimpleNamespace], Card]
+
+
+class RecordCards:
+    builders: dict[str, CardBuilder] = {}
+    pageSize: int = 20
+
+    @classmethod
+    async def send(cls, interaction: discord.Interaction, game: str, page: int) -> bool:
+        """記録をpageSize件ずつ一枚の画像にまとめて送信します。記録がなければFalseを返します。"""
+        snapshot, total = await PlayRecords.snapshot(interaction.user.id, game)
+        offset = page * cls.pageSize
+        if offset >= total:
+            return False
+        records = await PlayRecords.history(
+            interaction.user.id, game, snapshot, cls.pageSize, offset
+        )
+        player = await PlayRecords.player(interaction.user.id, game)
+        image = await Renderer.render(
+            player["name"] if player else interaction.user.display_name,
+            [cls.builders[game](record) for record in records],
+        )
+
+        file = discord.File(io.BytesIO(image), filename="records.png")
+        embed = (
+            discord.Embed(colour=discord.Colour.blurple())
+            .set_image(url="attachment://records.png")
+            .set_footer(text=f"{offset + 1} - {offset + len(records)} / {total}")
+        )
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embed=embed, file=file)
+        return True
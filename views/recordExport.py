@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import discord
+
+from services.export import RecordExport
+
+logger = logging.getLogger(__name__)
+
+# サーバー外 (DMなど) で送れるファイルの大きさ
+defaultFileSizeLimit = 10 * 1024 * 1024
+
+
+class RecordExports:
+    """書き出しをインタラクションの処理とは別のタスクで行い、終わったらファイルを送信します。"""
+
+    tasks: set[asyncio.Task] = set()
+
+    @classmethod
+    def start(cls, interaction: discord.Interaction, game: str, format: str):
+        task = asyncio.create_task(cls.run(interaction, game, format))
+        cls.tasks.add(task)
+        task.add_done_callback(cls.tasks.discard)
+
+    @classmethod
+    async def run(cls, interaction: discord.Interaction, game: str, format: str):
+        descriptor, name = tempfile.mkstemp(suffix=f".{format}.gz")
+        os.close(descriptor)
+        path = Path(name)
+        try:
+            count = await RecordExport.write(interaction.user.id, game, format, path)
+            limit = (
+                interaction.guild.filesize_limit
+                if interaction.guild is not None
+                else defaultFileSizeLimit
+            )
+            if path.stat().st_size > limit:
+                embed = discord.Embed(
+                    title="ファイルが大きすぎるため送信できませんでした。",
+                    colour=discord.Colour.red(),
+                )
+                await interaction.followup.send(embed=embed, ephemeral=True)
+                return
+            embed = discord.Embed(
+                title="プレイ履歴を書き出しました。",
+                description=f"{count}件",
+                colour=discord.Colour.green(),
+            )
+            await interaction.followup.send(
+                embed=embed,
+                file=discord.File(path, filename=f"{game}-records.{format}.gz"),
+                ephemeral=True,
+            )
+        except Exception as e:
+            logger.exception(
+                "failed to export %s records of %s", game, interaction.user.id
+            )
+            embed = discord.Embed(
+                title="エラーが発生しました！",
+                description=f"{e}",
+                colour=discord.Colour.red(),
+            )
+            await interaction.followup.send(embed=embed, ephemeral=True)
+        finally:
+            path.unlink(missing_ok=True)
@@ -0,0 +1,153 @@
+import os
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Callable
+
+import asyncpg
+import discord
+import dotenv
+
+from services import tracing
+from services.records import PlayRecords
+
+dotenv.load_dotenv()
+
+# (ユーザーID, プレイヤー情報, 記録) から埋め込みを作る関数。各Cogが登録する
+RecordRenderer = Callable[[int, asyncpg.Record, SimpleNamespace], list[discord.Embed]]
+
+
+class RecordSnapshots:
+    """ページ送り中の記録を、一定件数ごとのまとまりで短い間だけ保持します。
+    消えていてもデータベースから読み直せるので、再起動後もボタンは動きます。
+    """
+
+    ttl: float = float(os.getenv("record_snapshot_ttl", "600"))
+    maxEntries: int = int(os.getenv("record_snapshot_max_entries", "1024"))
+    chunkSize: int = 20
+    entries: OrderedDict[tuple, tuple[float, list[SimpleNamespace]]] = OrderedDict()
+    players: OrderedDict[tuple, tuple[float, asyncpg.Record]] = OrderedDict()
+
+    @classmethod
+    def sweep(cls, entries: OrderedDict):
+        now = time.monotonic()
+        while entries and (
+            len(entries) > cls.maxEntries
+            or now - next(iter(entries.values()))[0] >= cls.ttl
+        ):
+            entries.popitem(last=False)
+
+    @classmethod
+    async def record(
+        cls, game: str, userId: int, snapshot: int, index: int
+    ) -> SimpleNamespace | None:
+        key = (game, userId, snapshot, index // cls.chunkSize)
+        cached = cls.entries.get(key)
+        if cached is None:
+            records = await PlayRecords.history(
+                userId, game, snapshot, cls.chunkSize, key[3] * cls.chunkSize
+            )
+            cached = (time.monotonic(), records)
+            cls.entries[key] = cached
+            cls.sweep(cls.entries)
+        records = cached[1]
+        offset = index % cls.chunkSize
+        return records[offset] if offset < len(records) else None
+
+    @classmethod
+    async def player(cls, game: str, userId: int) -> asyncpg.Record:
+        key = (game, userId)
+        cached = cls.players.get(key)
+        if cached is None:
+            cached = (time.monotonic(), await PlayRecords.player(userId, game))
+            cls.players[key] = cached
+            cls.sweep(cls.players)
+        return cached[1]
+
+
+class RecordPageButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"record:(?P<action>prev|next):(?P<game>[a-z]+):(?P<userId>\d+)"
+    r":(?P<snapshot>\d+):(?P<index>\d+):(?P<total>\d+)",
+):
+    """ページ送りのボタンです。状態はすべてcustom_idに入っています。"""
+
+    def __init__(
+        self, action: str, game: str, userId: int, snapshot: int, index: int, total: int
+    ):
+        self.action = action
+        self.game = game
+        self.userId = userId
+        self.snapshot = snapshot
+        self.index = index
+        self.total = total
+        super().__init__(
+            discord.ui.Button(
+                emoji="⏪" if action == "prev" else "⏩",
+                style=discord.ButtonStyle.blurple,
+                custom_id=f"record:{action}:{game}:{userId}:{snapshot}:{index}:{total}",
+                disabled=index <= 0 if action == "prev" else index >= total - 1,
+            )
+        )
+
+    @classmethod
+    async def from_custom_id(
+        cls,
+        interaction: discord.Interaction,
+        item: discord.ui.Button,
+        match,
+    ):
+        return cls(
+            match["action"],
+            match["game"],
+            int(match["userId"]),
+            int(match["snapshot"]),
+            int(match["index"]),
+            int(match["total"]),
+        )
+
+    async def callback(self, interaction: discord.Interaction):
+        if interaction.user.id != self.userId:
+            embed = discord.Embed(
+                title="他の人は操作できません！", colour=discord.Colour.red()
+            )
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+        await interaction.response.defer()
+        index = self.index - 1 if self.action == "prev" else self.index + 1
+        embeds, view = await RecordPaginator.render(
+            self.game, self.userId, self.snapshot, index, self.total
+        )
+        await interaction.edit_original_response(embeds=embeds, view=view)
+        view.stop()
+
+
+class RecordPaginator:
+    renderers: dict[str, RecordRenderer] = {}
+
+    @classmethod
+    async def render(
+        cls, game: str, userId: int, snapshot: int, index: int, total: int
+    ) -> tuple[list[discord.Embed], discord.ui.View]:
+        index = max(0, min(index, total - 1))
+        record = await RecordSnapshots.record(game, userId, snapshot, index)
+        player = await RecordSnapshots.player(game, userId)
+
+        view = discord.ui.View(timeout=None)
+        view.add_item(RecordPageButton("prev", game, userId, snapshot, index, total))
+        view.add_item(discord.ui.Button(label=f"{index + 1} / {total}", disabled=True))
+        view.add_item(RecordPageButton("next", game, userId, snapshot, index, total))
+        return cls.renderers[game](userId, player, record), view
+
+    @classmethod
+    async def send(cls, interaction: discord.Interaction, game: str) -> bool:
+        """最新の記録のページを送信します。記録がなければFalseを返します。"""
+        snapshot, total = await PlayRecords.snapshot(interaction.user.id, game)
+        if total == 0:
+            return False
+        embeds, view = await cls.render(game, interaction.user.id, snapshot, 0, total)
+        with tracing.span("discord.send"):
+            await interaction.followup.send(embeds=embeds, view=view)
+        # ボタンはDynamicItemとして処理されるので、Viewをメッセージごとに保持しない
+        view.stop()
+        return True
@@ -0,0 +1,38 @@
+import discord
+from discord import app_commands
+
+from services.database import Database
+from services.songCatalog import SongCatalog
+from views.leaderboard import formatScore
+
+
+class SongLookup:
+    @staticmethod
+    async def choices(game: str, current: str) -> list[app_commands.Choice[str]]:
+        """曲名の入力補完の候補を返します。Discordの制限で25件・100文字までです。"""
+        songs = await SongCatalog.search(game, current)
+        return [
+            app_commands.Choice(name=song.name[:100], value=song.name[:100])
+            for song in songs
+        ]
+
+    @staticmethod
+    async def embed(game: str, userId: int, name: str) -> discord.Embed | None:
+        song = await SongCatalog.song(game, name)
+        if song is None:
+            return None
+        rows = await Database.fetch("songBests", userId, game, song.name)
+        embed = discord.Embed(
+            title=song.name,
+            description=None if rows else "まだ記録がありません。",
+            colour=discord.Colour.blurple(),
+        ).set_footer(text=f"{game} / {song.musicId}")
+        for row in rows:
+            embed.add_field(
+                name=row["difficulty"], value=f"`{formatScore(row['score'])}`"
+            )
+        if song.jacketUrl is not None:
+            embed.set_thumbnail(
+                url=f"https://beats-api.nennneko5787.net/imageProxy?url={song.jacketUrl}&w=160&format=webp"
+            )
+        return embed